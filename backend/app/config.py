@@ -4,17 +4,66 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 class Settings(BaseSettings):
     model_repo: str = "Qwen/Qwen2.5-0.5B-Instruct-GGUF"
     model_filename: str = "qwen2.5-0.5b-instruct-q5_k_m.gguf"
+    model_path: str = ""
+    model_local_only: bool = False
+    model_prefetch: bool = False
+    use_mmap: bool = True
+    use_mlock: bool = False
+    warmup_tokens: int = 4
+    autotune: bool = False
+    autotune_cache_path: str = "data/autotune.json"
     n_ctx: int = 8192
     max_new_tokens: int = 512
     generation_timeout_s: float = 30.0
     api_port: int = 8000
     cors_origins: list[str] = ["http://localhost:3000", "http://localhost:5173"]
     log_level: str = "INFO"
+    log_queue_size: int = 0
+    log_batch_size: int = 256
+    log_sample_rate: float = 1.0
+    profile_requests: bool = False
+    profile_recent_requests: int = 200
+    profile_sample_interval_ms: float = 5.0
     temperature: float = 0.7
     top_p: float = 0.9
     repetition_penalty: float = 1.1
-    max_history_messages: int = 10
+    max_history_messages: int = 0
+    history_summary_trigger_tokens: int = 0
+    history_summary_max_tokens: int = 160
     num_threads: int = 0
+    model_replicas: int = 1
+    batch_max_sequences: int = 0
+    speculative_mode: str = "off"
+    speculative_draft_tokens: int = 10
+    speculative_ngram_size: int = 2
+    draft_model_repo: str = ""
+    draft_model_filename: str = ""
+    draft_model_path: str = ""
+    max_concurrent_generations: int = 0
+    max_queued_requests: int = 8
+    scheduler_time_slice_s: float = 0.0
+    scheduler_fair_share: str = "off"
+    priority_api_keys: list[str] = []
+    admin_api_keys: list[str] = []
+    conversation_store: str = "memory"
+    conversation_db_path: str = "data/conversations.db"
+    conversation_cache_size: int = 1000
+    response_cache_max_entries: int = 0
+    response_cache_ttl_s: float = 3600.0
+    semantic_cache_max_entries: int = 0
+    semantic_cache_threshold: float = 0.95
+    stream_flush_interval_ms: float = 20.0
+    stream_flush_max_tokens: int = 16
+    stream_replay_max_events: int = 2048
+    stream_retention_s: float = 60.0
+    stream_resume_grace_s: float = 15.0
+    kv_cache_max_bytes: int = 512 * 1024 * 1024
+    kv_cache_spill_dir: str = ""
+    kv_cache_spill_max_bytes: int = 2 * 1024 * 1024 * 1024
+    model_variants: str = ""
+    load_shed_variant: str = ""
+    load_shed_queue_depth: int = 0
+    load_shed_ttft_s: float = 0.0
 
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
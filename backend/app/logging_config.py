@@ -1,13 +1,19 @@
 import logging
 import json
+import queue
 import sys
+import threading
+import zlib
 from datetime import datetime, timezone
+from typing import TextIO
 
 
 class JSONFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         log_entry = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            # When the record was made, not when it is written: the queued
+            # handler formats records later on its writer thread.
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
             "level": record.levelname,
             "logger": record.name,
             "message": record.getMessage(),
@@ -20,13 +26,146 @@ class JSONFormatter(logging.Formatter):
         return json.dumps(log_entry)
 
 
-def setup_logging(level: str = "INFO") -> None:
-    handler = logging.StreamHandler(sys.stdout)
+class RequestSampler(logging.Filter):
+    """Keep ``rate`` of the per-request INFO and DEBUG lines.
+
+    Per-request lines are the ones carrying a ``conversation_id``. The
+    choice hashes that id, so a sampled conversation keeps all of its
+    lines and the rest keep none. Warnings and errors always pass.
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.threshold = int(max(0.0, min(1.0, rate)) * 0xFFFFFFFF)
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        conversation_id = getattr(record, "conversation_id", None)
+        if record.levelno >= logging.WARNING or conversation_id is None:
+            return True
+        if zlib.crc32(str(conversation_id).encode("utf-8")) <= self.threshold:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+_STOP = object()
+
+
+class QueuedStreamHandler(logging.Handler):
+    """Hand records to a writer thread that formats and writes them in batches.
+
+    ``emit`` only merges the message arguments and enqueues the record, so
+    the thread logging never waits on JSON encoding or on the stream. The
+    queue holds at most ``max_records``; records arriving while it is full
+    are dropped and counted in ``dropped``, and the writer reports how many
+    it lost in the next batch.
+    """
+
+    def __init__(self, stream: TextIO, max_records: int, batch_size: int = 256) -> None:
+        super().__init__()
+        self.stream = stream
+        self.batch_size = max(1, batch_size)
+        self.dropped = 0
+        self._reported_drops = 0
+        self._queue: queue.Queue = queue.Queue(max(1, max_records))
+        self._thread = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            # Arguments may be mutated after this call returns; freeze them now.
+            record.msg = record.getMessage()
+            record.args = None
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [r for r in batch if r is not _STOP]
+            lines = []
+            dropped = self.dropped - self._reported_drops
+            if dropped:
+                self._reported_drops += dropped
+                lines.append(self._drop_notice(dropped))
+            for record in records:
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    if records:
+                        self.handleError(records[-1])
+            for _ in batch:
+                self._queue.task_done()
+            if len(records) < len(batch):
+                return
+
+    def _drop_notice(self, dropped: int) -> str:
+        record = logging.LogRecord(
+            __name__,
+            logging.WARNING,
+            __file__,
+            0,
+            "Log queue full; dropped %d records",
+            (dropped,),
+            None,
+        )
+        return self.format(record)
+
+    def flush(self) -> None:
+        """Wait until every record queued so far has been written."""
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        super().close()
+
+
+def setup_logging(
+    level: str = "INFO",
+    queue_size: int = 0,
+    batch_size: int = 256,
+    sample_rate: float = 1.0,
+) -> logging.Handler:
+    """Log JSON lines to stdout.
+
+    With ``queue_size`` set, records go through a :class:`QueuedStreamHandler`
+    holding up to that many records; otherwise they are written on the
+    logging thread. ``sample_rate`` below 1 keeps only that share of
+    per-request INFO and DEBUG lines.
+    """
+    if queue_size > 0:
+        handler: logging.Handler = QueuedStreamHandler(sys.stdout, queue_size, batch_size)
+    else:
+        handler = logging.StreamHandler(sys.stdout)
     handler.setFormatter(JSONFormatter())
+    if sample_rate < 1.0:
+        handler.addFilter(RequestSampler(sample_rate))
 
     root = logging.getLogger()
+    for old in root.handlers:
+        if isinstance(old, QueuedStreamHandler):
+            old.close()
     root.handlers.clear()
     root.addHandler(handler)
     root.setLevel(getattr(logging, level.upper(), logging.INFO))
 
     logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
+    return handler
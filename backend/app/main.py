@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import threading
 from contextlib import asynccontextmanager
@@ -8,7 +9,10 @@ from fastapi.responses import JSONResponse
 
 from app.config import settings
 from app.logging_config import setup_logging
+from app.services.conversation_service import conversation_service
+from app.services.model_registry import model_registry
 from app.services.model_service import model_service
+from app.services.summarizer import history_summarizer
 from app.routers import chat
 
 logger = logging.getLogger(__name__)
@@ -17,14 +21,27 @@ logger = logging.getLogger(__name__)
 def _load_model_background() -> None:
     try:
         model_service.load_model()
+        conversation_service.set_token_counter(model_service.count_message_tokens)
         logger.info("Model loaded successfully")
     except Exception:
         logger.error("Failed to load model", exc_info=True)
+        return
+    if model_registry.shed_variant:
+        # Ready before the first overload, not loaded in the middle of one.
+        try:
+            model_registry.load(model_registry.shed_variant)
+        except Exception:
+            logger.error("Failed to load the load-shedding variant", exc_info=True)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    setup_logging(settings.log_level)
+    setup_logging(
+        settings.log_level,
+        queue_size=settings.log_queue_size,
+        batch_size=settings.log_batch_size,
+        sample_rate=settings.log_sample_rate,
+    )
     logger.info(
         "Starting up — loading model %s/%s in background",
         settings.model_repo,
@@ -32,8 +49,10 @@ async def lifespan(app: FastAPI):
     )
     thread = threading.Thread(target=_load_model_background, daemon=True)
     thread.start()
+    summarizer = asyncio.create_task(history_summarizer.run())
     yield
     logger.info("Shutting down")
+    summarizer.cancel()
 
 
 app = FastAPI(
@@ -48,6 +67,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Stream-Id"],
 )
 
 app.include_router(chat.router, prefix="/api")
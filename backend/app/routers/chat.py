@@ -1,36 +1,182 @@
+import asyncio
 import json
 import logging
+import threading
+import time
+from datetime import datetime, timezone
 from typing import AsyncGenerator
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse
 from sse_starlette.sse import EventSourceResponse
+from starlette.background import BackgroundTask
 
 from app.schemas.chat import ChatRequest, HealthResponse
-from app.services.model_service import model_service
-from app.services.conversation_service import conversation_service
+from app.services import metrics
+from app.services.model_registry import model_registry
+from app.services.model_service import GenerationTicket, ModelService, QueueFullError
+from app.services.conversation_service import conversation_service, encode_cursor
+from app.services.profiling import (
+    RequestProfile,
+    StackSampler,
+    current_profile,
+    profile_log,
+)
+from app.services.response_cache import CachedResponse, CacheLookup, response_cache
+from app.services.streaming import SharedStream
+from app.services.summarizer import history_summarizer
 from app.config import settings
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Generations still streaming, by (conversation id, message).
+_inflight: dict[tuple[str, str], SharedStream] = {}
+# Generations by stream id, kept for stream_retention_s after they finish
+# so a dropped client can resume.
+_streams: dict[str, SharedStream] = {}
+
+
+def _record_reply(conversation_id: str, full_response: list[str]) -> None:
+    assistant_text = "".join(full_response)
+    if assistant_text:
+        conversation_service.add_message(conversation_id, "assistant", assistant_text)
+
+
+async def _cache_lookup(
+    conversation_id: str, message: str, variant: str, service: ModelService
+) -> CacheLookup:
+    """Look up the prompt ``message`` would make, before it is stored."""
+    history = [
+        *conversation_service.get_history(conversation_id),
+        {"role": "user", "content": message},
+    ]
+    token_counts = [*conversation_service.get_token_counts(conversation_id), None]
+    lookup = await response_cache.lookup(
+        service.prompt_history(history, token_counts),
+        service.embedder,
+        model=model_registry.model_id(variant),
+    )
+    metrics.response_cache_lookups.labels(lookup.tier or "miss").inc()
+    return lookup
+
+
+def _metadata_event(metadata: dict, profile: RequestProfile | None) -> dict:
+    if profile is not None:
+        metadata = {**metadata, "profile": profile.as_dict()}
+    return {"event": "metadata", "data": json.dumps(metadata)}
+
+
+def _note_first_token(profile: RequestProfile | None) -> None:
+    if profile is not None and "ttft_s" not in profile.values:
+        profile.set("ttft_s", profile.since_start())
+
 
 async def _stream_response(
-    conversation_id: str, message: str
+    conversation_id: str,
+    message: str,
+    service: ModelService,
+    ticket: GenerationTicket | None,
+    profile: RequestProfile | None = None,
+    lookup: CacheLookup | None = None,
 ) -> AsyncGenerator[dict, None]:
-    conversation_service.add_message(conversation_id, "user", message)
-    history = conversation_service.get_history(conversation_id)
+    """Store the user turn, then replay ``lookup``'s hit or generate a reply.
 
+    ``ticket`` is ``None`` exactly when there is a hit to replay.
+    """
+    cancel = threading.Event()
     full_response: list[str] = []
+    reply_handled = False
+    sampler: StackSampler | None = None
+    if profile is not None:
+        # This generator runs in its stream's own task, so the profile is
+        # visible to everything it calls without leaking to other requests.
+        current_profile.set(profile)
+        profile.thread_ids.add(threading.get_ident())
+        if profile_log.take_capture(conversation_id):
+            sampler = StackSampler(
+                profile.thread_ids, settings.profile_sample_interval_ms / 1000
+            ).start()
 
     try:
-        async for chunk in model_service.generate_stream_async(history):
+        conversation_service.add_message(conversation_id, "user", message)
+
+        if ticket is None:
+            # Replay the stored reply exactly as it was streamed.
+            start = time.perf_counter()
+            for chunk in lookup.hit.chunks:
+                _note_first_token(profile)
+                full_response.append(chunk)
+                yield {"event": "token", "data": chunk}
+            metadata = dict(
+                lookup.hit.metadata, elapsed_s=round(time.perf_counter() - start, 2)
+            )
+            yield _metadata_event(metadata, profile)
+            reply_handled = True
+            _record_reply(conversation_id, full_response)
+            yield {"event": "done", "data": ""}
+            return
+
+        async for position in ticket.wait():
+            yield {"event": "queued", "data": json.dumps({"position": position})}
+        metrics.queue_wait_seconds.observe(ticket.started_at - ticket.enqueued_at)
+        if profile is not None:
+            profile.add("queue", ticket.started_at - ticket.enqueued_at)
+
+        history = conversation_service.get_history(conversation_id)
+        token_counts = conversation_service.get_token_counts(conversation_id)
+
+        metadata: dict | None = None
+        async for chunk in service.generate_stream_async(
+            history,
+            conversation_id,
+            token_counts,
+            cancel,
+            flush_interval_s=settings.stream_flush_interval_ms / 1000,
+            flush_max_tokens=settings.stream_flush_max_tokens,
+            ticket=ticket,
+        ):
             if chunk["event"] == "token":
+                if not full_response:
+                    model_registry.record_ttft(time.perf_counter() - ticket.enqueued_at)
+                _note_first_token(profile)
                 full_response.append(chunk["data"])
                 yield {"event": "token", "data": chunk["data"]}
             elif chunk["event"] == "metadata":
-                yield {"event": "metadata", "data": json.dumps(chunk["data"])}
+                metadata = chunk["data"]
+                yield _metadata_event(metadata, profile)
+            elif chunk["event"] == "queued":
+                # Paused to let queued requests run; waiting to resume.
+                yield {"event": "queued", "data": json.dumps(chunk["data"])}
+
+        reply_handled = True
+        _record_reply(conversation_id, full_response)
+        history_summarizer.schedule(conversation_id)
+        if metadata is not None:
+            logger.debug(
+                "Generation finished for conversation %s",
+                conversation_id,
+                extra={
+                    "conversation_id": conversation_id,
+                    "tokens_generated": metadata.get("tokens_generated"),
+                    "elapsed_s": metadata.get("elapsed_s"),
+                },
+            )
+        if (
+            lookup is not None
+            and full_response
+            and metadata is not None
+            and metadata.get("truncated") is None
+        ):
+            response_cache.store(lookup, CachedResponse(list(full_response), metadata))
+
+        yield {"event": "done", "data": ""}
     except Exception:
+        # Anything from storing the turn to the cache lookup and generation
+        # itself ends the stream with an error event.
+        reply_handled = True
+        metrics.errors.inc()
         logger.error(
             "Streaming failed for conversation %s",
             conversation_id,
@@ -38,41 +184,336 @@ async def _stream_response(
             extra={"conversation_id": conversation_id, "input_length": len(message)},
         )
         yield {"event": "error", "data": "Generation failed. Please try again."}
-        return
+    finally:
+        # Reached without a handled reply when the client disconnects: stop
+        # decoding and keep the partial reply the client already displayed.
+        cancel.set()
+        if not reply_handled:
+            _record_reply(conversation_id, full_response)
+        if ticket is not None:
+            ticket.release()
+        if profile is not None:
+            profile.finish()
+            if sampler is not None:
+                profile.stacks = sampler.stop()
+            profile_log.record(profile)
 
-    assistant_text = "".join(full_response)
-    if assistant_text:
-        conversation_service.add_message(conversation_id, "assistant", assistant_text)
 
-    yield {"event": "done", "data": ""}
+def _trusted_key(api_key: str | None) -> str | None:
+    """``api_key`` if it is one of ``PRIORITY_API_KEYS``, else ``None``."""
+    if api_key and api_key in settings.priority_api_keys:
+        return api_key
+    return None
+
+
+def _priority(request: ChatRequest, api_key: str | None) -> str:
+    """The request's scheduling class; only trusted keys may ask for ``high``."""
+    if request.priority == "high" and _trusted_key(api_key) is None:
+        return "normal"
+    return request.priority
+
+
+def _share_key(
+    request: ChatRequest, api_key: str | None, client: str | None = None
+) -> str | None:
+    """What ``SCHEDULER_FAIR_SHARE`` divides generation time between.
+
+    In ``api_key`` mode an unrecognized key is not trusted to name its
+    share, so those requests share by client address instead.
+    """
+    mode = settings.scheduler_fair_share
+    if mode == "api_key":
+        if _trusted_key(api_key) is not None:
+            return f"key:{api_key}"
+        if client:
+            return f"client:{client}"
+    if mode in ("conversation", "api_key"):
+        return f"conversation:{request.conversation_id}"
+    return None
+
+
+def _coalesced(key: tuple[str, str]) -> SharedStream | None:
+    shared = _inflight.get(key)
+    if shared is None or shared.cancelled:
+        return None
+    metrics.requests_coalesced.inc()
+    return shared
+
+
+async def _admission_lookup(
+    request: ChatRequest,
+    variant: str,
+    service: ModelService,
+    profile: RequestProfile | None,
+) -> CacheLookup | None:
+    if not response_cache.enabled:
+        return None
+    start = time.perf_counter()
+    try:
+        return await _cache_lookup(request.conversation_id, request.message, variant, service)
+    except Exception:
+        # The cache only saves work; generate the reply instead.
+        metrics.errors.inc()
+        logger.error(
+            "Response cache lookup failed for conversation %s",
+            request.conversation_id,
+            exc_info=True,
+            extra={"conversation_id": request.conversation_id},
+        )
+        return None
+    finally:
+        if profile is not None:
+            profile.add("cache_lookup", time.perf_counter() - start)
+
+
+def _submit(request: ChatRequest, api_key: str | None, client: str | None) -> GenerationTicket:
+    try:
+        return model_registry.scheduler.submit(
+            _priority(request, api_key), _share_key(request, api_key, client)
+        )
+    except QueueFullError:
+        metrics.requests_rejected.labels("queue_full").inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests in progress. Please retry shortly.",
+            headers={"Retry-After": "1"},
+        )
+
+
+async def _generation_for(
+    request: ChatRequest, api_key: str | None = None, client: str | None = None
+) -> SharedStream:
+    """The running generation for this exact message, or a newly started one.
+
+    Retries and duplicate tabs that send the same message to the same
+    conversation while its reply is still streaming share that reply
+    instead of taking another generation slot and writing the user turn
+    to the history again. The response cache is checked before admission,
+    so a cached reply is replayed even while the queue is full.
+    """
+    key = (request.conversation_id, request.message)
+    shared = _coalesced(key)
+    if shared is not None:
+        return shared
+
+    profile = RequestProfile(request.conversation_id) if settings.profile_requests else None
+    # Chosen once: the reply is looked up for and generated by this model
+    # even if another variant is activated or load shedding kicks in
+    # meanwhile, and the variant is not unloaded until the stream is done.
+    variant, service = model_registry.acquire()
+    try:
+        lookup = await _admission_lookup(request, variant, service, profile)
+        # The same message may have started generating during the lookup.
+        shared = _coalesced(key)
+        if shared is not None:
+            model_registry.release(variant)
+            return shared
+        ticket: GenerationTicket | None = None
+        if lookup is None or lookup.hit is None:
+            ticket = _submit(request, api_key, client)
+    except BaseException:
+        model_registry.release(variant)
+        raise
+
+    shared = SharedStream(
+        _stream_response(
+            request.conversation_id, request.message, service, ticket, profile, lookup
+        ),
+        idle_grace_s=settings.stream_resume_grace_s,
+        max_events=settings.stream_replay_max_events,
+        on_write=(lambda s: profile.add("sse_write", s)) if profile else None,
+    )
+    _inflight[key] = shared
+    _streams[shared.stream_id] = shared
+
+    def forget() -> None:
+        # Release the ticket even if the stream was cancelled before it started.
+        if ticket is not None:
+            ticket.release()
+        model_registry.release(variant)
+        if _inflight.get(key) is shared:
+            del _inflight[key]
+        asyncio.get_running_loop().call_later(
+            settings.stream_retention_s, _streams.pop, shared.stream_id, None
+        )
+
+    shared.add_done_callback(forget)
+    return shared
 
 
 @router.post("/chat")
-async def chat(request: ChatRequest):
-    if not model_service.is_loaded:
+async def chat(
+    request: ChatRequest, http_request: Request, x_api_key: str | None = Header(None)
+):
+    if not model_registry.is_loaded:
+        metrics.requests_rejected.labels("loading").inc()
         raise HTTPException(status_code=503, detail="Model is still loading")
 
+    client = http_request.client.host if http_request.client else None
+    shared = await _generation_for(request, x_api_key, client)
+    # Covers a client that disconnects before the stream ever starts.
     return EventSourceResponse(
-        _stream_response(request.conversation_id, request.message)
+        shared.subscribe(),
+        headers={"X-Stream-Id": shared.stream_id},
+        background=BackgroundTask(shared.release_if_idle),
+    )
+
+
+@router.get("/chat/streams/{stream_id}")
+async def resume_stream(
+    stream_id: str,
+    last_event_id: str | None = Header(None),
+):
+    """Reconnect to a generation: replay events after ``Last-Event-ID``, then follow live."""
+    shared = _streams.get(stream_id)
+    if shared is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    try:
+        after = int(last_event_id) if last_event_id is not None else -1
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    if not shared.can_resume_after(after):
+        raise HTTPException(
+            status_code=410, detail="Events after Last-Event-ID are no longer buffered"
+        )
+    metrics.streams_resumed.inc()
+    return EventSourceResponse(
+        shared.subscribe(after),
+        headers={"X-Stream-Id": shared.stream_id},
+        background=BackgroundTask(shared.release_if_idle),
     )
 
 
 @router.get("/conversations")
-async def list_conversations():
-    return conversation_service.list_conversations()
+async def list_conversations(
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    before: str | None = None,
+):
+    try:
+        page = conversation_service.list_conversations(limit=limit, before=before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(page[-1])
+    return page
+
+
+@router.get("/conversations/search")
+async def search_conversations(
+    q: str = Query(..., min_length=1, max_length=500),
+    limit: int = Query(20, ge=1, le=100),
+):
+    return conversation_service.search(q, limit=limit)
 
 
 @router.delete("/conversations/{conversation_id}")
 async def delete_conversation(conversation_id: str):
     if not conversation_service.delete_conversation(conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found")
+    model_registry.forget_conversation(conversation_id)
     return {"detail": "Conversation deleted"}
 
 
 @router.get("/health", response_model=HealthResponse)
 async def health():
+    service = model_registry.serving()
+    variant = model_registry.serving_name
     return HealthResponse(
-        status="ok" if model_service.is_loaded else "loading",
-        model_id=f"{settings.model_repo}/{settings.model_filename}",
-        model_loaded=model_service.is_loaded,
+        status="ok" if service.is_loaded else "loading",
+        model_id=model_registry.model_id(variant),
+        model_loaded=service.is_loaded,
+        model_variant=variant,
+        variants=model_registry.stats()["variants"] if model_registry.files else None,
+        kv_cache=service.kv_cache.stats(),
+        replicas=service.replica_stats(),
+        batching=service.batch_engine.stats() if service.batch_engine else None,
+        response_cache=response_cache.stats() if response_cache.enabled else None,
+        startup={k: round(v, 3) for k, v in service.startup_phases.items()} or None,
+    )
+
+
+@router.get("/models")
+async def list_models():
+    return model_registry.stats()
+
+
+def _require_admin(api_key: str | None) -> None:
+    if not api_key or api_key not in settings.admin_api_keys:
+        raise HTTPException(status_code=403, detail="An admin API key is required")
+
+
+def _require_variant(name: str) -> None:
+    if name not in model_registry.names:
+        raise HTTPException(status_code=404, detail="Unknown model variant")
+
+
+@router.post("/models/{name}/activate")
+async def activate_model(
+    name: str, response: Response, x_api_key: str | None = Header(None)
+):
+    """Send new requests to ``name``, loading it in the background first if needed."""
+    _require_admin(x_api_key)
+    _require_variant(name)
+    if model_registry.state(name) == "loaded":
+        model_registry.activate(name)
+        return {"detail": f"New requests now go to {name}"}
+    if name not in model_registry.files:
+        raise HTTPException(status_code=503, detail="Model is still loading")
+    model_registry.load_in_background(name, activate=True)
+    response.status_code = 202
+    return {"detail": f"Loading {name}; new requests switch to it once it is ready"}
+
+
+@router.post("/models/{name}/unload")
+async def unload_model(name: str, x_api_key: str | None = Header(None)):
+    _require_admin(x_api_key)
+    _require_variant(name)
+    try:
+        model_registry.unload(name)
+    except KeyError:
+        raise HTTPException(status_code=409, detail="Model variant is not loaded")
+    except ValueError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return {"detail": f"Unloaded {name}"}
+
+
+def _require_profiling() -> None:
+    if not settings.profile_requests:
+        raise HTTPException(status_code=404, detail="Request profiling is disabled")
+
+
+def _profile_summary(profile: RequestProfile) -> dict:
+    return {
+        "conversation_id": profile.conversation_id,
+        "started_at": datetime.fromtimestamp(profile.started_at, timezone.utc).isoformat(),
+        **profile.as_dict(),
+    }
+
+
+@router.get("/debug/profile")
+async def debug_profile(limit: int = Query(20, ge=1, le=200)):
+    """The slowest recent requests' timing breakdowns, and finished stack captures."""
+    _require_profiling()
+    return {
+        "slowest": [_profile_summary(p) for p in profile_log.slowest(limit)],
+        "captures": [
+            {**_profile_summary(p), "stacks": p.stacks} for p in profile_log.captures()
+        ],
+    }
+
+
+@router.post("/debug/profile/capture")
+async def arm_profile_capture(conversation_id: str = Query(..., min_length=1)):
+    """Sample stacks during the next request in ``conversation_id``."""
+    _require_profiling()
+    profile_log.arm_capture(conversation_id)
+    return {"detail": "Capture armed for the next request in this conversation"}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(
+        metrics.registry.expose(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
     )
@@ -1,16 +1,21 @@
 from pydantic import BaseModel, Field
+from typing import Literal
 from datetime import datetime
 
 
 class ChatRequest(BaseModel):
     conversation_id: str = Field(..., min_length=1, description="Unique conversation identifier")
     message: str = Field(..., min_length=1, max_length=2000, description="User message content")
+    priority: Literal["high", "normal", "low"] = Field(
+        "normal", description="Scheduling class when requests queue for the model"
+    )
 
 
 class ChatMessage(BaseModel):
     role: str = Field(..., pattern="^(user|assistant|system)$")
     content: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now())
+    token_count: int | None = None
 
 
 class ConversationSummary(BaseModel):
@@ -21,7 +26,32 @@ class ConversationSummary(BaseModel):
     message_count: int
 
 
+class SearchHit(BaseModel):
+    conversation_id: str
+    title: str
+    message_index: int
+    role: str
+    snippet: str
+    score: float
+    timestamp: datetime
+
+
+class ReplicaHealth(BaseModel):
+    index: int
+    loaded: bool
+    active: int
+    generations: int
+    cores: list[int]
+
+
 class HealthResponse(BaseModel):
     status: str
     model_id: str
     model_loaded: bool
+    model_variant: str | None = None
+    variants: dict[str, dict[str, str | int]] | None = None
+    kv_cache: dict[str, int] | None = None
+    replicas: list[ReplicaHealth] | None = None
+    batching: dict[str, int] | None = None
+    response_cache: dict[str, int] | None = None
+    startup: dict[str, float] | None = None
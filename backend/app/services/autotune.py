@@ -0,0 +1,225 @@
+"""Measure the fastest llama.cpp thread counts and batch size on this host.
+
+    python -m app.services.autotune --model path/to/model.gguf
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+
+import llama_cpp
+from llama_cpp import Llama
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZES = (128, 256, 512)
+
+
+@dataclass
+class TuneResult:
+    n_threads: int
+    n_threads_batch: int
+    n_batch: int
+    decode_tokens_per_s: float
+    prefill_tokens_per_s: float
+
+
+def cpu_signature() -> str:
+    """CPU model, architecture and usable core count, e.g. for a cache key."""
+    model = platform.processor() or platform.machine()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return f"{model}|{platform.machine()}|{_usable_cores()}"
+
+
+def model_signature(model_path: str) -> str:
+    return f"{os.path.basename(model_path)}|{os.path.getsize(model_path)}"
+
+
+def _usable_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def thread_budget() -> int:
+    """Threads each model context may use under ``NUM_THREADS`` and ``MODEL_REPLICAS``.
+
+    Boot tunes for this budget, and the CLI defaults to it, so an offline
+    tuning run writes the cache entry the next boot reads.
+    """
+    batching = settings.batch_max_sequences > 0
+    n_replicas = 1 if batching else max(1, settings.model_replicas)
+    num_threads = settings.num_threads
+    if num_threads <= 0:
+        num_threads = max(1, os.cpu_count() // 2)
+    return max(1, num_threads // n_replicas)
+
+
+def thread_grid(max_threads: int) -> list[int]:
+    """Powers of two up to ``max_threads``, plus ``max_threads`` itself and its neighbour."""
+    grid = {max_threads, max(1, max_threads - 1)}
+    n = 1
+    while n < max_threads:
+        grid.add(n)
+        n *= 2
+    return sorted(grid)
+
+
+def _best_rate(measure, repeats: int) -> float:
+    return max(measure() for _ in range(repeats))
+
+
+def _prefill_rate(llama: Llama, prompt: list[int]) -> float:
+    llama.reset()
+    start = time.perf_counter()
+    llama.eval(prompt)
+    return len(prompt) / (time.perf_counter() - start)
+
+
+def _decode_rate(llama: Llama, prompt: list[int], n_tokens: int) -> float:
+    llama.reset()
+    llama.eval(prompt[:8])
+    token = prompt[-1]
+    start = time.perf_counter()
+    for _ in range(n_tokens):
+        llama.eval([token])
+    return n_tokens / (time.perf_counter() - start)
+
+
+def autotune(
+    model_path: str,
+    max_threads: int,
+    batch_sizes: tuple[int, ...] = DEFAULT_BATCH_SIZES,
+    prompt_tokens: int = 256,
+    decode_tokens: int = 16,
+    repeats: int = 2,
+) -> TuneResult:
+    """Measure every grid point on ``model_path`` and return the fastest settings.
+
+    Decode is memory-bandwidth bound and often peaks below the core count,
+    while prefill is compute bound, so decode is timed over ``n_threads``
+    and prefill over ``n_threads_batch`` x ``n_batch``.
+    """
+    threads = thread_grid(max(1, max_threads))
+    n_ctx = prompt_tokens + decode_tokens + 16
+    best_decode = (0.0, threads[-1])
+    best_prefill = (0.0, threads[-1], batch_sizes[0])
+    for n_batch in batch_sizes:
+        llama = Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_batch=n_batch,
+            n_threads=threads[-1],
+            n_threads_batch=threads[-1],
+            verbose=False,
+        )
+        text = b"The quick brown fox jumps over the lazy dog. " * prompt_tokens
+        prompt = llama.tokenize(text)[:prompt_tokens]
+        _prefill_rate(llama, prompt)  # fault the weights in before timing
+        for n in threads:
+            llama_cpp.llama_set_n_threads(llama.ctx, n, n)
+            rate = _best_rate(lambda: _prefill_rate(llama, prompt), repeats)
+            logger.info("autotune prefill n_batch=%d threads=%d: %.1f tok/s", n_batch, n, rate)
+            if rate > best_prefill[0]:
+                best_prefill = (rate, n, n_batch)
+            # Decode does not depend on n_batch; measure it once.
+            if n_batch == batch_sizes[0]:
+                rate = _best_rate(lambda: _decode_rate(llama, prompt, decode_tokens), repeats)
+                logger.info("autotune decode threads=%d: %.1f tok/s", n, rate)
+                if rate > best_decode[0]:
+                    best_decode = (rate, n)
+        llama.close()
+    return TuneResult(
+        n_threads=best_decode[1],
+        n_threads_batch=best_prefill[1],
+        n_batch=best_prefill[2],
+        decode_tokens_per_s=round(best_decode[0], 1),
+        prefill_tokens_per_s=round(best_prefill[0], 1),
+    )
+
+
+def _cache_key(model_path: str, max_threads: int) -> str:
+    return f"{cpu_signature()}|{model_signature(model_path)}|{max_threads}"
+
+
+def _read_cache(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_result(path: str, model_path: str, max_threads: int, result: TuneResult) -> None:
+    cache = _read_cache(path)
+    cache[_cache_key(model_path, max_threads)] = {
+        **asdict(result),
+        "tuned_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def load_result(path: str, model_path: str, max_threads: int) -> TuneResult | None:
+    entry = _read_cache(path).get(_cache_key(model_path, max_threads))
+    if entry is None:
+        return None
+    fields = TuneResult.__dataclass_fields__
+    return TuneResult(**{k: v for k, v in entry.items() if k in fields})
+
+
+def load_or_tune(cache_path: str, model_path: str, max_threads: int) -> TuneResult:
+    """Reuse the stored result for this host and model, or tune and store one."""
+    result = load_result(cache_path, model_path, max_threads)
+    if result is not None:
+        logger.info("Using stored autotune result: %s", result)
+        return result
+    logger.info("Autotuning threads and batch size for up to %d threads", max_threads)
+    result = autotune(model_path, max_threads)
+    save_result(cache_path, model_path, max_threads, result)
+    logger.info("Autotune result: %s", result)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", required=True, help="GGUF file to tune for")
+    parser.add_argument("--max-threads", type=int, default=thread_budget())
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=list(DEFAULT_BATCH_SIZES)
+    )
+    parser.add_argument("--prompt-tokens", type=int, default=256)
+    parser.add_argument("--decode-tokens", type=int, default=16)
+    parser.add_argument("--cache", default=settings.autotune_cache_path)
+    parser.add_argument(
+        "--no-save", action="store_true", help="Print the result without storing it"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    tuned = autotune(
+        args.model,
+        args.max_threads,
+        tuple(args.batch_sizes),
+        args.prompt_tokens,
+        args.decode_tokens,
+    )
+    if not args.no_save:
+        save_result(args.cache, args.model, args.max_threads, tuned)
+    print(json.dumps({"key": _cache_key(args.model, args.max_threads), **asdict(tuned)}, indent=2))
@@ -0,0 +1,379 @@
+import codecs
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+
+from app.services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Sequence 0 holds the shared system prompt; requests use 1..max_sequences.
+_PREFIX_SEQ = 0
+
+
+@dataclass
+class SamplingParams:
+    temperature: float
+    top_p: float
+    repeat_penalty: float
+    top_k: int = 40
+    min_p: float = 0.05
+    penalty_last_n: int = 64
+
+
+@dataclass
+class BatchRequest:
+    """One chat generation queued for, or running in, a :class:`BatchEngine`.
+
+    ``emit`` receives the same events as ``ModelService._decode`` produces:
+    ``("token", text)`` per decoded piece, then ``("done", reason)`` or
+    ``("error", exc)``.
+    """
+
+    tokens: list[int]
+    max_tokens: int
+    emit: Callable[[str, object], None]
+    cancel: threading.Event
+    deadline: float
+    stop: list[str] = field(default_factory=list)
+
+    seq_id: int = -1
+    n_past: int = 0
+    output_tokens: list[int] = field(default_factory=list)
+    next_token: int | None = None
+    reserved: int = 0
+    started_at: float = 0.0
+    first_token_at: float | None = None
+    _sampler: object = None
+    _decoder: codecs.IncrementalDecoder = field(
+        default_factory=lambda: codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    )
+    _held: str = ""
+
+    @property
+    def n_generated(self) -> int:
+        return len(self.output_tokens)
+
+    @property
+    def prefilling(self) -> bool:
+        return self.n_past < len(self.tokens)
+
+
+class BatchEngine:
+    """Continuous batching of chat sequences in one llama.cpp context.
+
+    A single thread runs decode steps. Each step packs one token for every
+    sequence that is generating plus as much pending prompt as fits in
+    ``n_batch``, so new requests join the running batch at the next token
+    boundary instead of waiting for the others to finish. Every sequence
+    samples from its own logits and streams through its own ``emit``.
+
+    The context's ``n_ctx`` cells are shared by all sequences; a request is
+    admitted once its prompt plus ``max_tokens`` fits in what is left. The
+    rendered system turn is prefilled once into sequence 0 and copied into
+    each new sequence whose prompt starts with it.
+    """
+
+    def __init__(
+        self,
+        model: Llama,
+        max_sequences: int,
+        n_ctx: int,
+        sampling: SamplingParams,
+        n_batch: int = 512,
+        n_threads: int | None = None,
+        n_threads_batch: int | None = None,
+    ) -> None:
+        self.model = model
+        self.max_sequences = max(1, max_sequences)
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.sampling = sampling
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = self.max_sequences + 1
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads_batch or n_threads
+        self._context = internals.LlamaContext(
+            model=model._model, params=params, verbose=False
+        )
+        self._ctx = self._context.ctx
+        self._vocab = llama_cpp.llama_model_get_vocab(model.model)
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self._prefix: list[int] = []
+        self._pending: deque[BatchRequest] = deque()
+        self._running: list[BatchRequest] = []
+        self._free_seqs = list(range(self.max_sequences, 0, -1))
+        self._reserved = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread: threading.Thread | None = None
+
+        self.steps = 0
+        self.tokens_decoded = 0
+
+    # -- public API -------------------------------------------------------
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="batch-decode", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        llama_cpp.llama_batch_free(self._batch)
+        self._context.close()
+
+    def set_prefix(self, tokens: list[int]) -> None:
+        """Prefill ``tokens`` once so prompts starting with them skip that work.
+
+        Call before :meth:`start`.
+        """
+        self._prefix = []
+        llama_cpp.llama_kv_cache_seq_rm(self._ctx, _PREFIX_SEQ, -1, -1)
+        for begin in range(0, len(tokens), self.n_batch):
+            chunk = tokens[begin:begin + self.n_batch]
+            self._batch.n_tokens = 0
+            for offset, token in enumerate(chunk):
+                self._add(token, begin + offset, _PREFIX_SEQ, logits=False)
+            if llama_cpp.llama_decode(self._ctx, self._batch) != 0:
+                raise RuntimeError("Failed to prefill shared prefix")
+        self._prefix = list(tokens)
+
+    def submit(self, request: BatchRequest) -> None:
+        if self._cells_needed(request) > self._kv_budget:
+            raise ValueError(
+                f"Prompt of {len(request.tokens)} tokens plus {request.max_tokens} "
+                f"new tokens exceeds the batch context of {self.n_ctx}"
+            )
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify()
+
+    @property
+    def thread_id(self) -> int | None:
+        return self._thread.ident if self._thread is not None else None
+
+    def shared_prefix_len(self, tokens: list[int]) -> int:
+        """Leading tokens of ``tokens`` served from the shared prefix instead of prefilled."""
+        n_prefix = len(self._prefix)
+        if n_prefix and tokens[:n_prefix] == self._prefix and len(tokens) > n_prefix:
+            return n_prefix
+        return 0
+
+    @property
+    def _kv_budget(self) -> int:
+        """KV cells left for requests once the resident shared prefix is held."""
+        return self.n_ctx - len(self._prefix)
+
+    def _cells_needed(self, request: BatchRequest) -> int:
+        # Prefix cells copied into a sequence are shared with the prefix
+        # sequence, so only the rest of the prompt takes new cells.
+        n_prefix = self.shared_prefix_len(request.tokens)
+        return len(request.tokens) - n_prefix + request.max_tokens
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "running": len(self._running),
+            "pending": len(self._pending),
+            "steps": self.steps,
+            "tokens_decoded": self.tokens_decoded,
+        }
+
+    # -- decode loop ------------------------------------------------------
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed and not self._pending and not self._running:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                self._admit()
+            try:
+                self._step()
+            except Exception as exc:  # pragma: no cover - llama.cpp failure
+                logger.error("Batch decode step failed", exc_info=True)
+                for request in list(self._running):
+                    self._finish(request, error=exc)
+        for request in list(self._running) + list(self._pending):
+            self._finish(request, error=RuntimeError("Batch engine closed"))
+
+    def _admit(self) -> None:
+        """Move pending requests into free sequences while the KV budget allows."""
+        while self._pending and self._free_seqs:
+            request = self._pending[0]
+            needed = self._cells_needed(request)
+            if self._reserved + needed > self._kv_budget and self._running:
+                return
+            self._pending.popleft()
+            request.seq_id = self._free_seqs.pop()
+            request.reserved = needed
+            request.started_at = time.perf_counter()
+            request._sampler = self._new_sampler()
+            self._reserved += needed
+            n_prefix = self.shared_prefix_len(request.tokens)
+            if n_prefix:
+                llama_cpp.llama_kv_cache_seq_cp(
+                    self._ctx, _PREFIX_SEQ, request.seq_id, 0, n_prefix
+                )
+                request.n_past = n_prefix
+            self._running.append(request)
+
+    def _step(self) -> None:
+        for request in list(self._running):
+            if request.cancel.is_set():
+                self._finish(request, reason="cancelled")
+            elif time.monotonic() >= request.deadline:
+                self._finish(request, reason="deadline")
+        if not self._running:
+            return
+
+        self._batch.n_tokens = 0
+        sampled: list[tuple[BatchRequest, int]] = []
+        # Generating sequences first, so a long prompt never stalls them.
+        for request in self._running:
+            if not request.prefilling:
+                sampled.append((request, self._batch.n_tokens))
+                self._add(request.next_token, request.n_past, request.seq_id, logits=True)
+                request.n_past += 1
+        for request in self._running:
+            room = self.n_batch - self._batch.n_tokens
+            if not request.prefilling or room <= 0:
+                continue
+            chunk = request.tokens[request.n_past:request.n_past + room]
+            for token in chunk:
+                request.n_past += 1
+                last = not request.prefilling
+                if last:
+                    sampled.append((request, self._batch.n_tokens))
+                self._add(token, request.n_past - 1, request.seq_id, logits=last)
+
+        if llama_cpp.llama_decode(self._ctx, self._batch) != 0:
+            raise RuntimeError("llama_decode failed (KV cache full?)")
+        self.steps += 1
+        self.tokens_decoded += len(sampled)
+
+        for request, index in sampled:
+            token = llama_cpp.llama_sampler_sample(request._sampler, self._ctx, index)
+            self._accept(request, token)
+
+    def _accept(self, request: BatchRequest, token: int) -> None:
+        if request.first_token_at is None:
+            request.first_token_at = time.perf_counter()
+        if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+            self._finish(request)
+            return
+        request.output_tokens.append(token)
+        request.next_token = token
+        piece = self.model.detokenize([token])
+        text = request._held + request._decoder.decode(piece)
+        text, stopped, request._held = _split_on_stop(text, request.stop)
+        if text:
+            request.emit("token", text)
+        if stopped:
+            request._held = ""
+            self._finish(request)
+        elif request.n_generated >= request.max_tokens:
+            self._finish(request)
+
+    def _finish(
+        self,
+        request: BatchRequest,
+        reason: str | None = None,
+        error: BaseException | None = None,
+    ) -> None:
+        if request in self._running:
+            self._running.remove(request)
+            llama_cpp.llama_kv_cache_seq_rm(self._ctx, request.seq_id, -1, -1)
+            llama_cpp.llama_sampler_free(request._sampler)
+            self._free_seqs.append(request.seq_id)
+            self._reserved -= request.reserved
+            self._record_timing(request)
+        elif request in self._pending:
+            self._pending.remove(request)
+        if error is not None:
+            request.emit("error", error)
+            return
+        tail = request._held + request._decoder.decode(b"", final=True)
+        if tail:
+            request.emit("token", tail)
+        request.emit("done", reason)
+
+    @staticmethod
+    def _record_timing(request: BatchRequest) -> None:
+        if request.first_token_at is None:
+            return
+        decode_s = time.perf_counter() - request.first_token_at
+        metrics.prefill_seconds.observe(request.first_token_at - request.started_at)
+        metrics.decode_seconds.observe(decode_s)
+        if request.n_generated > 1 and decode_s > 0:
+            metrics.tokens_per_second.observe((request.n_generated - 1) / decode_s)
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool) -> None:
+        i = self._batch.n_tokens
+        self._batch.token[i] = token
+        self._batch.pos[i] = pos
+        self._batch.n_seq_id[i] = 1
+        self._batch.seq_id[i][0] = seq_id
+        self._batch.logits[i] = logits
+        self._batch.n_tokens = i + 1
+
+    def _new_sampler(self):
+        """The same sampler chain ``Llama.create_completion`` builds."""
+        s = self.sampling
+        chain = llama_cpp.llama_sampler_chain_init(
+            llama_cpp.llama_sampler_chain_default_params()
+        )
+
+        def add(sampler) -> None:
+            llama_cpp.llama_sampler_chain_add(chain, sampler)
+
+        add(llama_cpp.llama_sampler_init_penalties(s.penalty_last_n, s.repeat_penalty, 0.0, 0.0))
+        if s.temperature == 0:
+            add(llama_cpp.llama_sampler_init_greedy())
+        else:
+            add(llama_cpp.llama_sampler_init_top_k(s.top_k))
+            add(llama_cpp.llama_sampler_init_typical(1.0, 1))
+            add(llama_cpp.llama_sampler_init_top_p(s.top_p, 1))
+            add(llama_cpp.llama_sampler_init_min_p(s.min_p, 1))
+            add(llama_cpp.llama_sampler_init_temp(s.temperature))
+            add(llama_cpp.llama_sampler_init_dist(random.getrandbits(32)))
+        return chain
+
+
+def _split_on_stop(text: str, stops: list[str]) -> tuple[str, bool, str]:
+    """Split streamed ``text`` into (emit now, hit a stop string, hold back).
+
+    Text that could be the start of a stop string is held back until the
+    next piece shows whether it is one.
+    """
+    for stop in stops:
+        index = text.find(stop)
+        if index != -1:
+            return text[:index], True, ""
+    held = 0
+    for stop in stops:
+        for length in range(min(len(stop) - 1, len(text)), 0, -1):
+            if text.endswith(stop[:length]):
+                held = max(held, length)
+                break
+    if held:
+        return text[:-held], False, text[-held:]
+    return text, False, ""
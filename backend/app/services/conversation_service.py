@@ -1,8 +1,21 @@
+import base64
+import binascii
 import logging
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime
-from dataclasses import dataclass, field
+from typing import Callable
 
+from app.config import settings
 from app.schemas.chat import ChatMessage
+from app.services.conversation_store import (
+    Conversation,
+    ConversationStore,
+    InMemoryConversationStore,
+    MessageLog,
+    create_conversation_store,
+)
+from app.services.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -13,74 +26,292 @@ SYSTEM_PROMPT = (
     "Keep responses concise unless the user asks for detail."
 )
 
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+TokenCounter = Callable[[str], int]
+
 
 @dataclass
-class Conversation:
-    id: str
-    title: str
-    messages: list[ChatMessage] = field(default_factory=list)
-    created_at: datetime = field(default_factory=datetime.now)
-    updated_at: datetime = field(default_factory=datetime.now)
+class SummaryJob:
+    """Messages ``[start, end)`` to fold into a conversation's rolling summary."""
+
+    conversation_id: str
+    start: int
+    end: int
+    previous_summary: str
+    messages: list[dict[str, str]]
+
+
+class _HistoryView:
+    """``{"role", "content"}`` dicts for ``log[start:]``, extended as it grows.
+
+    Tied to one :class:`MessageLog` object: if the store hands back a
+    different one (reloaded from disk), the view is rebuilt.
+    """
+
+    __slots__ = ("log", "start", "dicts")
+
+    def __init__(self, log: MessageLog, start: int) -> None:
+        self.log = log
+        self.start = start
+        self.dicts: list[dict[str, str]] = []
+
+    def messages(self, start: int) -> list[dict[str, str]]:
+        if start > self.start:
+            # The summary moved on; drop the turns it now covers.
+            del self.dicts[:start - self.start]
+            self.start = start
+        log = self.log
+        for index in range(self.start + len(self.dicts), len(log)):
+            self.dicts.append({"role": log.role(index), "content": log.content(index)})
+        return self.dicts
+
+
+def encode_cursor(summary: dict) -> str:
+    """Opaque cursor pointing just past ``summary`` in the listing order."""
+    raw = f"{summary['updated_at']} {summary['id']}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    """Inverse of :func:`encode_cursor`. Raises ``ValueError`` if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        updated_at, conversation_id = raw.split(" ", 1)
+        return datetime.fromisoformat(updated_at), conversation_id
+    except (binascii.Error, UnicodeError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from exc
 
 
 class ConversationService:
-    def __init__(self) -> None:
-        self._store: dict[str, Conversation] = {}
+    def __init__(
+        self,
+        store: ConversationStore | None = None,
+        token_counter: TokenCounter | None = None,
+        summary_trigger_tokens: int = 0,
+        view_cache_size: int = 1000,
+    ) -> None:
+        self._store = store or InMemoryConversationStore()
+        self._token_counter = token_counter
+        self._system_token_count: int | None = None
+        self.summary_trigger_tokens = summary_trigger_tokens
+        # History views of recently used conversations, least recent first.
+        self.view_cache_size = max(1, view_cache_size)
+        self._views: OrderedDict[str, _HistoryView] = OrderedDict()
+
+    def set_token_counter(self, token_counter: TokenCounter | None) -> None:
+        """Count tokens with the loaded model's tokenizer from now on."""
+        self._token_counter = token_counter
+        self._system_token_count = None
+
+    def _count_tokens(self, content: str) -> int | None:
+        if self._token_counter is None:
+            return None
+        return self._token_counter(content)
 
     def get_or_create(self, conversation_id: str) -> Conversation:
-        if conversation_id not in self._store:
-            self._store[conversation_id] = Conversation(
-                id=conversation_id,
-                title="New conversation",
+        convo = self._store.get(conversation_id)
+        if convo is None:
+            convo = Conversation(id=conversation_id, title="New conversation")
+            self._store.create(convo)
+            logger.info(
+                "Created conversation %s",
+                conversation_id,
+                extra={"conversation_id": conversation_id},
             )
-            logger.info("Created conversation %s", conversation_id)
-        return self._store[conversation_id]
+        return convo
 
     def add_message(
         self, conversation_id: str, role: str, content: str
     ) -> ChatMessage:
+        with profiled("store_message"):
+            return self._add_message(conversation_id, role, content)
+
+    def _add_message(self, conversation_id: str, role: str, content: str) -> ChatMessage:
         convo = self.get_or_create(conversation_id)
-        message = ChatMessage(role=role, content=content)
-        convo.messages.append(message)
+        token_count = self._count_tokens(content)
         convo.updated_at = datetime.now()
+        convo.messages.append(role, content, convo.updated_at.timestamp(), token_count)
 
         if role == "user" and len(convo.messages) == 1:
             convo.title = content[:50].strip() + ("..." if len(content) > 50 else "")
 
-        return message
+        self._store.append_message(convo)
+        return ChatMessage(
+            role=role,
+            content=content,
+            timestamp=convo.updated_at,
+            token_count=token_count,
+        )
 
     def get_history(self, conversation_id: str) -> list[dict[str, str]]:
+        """System prompt, rolling summary if any, then the unsummarized messages.
+
+        The message dicts are built once per message and shared between
+        calls, so callers must not modify them.
+        """
+        with profiled("history"):
+            return self._history(conversation_id)
+
+    def _history(self, conversation_id: str) -> list[dict[str, str]]:
         system_msg = {"role": "system", "content": SYSTEM_PROMPT}
-        if conversation_id not in self._store:
+        convo = self._store.get(conversation_id)
+        if convo is None:
             return [system_msg]
-        user_assistant_msgs = [
-            {"role": m.role, "content": m.content}
-            for m in self._store[conversation_id].messages
-        ]
-        return [system_msg] + user_assistant_msgs
+        history = [system_msg]
+        if convo.summary:
+            history.append({"role": "system", "content": SUMMARY_PREFIX + convo.summary})
+        history.extend(self._view(convo).messages(convo.summarized_count))
+        return history
+
+    def _view(self, convo: Conversation) -> _HistoryView:
+        view = self._views.get(convo.id)
+        stale = view is None or view.log is not convo.messages
+        if stale or view.start > convo.summarized_count:
+            view = _HistoryView(convo.messages, convo.summarized_count)
+            self._views[convo.id] = view
+        self._views.move_to_end(convo.id)
+        while len(self._views) > self.view_cache_size:
+            self._views.popitem(last=False)
+        return view
+
+    def get_token_counts(self, conversation_id: str) -> list[int | None]:
+        """Token counts lined up with :meth:`get_history`.
+
+        Counts are cached on each message, so only messages stored before a
+        tokenizer was available are counted here, and only once.
+        """
+        with profiled("token_counts"):
+            return self._token_counts(conversation_id)
+
+    def _token_counts(self, conversation_id: str) -> list[int | None]:
+        if self._system_token_count is None:
+            self._system_token_count = self._count_tokens(SYSTEM_PROMPT)
+        counts = [self._system_token_count]
+        convo = self._store.get(conversation_id)
+        if convo is None:
+            return counts
+        if convo.summary:
+            if convo.summary_token_count is None:
+                convo.summary_token_count = self._count_tokens(
+                    SUMMARY_PREFIX + convo.summary
+                )
+            counts.append(convo.summary_token_count)
+        messages = convo.messages
+        for index in range(convo.summarized_count, len(messages)):
+            count = messages.token_count(index)
+            if count is None:
+                count = self._count_tokens(messages.content(index))
+                if count is not None:
+                    messages.set_token_count(index, count)
+            counts.append(count)
+        return counts
+
+    def pending_summary(self, conversation_id: str) -> SummaryJob | None:
+        """The oldest unsummarized turns, once they push the history over budget.
+
+        Nothing is due until the unsummarized messages exceed
+        ``summary_trigger_tokens``. Then every message is folded in except
+        the newest ones fitting in half that budget, and the cut is moved
+        back to a user message so the kept history starts on a whole turn.
+        The latest exchange is always kept verbatim.
+        """
+        if self.summary_trigger_tokens <= 0 or self._token_counter is None:
+            return None
+        convo = self._store.get(conversation_id)
+        if convo is None:
+            return None
+        counts = self.get_token_counts(conversation_id)[1 + bool(convo.summary):]
+        if sum(counts) <= self.summary_trigger_tokens:
+            return None
+        messages = convo.messages
+        start = convo.summarized_count
+        keep_budget = self.summary_trigger_tokens // 2
+        end, kept = len(messages), 0
+        while end > start and kept + counts[end - 1 - start] <= keep_budget:
+            end -= 1
+            kept += counts[end - start]
+        users = [i for i in range(start, len(messages)) if messages.role(i) == "user"]
+        if not users:
+            return None
+        end = min(end, users[-1])
+        while end > start and messages.role(end) != "user":
+            end -= 1
+        if end <= start:
+            return None
+        return SummaryJob(
+            conversation_id=conversation_id,
+            start=start,
+            end=end,
+            previous_summary=convo.summary,
+            messages=[
+                {"role": messages.role(i), "content": messages.content(i)}
+                for i in range(start, end)
+            ],
+        )
+
+    def apply_summary(self, job: SummaryJob, summary: str) -> bool:
+        """Store ``summary`` as covering ``job``'s messages.
 
-    def list_conversations(self) -> list[dict]:
+        Returns ``False``, storing nothing, if the conversation is gone or
+        its summary moved on while the job ran.
+        """
+        convo = self._store.get(job.conversation_id)
+        if convo is None or convo.summarized_count != job.start:
+            return False
+        convo.summary = summary
+        convo.summarized_count = job.end
+        convo.summary_token_count = None
+        self._store.save_summary(convo)
+        logger.info(
+            "Summarized messages %d-%d of conversation %s",
+            job.start,
+            job.end,
+            job.conversation_id,
+        )
+        return True
+
+    def list_conversations(
+        self, limit: int | None = None, before: str | None = None
+    ) -> list[dict]:
+        """A page of conversations, most recently updated first.
+
+        ``before`` is a cursor from :func:`encode_cursor`; the page holds at
+        most ``limit`` conversations older than it.
+        """
+        key = decode_cursor(before) if before else None
         return [
             {
                 "id": c.id,
                 "title": c.title,
                 "created_at": c.created_at.isoformat(),
                 "updated_at": c.updated_at.isoformat(),
-                "message_count": len(c.messages),
+                "message_count": c.message_count,
             }
-            for c in sorted(
-                self._store.values(),
-                key=lambda c: c.updated_at,
-                reverse=True,
-            )
+            for c in self._store.list_summaries(limit=limit, before=key)
+        ]
+
+    def search(self, query: str, limit: int = 20) -> list[dict]:
+        """Messages containing every word of ``query``, best match first."""
+        return [
+            {**hit.model_dump(), "timestamp": hit.timestamp.isoformat()}
+            for hit in self._store.search(query, limit=limit)
         ]
 
     def delete_conversation(self, conversation_id: str) -> bool:
-        if conversation_id not in self._store:
+        self._views.pop(conversation_id, None)
+        if not self._store.delete(conversation_id):
             return False
-        del self._store[conversation_id]
         logger.info("Deleted conversation %s", conversation_id)
         return True
 
 
-conversation_service = ConversationService()
+conversation_service = ConversationService(
+    store=create_conversation_store(
+        settings.conversation_store,
+        settings.conversation_db_path,
+        settings.conversation_cache_size,
+    ),
+    summary_trigger_tokens=settings.history_summary_trigger_tokens,
+    view_cache_size=settings.conversation_cache_size,
+)
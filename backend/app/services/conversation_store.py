@@ -0,0 +1,549 @@
+import bisect
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterator, NamedTuple
+
+from app.schemas.chat import ConversationSummary, SearchHit
+from app.services.search_index import InvertedIndex, fts_query, snippet, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Roles are stored as an index into this tuple, one byte per message.
+ROLES = ("system", "user", "assistant")
+_ROLE_INDEX = {role: i for i, role in enumerate(ROLES)}
+_UNCOUNTED = -1
+
+
+class StoredMessage(NamedTuple):
+    """One message read back out of a :class:`MessageLog`."""
+
+    role: str
+    content: str
+    timestamp: float
+    token_count: int | None
+
+
+class MessageLog:
+    """A conversation's messages, stored column by column.
+
+    Roles go in a ``bytearray``, timestamps (epoch seconds) and token counts
+    in ``array`` columns, and only the content strings are Python objects,
+    so a message costs its text plus about 21 bytes instead of a model
+    instance, a ``datetime`` and a ``__dict__``. Indexing and iteration
+    build :class:`StoredMessage` tuples on demand.
+    """
+
+    __slots__ = ("_roles", "_contents", "_timestamps", "_token_counts")
+
+    def __init__(self) -> None:
+        self._roles = bytearray()
+        self._contents: list[str] = []
+        self._timestamps = array("d")
+        self._token_counts = array("i")
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    def append(
+        self,
+        role: str,
+        content: str,
+        timestamp: float | None = None,
+        token_count: int | None = None,
+    ) -> None:
+        self._roles.append(_ROLE_INDEX[role])
+        self._contents.append(content)
+        self._timestamps.append(time.time() if timestamp is None else timestamp)
+        self._token_counts.append(_UNCOUNTED if token_count is None else token_count)
+
+    def role(self, index: int) -> str:
+        return ROLES[self._roles[index]]
+
+    def content(self, index: int) -> str:
+        return self._contents[index]
+
+    def timestamp(self, index: int) -> float:
+        return self._timestamps[index]
+
+    def token_count(self, index: int) -> int | None:
+        count = self._token_counts[index]
+        return None if count == _UNCOUNTED else count
+
+    def set_token_count(self, index: int, count: int) -> None:
+        self._token_counts[index] = count
+
+    def __getitem__(self, index: int) -> StoredMessage:
+        return StoredMessage(
+            self.role(index),
+            self._contents[index],
+            self._timestamps[index],
+            self.token_count(index),
+        )
+
+    def __iter__(self) -> Iterator[StoredMessage]:
+        for index in range(len(self)):
+            yield self[index]
+
+
+@dataclass(slots=True)
+class Conversation:
+    id: str
+    title: str
+    messages: MessageLog = field(default_factory=MessageLog)
+    created_at: datetime = field(default_factory=datetime.now)
+    updated_at: datetime = field(default_factory=datetime.now)
+    # Rolling summary standing in for messages[:summarized_count].
+    summary: str = ""
+    summarized_count: int = 0
+    summary_token_count: int | None = None
+
+
+class ConversationStore(ABC):
+    """Storage backend for :class:`ConversationService`.
+
+    The service mutates the :class:`Conversation` it gets back and then
+    tells the store what changed, so backends can persist incrementally.
+    """
+
+    @abstractmethod
+    def get(self, conversation_id: str) -> Conversation | None: ...
+
+    @abstractmethod
+    def create(self, convo: Conversation) -> None: ...
+
+    @abstractmethod
+    def append_message(self, convo: Conversation) -> None:
+        """Persist the last message of ``convo.messages``, just appended."""
+
+    @abstractmethod
+    def save_summary(self, convo: Conversation) -> None:
+        """Persist ``convo.summary`` and ``convo.summarized_count``."""
+
+    @abstractmethod
+    def list_summaries(
+        self, limit: int | None = None, before: tuple[datetime, str] | None = None
+    ) -> list[ConversationSummary]:
+        """Conversations ordered by ``(updated_at, id)``, most recent first.
+
+        ``before`` is the key of the last conversation on the previous page;
+        only conversations strictly older than it are returned.
+        """
+
+    @abstractmethod
+    def search(self, query: str, limit: int = 20) -> list[SearchHit]:
+        """Messages containing every term of ``query``, best match first."""
+
+    @abstractmethod
+    def delete(self, conversation_id: str) -> bool: ...
+
+
+class InMemoryConversationStore(ConversationStore):
+    """Conversations in a dict, plus an index ordered by ``updated_at``.
+
+    The index is a sorted list of ``(updated_at, id)`` keys. A conversation
+    that was just written almost always moves to the end, so keeping it
+    sorted is cheap, and a page is a bisect plus a slice. Message text is
+    searched through an :class:`InvertedIndex` updated on every append.
+    """
+
+    def __init__(self) -> None:
+        self._conversations: dict[str, Conversation] = {}
+        self._order: list[tuple[datetime, str]] = []
+        self._keys: dict[str, tuple[datetime, str]] = {}
+        self._search_index = InvertedIndex()
+
+    def get(self, conversation_id: str) -> Conversation | None:
+        return self._conversations.get(conversation_id)
+
+    def create(self, convo: Conversation) -> None:
+        self._conversations[convo.id] = convo
+        self._reindex(convo)
+
+    def append_message(self, convo: Conversation) -> None:
+        self._reindex(convo)
+        last = len(convo.messages) - 1
+        self._search_index.add(convo.id, last, convo.messages.content(last))
+
+    def save_summary(self, convo: Conversation) -> None:
+        pass
+
+    def search(self, query: str, limit: int = 20) -> list[SearchHit]:
+        terms = tokenize(query)
+        hits = []
+        for conversation_id, index, score in self._search_index.search(query, limit):
+            c = self._conversations[conversation_id]
+            hits.append(
+                SearchHit(
+                    conversation_id=conversation_id,
+                    title=c.title,
+                    message_index=index,
+                    role=c.messages.role(index),
+                    snippet=snippet(c.messages.content(index), terms),
+                    score=score,
+                    timestamp=datetime.fromtimestamp(c.messages.timestamp(index)),
+                )
+            )
+        return hits
+
+    def list_summaries(
+        self, limit: int | None = None, before: tuple[datetime, str] | None = None
+    ) -> list[ConversationSummary]:
+        end = bisect.bisect_left(self._order, before) if before else len(self._order)
+        start = 0 if limit is None else max(0, end - limit)
+        summaries = []
+        for _, conversation_id in reversed(self._order[start:end]):
+            c = self._conversations[conversation_id]
+            summaries.append(
+                ConversationSummary(
+                    id=c.id,
+                    title=c.title,
+                    created_at=c.created_at,
+                    updated_at=c.updated_at,
+                    message_count=len(c.messages),
+                )
+            )
+        return summaries
+
+    def delete(self, conversation_id: str) -> bool:
+        if self._conversations.pop(conversation_id, None) is None:
+            return False
+        self._unindex(conversation_id)
+        self._search_index.remove_conversation(conversation_id)
+        return True
+
+    def _reindex(self, convo: Conversation) -> None:
+        self._unindex(convo.id)
+        key = (convo.updated_at, convo.id)
+        bisect.insort(self._order, key)
+        self._keys[convo.id] = key
+
+    def _unindex(self, conversation_id: str) -> None:
+        key = self._keys.pop(conversation_id, None)
+        if key is not None:
+            del self._order[bisect.bisect_left(self._order, key)]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    summary TEXT NOT NULL DEFAULT '',
+    summarized_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated_at
+    ON conversations (updated_at, id);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation
+    ON messages (conversation_id, id);
+"""
+
+# Full-text index over message content, kept in step with the messages
+# table by triggers so every connection's writes are indexed.
+_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+    USING fts5(content, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+END;
+"""
+
+# Columns added after the first release, for databases created before them.
+_ADDED_COLUMNS = {
+    "summary": "TEXT NOT NULL DEFAULT ''",
+    "summarized_count": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def _to_db(value: datetime) -> str:
+    # Fixed-width ISO strings sort chronologically and round-trip exactly,
+    # so page cursors compare equal to the stored values.
+    return value.isoformat(timespec="microseconds")
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Conversations persisted in SQLite, with an LRU of hot conversations.
+
+    The database runs in WAL mode and messages are append-only inserts, so
+    several uvicorn workers can share one file. Reads of cached
+    conversations never touch the database; ``PRAGMA data_version`` (read
+    from shared memory in WAL mode) tells us when another connection has
+    written. Cached conversations are then checked against their row on
+    their next read, and only those another worker changed are reloaded.
+    Search uses an FTS5 index
+    when this SQLite build has the extension, and a slow ``LIKE`` scan
+    otherwise.
+    """
+
+    def __init__(self, path: str, cache_size: int = 1000) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.cache_size = max(1, cache_size)
+        self._hot: OrderedDict[str, Conversation] = OrderedDict()
+        # Cached conversations that may have changed since they were cached.
+        self._unverified: set[str] = set()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._add_missing_columns()
+        self._fts = self._create_search_index()
+        self._data_version = self._read_data_version()
+
+    def _add_missing_columns(self) -> None:
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+        for name, definition in _ADDED_COLUMNS.items():
+            if name not in existing:
+                self._conn.execute(f"ALTER TABLE conversations ADD COLUMN {name} {definition}")
+
+    def _create_search_index(self) -> bool:
+        existed = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone()
+        try:
+            self._conn.executescript(_SEARCH_SCHEMA)
+        except sqlite3.OperationalError:
+            logger.warning("SQLite lacks FTS5; conversation search will scan messages")
+            return False
+        if not existed:
+            # Index messages stored before search existed.
+            self._conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        return True
+
+    def _read_data_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _check_external_writes(self) -> None:
+        version = self._read_data_version()
+        if version != self._data_version:
+            self._data_version = version
+            self._unverified.update(self._hot)
+
+    def _changed_elsewhere(self, convo: Conversation) -> bool:
+        row = self._conn.execute(
+            "SELECT updated_at, message_count, summarized_count "
+            "FROM conversations WHERE id = ?",
+            (convo.id,),
+        ).fetchone()
+        return row != (
+            _to_db(convo.updated_at),
+            len(convo.messages),
+            convo.summarized_count,
+        )
+
+    def _cache(self, convo: Conversation) -> None:
+        self._hot[convo.id] = convo
+        self._hot.move_to_end(convo.id)
+        self._unverified.discard(convo.id)
+        while len(self._hot) > self.cache_size:
+            evicted, _ = self._hot.popitem(last=False)
+            self._unverified.discard(evicted)
+
+    def get(self, conversation_id: str) -> Conversation | None:
+        with self._lock:
+            self._check_external_writes()
+            convo = self._hot.get(conversation_id)
+            if convo is not None and conversation_id in self._unverified:
+                self._unverified.discard(conversation_id)
+                if self._changed_elsewhere(convo):
+                    del self._hot[conversation_id]
+                    convo = None
+            if convo is not None:
+                self._hot.move_to_end(conversation_id)
+                return convo
+            convo = self._load(conversation_id)
+            if convo is not None:
+                self._cache(convo)
+            return convo
+
+    def _load(self, conversation_id: str) -> Conversation | None:
+        row = self._conn.execute(
+            "SELECT title, created_at, updated_at, summary, summarized_count "
+            "FROM conversations WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        title, created_at, updated_at, summary, summarized_count = row
+        messages = MessageLog()
+        for role, content, timestamp in self._conn.execute(
+            "SELECT role, content, created_at FROM messages "
+            "WHERE conversation_id = ? ORDER BY id",
+            (conversation_id,),
+        ):
+            messages.append(role, content, datetime.fromisoformat(timestamp).timestamp())
+        return Conversation(
+            id=conversation_id,
+            title=title,
+            messages=messages,
+            created_at=datetime.fromisoformat(created_at),
+            updated_at=datetime.fromisoformat(updated_at),
+            summary=summary,
+            summarized_count=summarized_count,
+        )
+
+    def create(self, convo: Conversation) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO conversations "
+                "(id, title, created_at, updated_at, message_count) "
+                "VALUES (?, ?, ?, ?, 0)",
+                (
+                    convo.id,
+                    convo.title,
+                    _to_db(convo.created_at),
+                    _to_db(convo.updated_at),
+                ),
+            )
+            self._cache(convo)
+
+    def append_message(self, convo: Conversation) -> None:
+        last = len(convo.messages) - 1
+        created_at = datetime.fromtimestamp(convo.messages.timestamp(last))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT INTO messages (conversation_id, role, content, created_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (
+                        convo.id,
+                        convo.messages.role(last),
+                        convo.messages.content(last),
+                        _to_db(created_at),
+                    ),
+                )
+                self._conn.execute(
+                    "UPDATE conversations SET title = ?, updated_at = ?, "
+                    "message_count = message_count + 1 WHERE id = ?",
+                    (convo.title, _to_db(convo.updated_at), convo.id),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def save_summary(self, convo: Conversation) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE conversations SET summary = ?, summarized_count = ? WHERE id = ?",
+                (convo.summary, convo.summarized_count, convo.id),
+            )
+
+    def list_summaries(
+        self, limit: int | None = None, before: tuple[datetime, str] | None = None
+    ) -> list[ConversationSummary]:
+        query = "SELECT id, title, created_at, updated_at, message_count FROM conversations"
+        params: list[object] = []
+        if before is not None:
+            query += " WHERE (updated_at, id) < (?, ?)"
+            params += [_to_db(before[0]), before[1]]
+        query += " ORDER BY updated_at DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            ConversationSummary(
+                id=conversation_id,
+                title=title,
+                created_at=datetime.fromisoformat(created_at),
+                updated_at=datetime.fromisoformat(updated_at),
+                message_count=count,
+            )
+            for conversation_id, title, created_at, updated_at, count in rows
+        ]
+
+    def search(self, query: str, limit: int = 20) -> list[SearchHit]:
+        terms = tokenize(query)
+        if not terms:
+            return []
+        select = (
+            "SELECT m.conversation_id, c.title, m.role, m.content, m.created_at, {score}, "
+            "(SELECT COUNT(*) FROM messages p "
+            "WHERE p.conversation_id = m.conversation_id AND p.id < m.id) "
+        )
+        if self._fts:
+            query_sql = select.format(score="-bm25(messages_fts)") + (
+                "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                "JOIN conversations c ON c.id = m.conversation_id "
+                "WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts) LIMIT ?"
+            )
+            params: list[object] = [fts_query(query), limit]
+        else:
+            query_sql = select.format(score="0.0") + (
+                "FROM messages m JOIN conversations c ON c.id = m.conversation_id WHERE "
+                + " AND ".join("m.content LIKE ?" for _ in terms)
+                + " ORDER BY m.id DESC LIMIT ?"
+            )
+            params = [f"%{term}%" for term in terms] + [limit]
+        with self._lock:
+            rows = self._conn.execute(query_sql, params).fetchall()
+        return [
+            SearchHit(
+                conversation_id=conversation_id,
+                title=title,
+                message_index=index,
+                role=role,
+                snippet=snippet(content, terms),
+                score=score,
+                timestamp=datetime.fromisoformat(created_at),
+            )
+            for conversation_id, title, role, content, created_at, score, index in rows
+        ]
+
+    def delete(self, conversation_id: str) -> bool:
+        with self._lock:
+            self._hot.pop(conversation_id, None)
+            self._unverified.discard(conversation_id)
+            self._conn.execute("BEGIN")
+            try:
+                deleted = self._conn.execute(
+                    "DELETE FROM conversations WHERE id = ?", (conversation_id,)
+                ).rowcount
+                self._conn.execute(
+                    "DELETE FROM messages WHERE conversation_id = ?", (conversation_id,)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return deleted > 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_conversation_store(
+    backend: str, db_path: str, cache_size: int
+) -> ConversationStore:
+    if backend == "memory":
+        return InMemoryConversationStore()
+    if backend == "sqlite":
+        logger.info("Using SQLite conversation store at %s", db_path)
+        return SQLiteConversationStore(db_path, cache_size=cache_size)
+    raise ValueError(f"Unknown conversation store backend: {backend!r}")
@@ -0,0 +1,218 @@
+import ctypes
+import hashlib
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("<Q")
+
+
+@dataclass
+class KVSnapshot:
+    """The llama.cpp context state after a reply, plus the tokens it holds."""
+
+    tokens: np.ndarray
+    state: bytes
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.state) + self.tokens.nbytes
+
+
+def capture_snapshot(model: Llama) -> KVSnapshot:
+    """Copy the KV cache and token ids out of ``model``.
+
+    ``Llama.save_state`` also copies the per-token logits buffer, which is
+    unused without ``logits_all`` and dwarfs the KV cache for large
+    vocabularies, so the context state is read directly instead.
+    """
+    size = llama_cpp.llama_state_get_size(model.ctx)
+    buffer = (ctypes.c_uint8 * size)()
+    written = llama_cpp.llama_state_get_data(model.ctx, buffer, size)
+    return KVSnapshot(
+        tokens=model.input_ids[: model.n_tokens].copy(),
+        state=bytes(memoryview(buffer)[:written]),
+    )
+
+
+def restore_snapshot(model: Llama, snapshot: KVSnapshot) -> None:
+    size = len(snapshot.state)
+    buffer = (ctypes.c_uint8 * size).from_buffer_copy(snapshot.state)
+    if llama_cpp.llama_state_set_data(model.ctx, buffer, size) != size:
+        raise RuntimeError("Failed to restore llama state")
+    n_tokens = len(snapshot.tokens)
+    model.input_ids[:n_tokens] = snapshot.tokens
+    model.n_tokens = n_tokens
+
+
+class KVStateCache:
+    """Byte-bounded LRU of :class:`KVSnapshot` keyed by conversation id.
+
+    Snapshots evicted from memory are written to ``spill_dir`` when one is
+    configured, and promoted back into memory on their next hit. The disk
+    tier is itself an LRU bounded by ``spill_capacity_bytes``.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int,
+        spill_dir: str | None = None,
+        spill_capacity_bytes: int = 0,
+    ) -> None:
+        self.capacity_bytes = capacity_bytes
+        self.spill_dir = spill_dir
+        self.spill_capacity_bytes = spill_capacity_bytes
+        self._memory: OrderedDict[str, KVSnapshot] = OrderedDict()
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity_bytes > 0
+
+    def get(self, key: str) -> KVSnapshot | None:
+        with self._lock:
+            snapshot = self._memory.get(key)
+            if snapshot is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return snapshot
+            if key not in self._disk:
+                self.misses += 1
+                return None
+            self._disk_bytes -= self._disk.pop(key)
+
+        snapshot = self._read_spilled(key)
+        with self._lock:
+            if snapshot is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self.put(key, snapshot)
+        return snapshot
+
+    def record_hit(self) -> None:
+        """Count a reuse of state that never left the model context."""
+        with self._lock:
+            self.hits += 1
+
+    def put(self, key: str, snapshot: KVSnapshot) -> None:
+        if not self.enabled or snapshot.nbytes > self.capacity_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous.nbytes
+            self._memory[key] = snapshot
+            self._memory_bytes += snapshot.nbytes
+            evicted: list[tuple[str, KVSnapshot]] = []
+            while self._memory_bytes > self.capacity_bytes:
+                old_key, old = self._memory.popitem(last=False)
+                self._memory_bytes -= old.nbytes
+                self.evictions += 1
+                evicted.append((old_key, old))
+        for old_key, old in evicted:
+            self._spill(old_key, old)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            snapshot = self._memory.pop(key, None)
+            if snapshot is not None:
+                self._memory_bytes -= snapshot.nbytes
+            spilled = self._disk.pop(key, None)
+            if spilled is not None:
+                self._disk_bytes -= spilled
+        if spilled is not None:
+            self._remove_file(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            spilled = list(self._disk)
+            self._disk.clear()
+            self._disk_bytes = 0
+        for key in spilled:
+            self._remove_file(key)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._memory),
+                "bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, f"{digest}.kv")
+
+    def _spill(self, key: str, snapshot: KVSnapshot) -> None:
+        if not self.spill_dir or snapshot.nbytes > self.spill_capacity_bytes:
+            return
+        tokens = snapshot.tokens.astype(np.intc, copy=False)
+        try:
+            with open(self._path(key), "wb") as f:
+                f.write(_HEADER.pack(len(tokens)))
+                f.write(tokens.tobytes())
+                f.write(snapshot.state)
+        except OSError:
+            logger.warning("Failed to spill KV state for %s", key, exc_info=True)
+            return
+
+        stale: list[str] = []
+        with self._lock:
+            self._disk[key] = snapshot.nbytes
+            self._disk_bytes += snapshot.nbytes
+            while self._disk_bytes > self.spill_capacity_bytes:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                stale.append(old_key)
+        for old_key in stale:
+            self._remove_file(old_key)
+
+    def _read_spilled(self, key: str) -> KVSnapshot | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                (n_tokens,) = _HEADER.unpack(f.read(_HEADER.size))
+                tokens = np.frombuffer(
+                    f.read(n_tokens * np.dtype(np.intc).itemsize), dtype=np.intc
+                ).copy()
+                state = f.read()
+        except (OSError, struct.error):
+            logger.warning("Failed to read spilled KV state for %s", key, exc_info=True)
+            return None
+        finally:
+            self._remove_file(key)
+        return KVSnapshot(tokens=tokens, state=state)
+
+    def _remove_file(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,377 @@
+import bisect
+import math
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable
+
+# Latency buckets in seconds, from a fast cached prefill up to the deadline.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+PROMPT_TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+class _Sharded:
+    """Per-thread slots of floats, summed when the metric is scraped.
+
+    Each thread only ever writes its own slots, so recording never takes a
+    lock; the lock is only held when a thread records its first value and
+    during a scrape. Shards of threads that have exited (every generation
+    decodes on its own thread) are folded into a running total at both
+    points, so they do not pile up when nothing scrapes the metrics.
+    """
+
+    def __init__(self, size: int) -> None:
+        self._size = size
+        self._local = threading.local()
+        self._shards: list[tuple[threading.Thread, list[float]]] = []
+        self._retired = [0.0] * size
+        self._lock = threading.Lock()
+
+    def shard(self) -> list[float]:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = [0.0] * self._size
+            self._local.shard = shard
+            with self._lock:
+                self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_dead(self) -> list[tuple[threading.Thread, list[float]]]:
+        # Called with the lock held.
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for i, value in enumerate(shard):
+                    self._retired[i] += value
+        self._shards = live
+        return live
+
+    def totals(self) -> list[float]:
+        with self._lock:
+            live = self._retire_dead()
+            totals = list(self._retired)
+        for _, shard in live:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self): ...
+
+    def _series(self) -> list[tuple[tuple[str, ...], object]]:
+        if not self.labelnames:
+            return [((), self.labels())]
+        with self._lock:
+            return sorted(self._children.items())
+
+    def _label_text(self, values: tuple[str, ...], extra: str = "") -> str:
+        pairs = [
+            f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def expose(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in self._series():
+            lines.extend(self._expose_child(values, child))
+        return lines
+
+    @abstractmethod
+    def _expose_child(self, values: tuple[str, ...], child) -> list[str]: ...
+
+
+class _CounterChild:
+    def __init__(self) -> None:
+        self._values = _Sharded(1)
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._values.shard()[0] += amount
+
+    @property
+    def value(self) -> float:
+        return self._values.totals()[0]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    @property
+    def value(self) -> float:
+        return self.labels().value
+
+    def _expose_child(self, values, child) -> list[str]:
+        return [f"{self.name}{self._label_text(values)} {_format(child.value)}"]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        # One slot per bucket, one for +Inf, then the sum.
+        self._values = _Sharded(len(buckets) + 2)
+
+    def observe(self, value: float) -> None:
+        shard = self._values.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self) -> tuple[list[float], float, float]:
+        """Cumulative bucket counts, the total count and the sum."""
+        totals = self._values.totals()
+        cumulative = []
+        running = 0.0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, totals[-1]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+        labelnames: Iterable[str] = (),
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def snapshot(self) -> tuple[list[float], float, float]:
+        return self.labels().snapshot()
+
+    def _expose_child(self, values, child) -> list[str]:
+        cumulative, count, total = child.snapshot()
+        lines = []
+        for bound, bucket_count in zip(self.buckets + (math.inf,), cumulative):
+            le = 'le="+Inf"' if bound == math.inf else f'le="{_format(bound)}"'
+            lines.append(
+                f"{self.name}_bucket{self._label_text(values, le)} {_format(bucket_count)}"
+            )
+        labels = self._label_text(values)
+        lines.append(f"{self.name}_sum{labels} {_format(total)}")
+        lines.append(f"{self.name}_count{labels} {_format(count)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read from ``callback`` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def _series(self):
+        return [((), None)]
+
+    def _new_child(self):
+        raise TypeError(f"{self.name} is read from its callback and has no children")
+
+    def _expose_child(self, values, child) -> list[str]:
+        return [f"{self.name} {_format(self.callback())}"]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics = [m for m in self._metrics if m.name != metric.name]
+            self._metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines: list[str] = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+registry = MetricsRegistry()
+
+time_to_first_token = registry.register(
+    Histogram(
+        "chat_time_to_first_token_seconds",
+        "Time from a generation slot being granted to the first streamed token.",
+    )
+)
+prefill_seconds = registry.register(
+    Histogram(
+        "chat_prefill_seconds",
+        "Time spent restoring context and evaluating the prompt.",
+    )
+)
+decode_seconds = registry.register(
+    Histogram(
+        "chat_decode_seconds",
+        "Time spent decoding after the first token.",
+    )
+)
+tokens_per_second = registry.register(
+    Histogram(
+        "chat_decode_tokens_per_second",
+        "Decode throughput per generation.",
+        buckets=TOKENS_PER_SECOND_BUCKETS,
+    )
+)
+queue_wait_seconds = registry.register(
+    Histogram(
+        "chat_queue_wait_seconds",
+        "Time a request waited for a generation slot.",
+    )
+)
+scheduling_delay_seconds = registry.register(
+    Histogram(
+        "chat_scheduling_delay_seconds",
+        "Time a generation waited for a slot, by priority class; resumed "
+        "generations count each wait.",
+        labelnames=("priority",),
+    )
+)
+generation_preemptions = registry.register(
+    Counter(
+        "chat_generation_preemptions_total",
+        "Generations paused to let queued requests run, by priority class.",
+        labelnames=("priority",),
+    )
+)
+prompt_tokens = registry.register(
+    Histogram(
+        "chat_prompt_tokens",
+        "Prompt size in tokens after history truncation.",
+        buckets=PROMPT_TOKEN_BUCKETS,
+    )
+)
+tokens_generated = registry.register(
+    Counter("chat_generated_tokens_total", "Tokens streamed to clients.")
+)
+generations = registry.register(
+    Counter(
+        "chat_generations_total",
+        "Finished generations by outcome.",
+        labelnames=("outcome",),
+    )
+)
+draft_tokens = registry.register(
+    Counter(
+        "chat_speculative_draft_tokens_total",
+        "Tokens proposed by the speculative draft model.",
+    )
+)
+draft_tokens_accepted = registry.register(
+    Counter(
+        "chat_speculative_accepted_tokens_total",
+        "Draft tokens the target model kept.",
+    )
+)
+response_cache_lookups = registry.register(
+    Counter(
+        "chat_response_cache_lookups_total",
+        "Response cache lookups by result: exact, semantic or miss.",
+        labelnames=("result",),
+    )
+)
+history_truncations = registry.register(
+    Counter(
+        "chat_history_truncations_total",
+        "Prompts that dropped older turns to fit the context budget.",
+    )
+)
+history_summaries = registry.register(
+    Counter(
+        "chat_history_summaries_total",
+        "Background history summaries by outcome: stored, stale, interrupted, failed or error.",
+        labelnames=("outcome",),
+    )
+)
+requests_rejected = registry.register(
+    Counter(
+        "chat_requests_rejected_total",
+        "Chat requests refused before generation, by reason.",
+        labelnames=("reason",),
+    )
+)
+requests_coalesced = registry.register(
+    Counter(
+        "chat_requests_coalesced_total",
+        "Chat requests attached to an identical generation already streaming.",
+    )
+)
+streams_resumed = registry.register(
+    Counter(
+        "chat_streams_resumed_total",
+        "Reconnections to a generation's stream with Last-Event-ID.",
+    )
+)
+model_switches = registry.register(
+    Counter(
+        "chat_model_switches_total",
+        "Times new requests were switched to another model variant.",
+    )
+)
+errors = registry.register(
+    Counter(
+        "chat_errors_total",
+        "Chat requests that failed while streaming.",
+    )
+)
@@ -0,0 +1,309 @@
+import logging
+import os
+import threading
+import time
+from typing import AsyncGenerator
+
+from app.config import settings
+from app.services import metrics
+from app.services.kv_cache import KVStateCache
+from app.services.model_service import (
+    GenerationScheduler,
+    ModelService,
+    _resolve_model_file,
+    model_service,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANT = "default"
+
+# Load shedding stays on at least this long once triggered, and turns off
+# only when load is below half of every threshold, so it does not flap.
+_SHED_MIN_HOLD_S = 10.0
+# Weight of the newest sample in the moving average of time to first token.
+_TTFT_SMOOTHING = 0.2
+
+
+def parse_variants(spec: str) -> dict[str, str]:
+    """``MODEL_VARIANTS`` as ``{name: file}``.
+
+    The spec is a comma-separated list of ``name=file`` pairs. A file with a
+    ``/`` in it is a local path; anything else is a filename in
+    ``MODEL_REPO``.
+    """
+    variants: dict[str, str] = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, sep, file = entry.partition("=")
+        if not sep or not name.strip() or not file.strip():
+            raise ValueError(f"Invalid model variant {entry!r}; expected name=file")
+        variants[name.strip()] = file.strip()
+    if DEFAULT_VARIANT in variants:
+        raise ValueError(f"{DEFAULT_VARIANT!r} is reserved for the configured model")
+    return variants
+
+
+class ModelRegistry:
+    """Named model variants, one of which serves new requests.
+
+    ``default`` is the configured model; the others come from
+    ``MODEL_VARIANTS``. A variant is a :class:`ModelService` of its own,
+    with its own contexts and KV state cache, sharing the primary's
+    generation scheduler so admission control sees every request. Variants
+    are meant to be quantizations of the same model: the token counts
+    stored with conversations come from the primary's tokenizer.
+
+    :meth:`activate` switches new requests to a variant in one assignment.
+    A generation keeps the :class:`ModelService` it started on, so streams
+    already running finish on the old variant while new ones go to the
+    new one. With a ``shed_variant``, :meth:`serving` routes new requests
+    to it while the queue is at least ``shed_queue_depth`` deep or the
+    moving average of time to first token is at least ``shed_ttft_s``.
+    """
+
+    def __init__(
+        self,
+        primary: ModelService,
+        files: dict[str, str] | None = None,
+        shed_variant: str = "",
+        shed_queue_depth: int = 0,
+        shed_ttft_s: float = 0.0,
+    ) -> None:
+        self.files = dict(files or {})
+        if shed_variant and shed_variant not in self.files:
+            raise ValueError(f"Unknown load-shedding variant {shed_variant!r}")
+        self.shed_variant = shed_variant
+        self.shed_queue_depth = shed_queue_depth
+        self.shed_ttft_s = shed_ttft_s
+        self._services: dict[str, ModelService] = {DEFAULT_VARIANT: primary}
+        # The primary's state is its own is_loaded; see state().
+        self._states: dict[str, str] = {}
+        self._active = DEFAULT_VARIANT
+        self._activate_when_loaded: str | None = None
+        self._shedding = False
+        self._shed_since = 0.0
+        self._ttft_s: float | None = None
+        # Requests that chose each variant and have not finished, queued or not.
+        self._requests: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def scheduler(self) -> GenerationScheduler:
+        return self._services[DEFAULT_VARIANT].scheduler
+
+    @property
+    def active(self) -> str:
+        return self._active
+
+    @property
+    def shedding(self) -> bool:
+        return self._shedding
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.serving().is_loaded
+
+    @property
+    def names(self) -> list[str]:
+        return [DEFAULT_VARIANT, *self.files]
+
+    def state(self, name: str) -> str:
+        """``unloaded``, ``loading``, ``loaded`` or ``failed``."""
+        if name == DEFAULT_VARIANT:
+            return "loaded" if self._services[name].is_loaded else "loading"
+        return self._states.get(name, "unloaded")
+
+    def model_id(self, name: str) -> str:
+        file = self.files.get(name, settings.model_path or settings.model_filename)
+        return file if "/" in file else f"{settings.model_repo}/{file}"
+
+    @property
+    def serving_name(self) -> str:
+        """The variant new requests go to right now."""
+        if self._shedding and self.state(self.shed_variant) == "loaded":
+            return self.shed_variant
+        return self._active
+
+    def serving(self) -> ModelService:
+        """The model for a new request, after updating the load-shedding state."""
+        return self.serving_variant()[1]
+
+    def serving_variant(self) -> tuple[str, ModelService]:
+        """Name and model for a new request, after updating the load-shedding state."""
+        self._update_shedding()
+        name = self.serving_name
+        return name, self._services[name]
+
+    def acquire(self) -> tuple[str, ModelService]:
+        """:meth:`serving_variant`, counted against the variant until :meth:`release`.
+
+        :meth:`unload` refuses a variant with requests counted against it,
+        so a request keeps its model while it waits in the queue.
+        """
+        with self._lock:
+            name, service = self.serving_variant()
+            self._requests[name] = self._requests.get(name, 0) + 1
+        return name, service
+
+    def release(self, name: str) -> None:
+        with self._lock:
+            self._requests[name] -= 1
+
+    def generate_stream_async(self, *args, **kwargs) -> AsyncGenerator[dict, None]:
+        """:meth:`ModelService.generate_stream_async` on the serving variant."""
+        return self.serving().generate_stream_async(*args, **kwargs)
+
+    def record_ttft(self, seconds: float) -> None:
+        """Feed a request's time to first token into the load-shedding average."""
+        if self._ttft_s is None:
+            self._ttft_s = seconds
+        else:
+            self._ttft_s += _TTFT_SMOOTHING * (seconds - self._ttft_s)
+
+    def _overloaded(self, fraction: float) -> bool:
+        queued = self.scheduler.queued_count
+        if self.shed_queue_depth > 0 and queued >= self.shed_queue_depth * fraction:
+            return True
+        return (
+            self.shed_ttft_s > 0
+            and self._ttft_s is not None
+            and self._ttft_s >= self.shed_ttft_s * fraction
+        )
+
+    def _update_shedding(self) -> None:
+        if not self.shed_variant or self.state(self.shed_variant) != "loaded":
+            return
+        now = time.monotonic()
+        if not self._shedding and self._overloaded(1.0):
+            self._shedding = True
+            self._shed_since = now
+            logger.warning(
+                "Load shedding: routing new requests to variant %s", self.shed_variant
+            )
+        elif (
+            self._shedding
+            and now - self._shed_since >= _SHED_MIN_HOLD_S
+            and not self._overloaded(0.5)
+        ):
+            self._shedding = False
+            logger.info("Load dropped: routing new requests to variant %s", self._active)
+
+    def load(self, name: str) -> ModelService:
+        """Load variant ``name`` on the calling thread, if it is not loaded yet."""
+        if name not in self.files:
+            raise KeyError(name)
+        with self._lock:
+            service = self._services.get(name)
+            if service is not None and self.state(name) in ("loading", "loaded"):
+                return service
+            service = ModelService(scheduler=self.scheduler)
+            if settings.kv_cache_spill_dir:
+                # Snapshots only fit the model that made them.
+                service.kv_cache = KVStateCache(
+                    capacity_bytes=settings.kv_cache_max_bytes,
+                    spill_dir=os.path.join(settings.kv_cache_spill_dir, name),
+                    spill_capacity_bytes=settings.kv_cache_spill_max_bytes,
+                )
+            self._services[name] = service
+            self._states[name] = "loading"
+        file = self.files[name]
+        logger.info("Loading model variant %s (%s)", name, file)
+        try:
+            if "/" in file:
+                path = _resolve_model_file("", "", file)
+            else:
+                path = _resolve_model_file(settings.model_repo, file)
+            service.load_model(model_path=path)
+        except Exception:
+            self._states[name] = "failed"
+            if self._activate_when_loaded == name:
+                self._activate_when_loaded = None
+            raise
+        self._states[name] = "loaded"
+        logger.info("Model variant %s loaded", name)
+        if self._activate_when_loaded == name:
+            self._activate_when_loaded = None
+            self.activate(name)
+        return service
+
+    def load_in_background(self, name: str, activate: bool = False) -> None:
+        if activate:
+            self._activate_when_loaded = name
+
+        def run() -> None:
+            try:
+                self.load(name)
+            except Exception:
+                logger.error("Failed to load model variant %s", name, exc_info=True)
+
+        threading.Thread(target=run, name=f"load-{name}", daemon=True).start()
+
+    def activate(self, name: str) -> None:
+        """Send new requests to loaded variant ``name``."""
+        if self.state(name) != "loaded":
+            raise ValueError(f"Model variant {name!r} is not loaded")
+        previous, self._active = self._active, name
+        if previous != name:
+            metrics.model_switches.inc()
+            logger.info("Switched new requests from variant %s to %s", previous, name)
+
+    def unload(self, name: str) -> None:
+        """Free variant ``name``. Refused while it serves or drains requests."""
+        if self.state(name) != "loaded":
+            raise KeyError(name)
+        if name == DEFAULT_VARIANT:
+            # Its tokenizer counts the tokens stored with conversations.
+            raise ValueError("The configured model cannot be unloaded")
+        if name in (self._active, self.shed_variant):
+            raise ValueError(f"Model variant {name!r} is in use")
+        service = self._services[name]
+        with self._lock:
+            requests = max(self._requests.get(name, 0), service.generations_in_flight)
+            if requests:
+                raise ValueError(
+                    f"Model variant {name!r} still has {requests} requests in flight"
+                )
+            self._states[name] = "unloaded"
+        service.unload()
+        logger.info("Unloaded model variant %s", name)
+
+    def forget_conversation(self, conversation_id: str) -> None:
+        for service in list(self._services.values()):
+            service.forget_conversation(conversation_id)
+
+    def stats(self) -> dict[str, object]:
+        variants = {}
+        for name in self.names:
+            service = self._services.get(name)
+            variants[name] = {
+                "state": self.state(name),
+                "model_id": self.model_id(name),
+                "in_flight": service.generations_in_flight if service is not None else 0,
+            }
+        return {
+            "active": self._active,
+            "serving": self.serving_name,
+            "shedding": self._shedding,
+            "ttft_avg_s": round(self._ttft_s, 3) if self._ttft_s is not None else None,
+            "variants": variants,
+        }
+
+
+model_registry = ModelRegistry(
+    model_service,
+    files=parse_variants(settings.model_variants),
+    shed_variant=settings.load_shed_variant,
+    shed_queue_depth=settings.load_shed_queue_depth,
+    shed_ttft_s=settings.load_shed_ttft_s,
+)
+
+metrics.registry.register(
+    metrics.Gauge(
+        "chat_load_shedding",
+        "1 while new requests are routed to the load-shedding variant.",
+        lambda: float(model_registry.serving_name != model_registry.active),
+    )
+)
@@ -1,110 +1,1241 @@
 import asyncio
 import logging
 import os
+import threading
 import time
-from typing import AsyncGenerator
+from collections import deque
+from typing import AsyncGenerator, Callable
 
-from huggingface_hub import hf_hub_download
+import numpy as np
+from huggingface_hub import hf_hub_download, try_to_load_from_cache
 from llama_cpp import Llama
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
 
 from app.config import settings
+from app.services import metrics
+from app.services.autotune import TuneResult, load_or_tune, thread_budget
+from app.services.batching import BatchEngine, BatchRequest, SamplingParams
+from app.services.conversation_service import SYSTEM_PROMPT
+from app.services.kv_cache import (
+    KVSnapshot,
+    KVStateCache,
+    capture_snapshot,
+    restore_snapshot,
+)
+from app.services.profiling import RequestProfile, current_profile
+from app.services.response_cache import LlamaEmbedder
+from app.services.speculative import create_draft_model, metered_drafts
+from app.services.streaming import TokenBuffer
 
 logger = logging.getLogger(__name__)
 
-_SENTINEL = object()
+# Tokens assumed for chat-template framing when the model has no template.
+_DEFAULT_TEMPLATE_OVERHEAD = 8
+
+# With continuous batching the Llama object is only used for tokenizing and
+# templates; the batch engine owns the real context.
+_TOKENIZER_ONLY_CTX = 512
+
+# llama.cpp's default prompt batch size, used unless autotuning picks another.
+_DEFAULT_N_BATCH = 512
+
+
+def _reused_prefix(model: Llama, prompt: list[int]) -> int:
+    """Prompt tokens llama.cpp will reuse from the context instead of evaluating."""
+    n = min(model.n_tokens, len(prompt))
+    mismatch = np.flatnonzero(model.input_ids[:n] != np.asarray(prompt[:n]))
+    reused = int(mismatch[0]) if len(mismatch) else n
+    # The last prompt token is always evaluated again to get fresh logits.
+    return min(reused, len(prompt) - 1)
+
+
+def _set_token_rates(profile: RequestProfile, tokens_generated: int) -> None:
+    prefill_s = profile.phases.get("prefill")
+    decode_s = profile.phases.get("decode")
+    prefill_tokens = profile.values.get("prefill_tokens")
+    if prefill_s and prefill_tokens is not None:
+        profile.set("prefill_tokens_per_s", prefill_tokens / prefill_s)
+    if decode_s and tokens_generated > 1:
+        profile.set("decode_tokens_per_s", (tokens_generated - 1) / decode_s)
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the generation queue cannot admit another request."""
+
+
+# Priority classes, most urgent first. A ticket's ``priority`` indexes this.
+PRIORITIES = ("high", "normal", "low")
+
+# Half-life of the slot time charged to a fair-share key, and how many keys
+# are tracked before those whose usage has decayed away are dropped.
+_USAGE_HALF_LIFE_S = 60.0
+_MAX_SHARE_KEYS = 4096
+
+
+class GenerationTicket:
+    """A single request's place in the generation queue."""
+
+    def __init__(
+        self,
+        scheduler: "GenerationScheduler",
+        priority: int = 1,
+        share_key: str | None = None,
+    ) -> None:
+        self._scheduler = scheduler
+        self._granted = False
+        self._changed = asyncio.Event()
+        self.priority = priority
+        self.share_key = share_key
+        self.preemptions = 0
+        self.enqueued_at = time.perf_counter()
+        self.started_at: float | None = None
+        self._seq = 0
+
+    @property
+    def granted(self) -> bool:
+        return self._granted
+
+    @property
+    def position(self) -> int:
+        """1-based position in the queue, or 0 once the ticket holds a slot."""
+        return self._scheduler._position(self)
+
+    async def wait(self) -> AsyncGenerator[int, None]:
+        """Wait for a generation slot, yielding the queue position on every change."""
+        last_position: int | None = None
+        while True:
+            self._changed.clear()
+            if self._granted:
+                return
+            position = self.position
+            if position != last_position:
+                last_position = position
+                yield position
+            await self._changed.wait()
+
+    def should_yield(self) -> bool:
+        """Whether the holder should give up its slot at the next token.
+
+        Safe to call from a decode thread.
+        """
+        return self._scheduler._should_yield(self)
+
+    def requeue(self) -> None:
+        """Give the slot up and wait in line again, keeping the priority."""
+        self._scheduler._requeue(self)
+
+    def release(self) -> None:
+        """Give up the slot or queue entry. Safe to call more than once."""
+        self._scheduler._release(self)
+
+
+class GenerationScheduler:
+    """Bounded admission control in front of the model.
+
+    At most ``max_concurrent`` tickets hold a generation slot at once; up to
+    ``max_queued`` more wait. Anything beyond that is rejected immediately
+    with :class:`QueueFullError` so callers can shed load instead of letting
+    every request slow down together.
+
+    Waiting tickets are served by priority class (see :data:`PRIORITIES`),
+    then in arrival order. With ``fair_share`` on, tickets within a class
+    are ordered by the slot time their share key has used recently
+    (decaying with a one-minute half-life), so one busy conversation or
+    client cannot crowd out the others. With ``time_slice_s`` set,
+    :meth:`GenerationTicket.should_yield` asks a holder to step aside once
+    it has run that long and a ticket of the same or a higher class is
+    waiting, or at once for a higher class.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_queued: int,
+        time_slice_s: float = 0.0,
+        fair_share: bool = False,
+    ) -> None:
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queued = max(0, max_queued)
+        self.time_slice_s = time_slice_s
+        self.fair_share = fair_share
+        self._active: set[GenerationTicket] = set()
+        self._waiting: list[deque[GenerationTicket]] = [deque() for _ in PRIORITIES]
+        # Per-class queue lengths, read by decode threads in should_yield.
+        self._waiting_counts = [0] * len(PRIORITIES)
+        self._usage: dict[str, tuple[float, float]] = {}
+        self._next_seq = 0
+
+    @property
+    def active_count(self) -> int:
+        return len(self._active)
+
+    @property
+    def queued_count(self) -> int:
+        return sum(self._waiting_counts)
+
+    def submit(self, priority: str = "normal", share_key: str | None = None) -> GenerationTicket:
+        has_free_slot = len(self._active) < self.max_concurrent
+        if not has_free_slot and self.queued_count >= self.max_queued:
+            raise QueueFullError(
+                f"Generation queue is full ({self.max_queued} waiting)"
+            )
+        ticket = GenerationTicket(self, PRIORITIES.index(priority), share_key)
+        self._enqueue(ticket)
+        self._dispatch()
+        return ticket
+
+    def usage(self, share_key: str) -> float:
+        """Slot seconds charged to ``share_key``, decayed to now."""
+        value, at = self._usage.get(share_key, (0.0, 0.0))
+        return value * 0.5 ** ((time.perf_counter() - at) / _USAGE_HALF_LIFE_S)
+
+    def _enqueue(self, ticket: GenerationTicket) -> None:
+        ticket._seq = self._next_seq
+        self._next_seq += 1
+        self._waiting[ticket.priority].append(ticket)
+        self._waiting_counts[ticket.priority] += 1
+
+    def _ordered(self) -> list[GenerationTicket]:
+        """Waiting tickets in the order they will be granted."""
+        ordered: list[GenerationTicket] = []
+        for queue in self._waiting:
+            if self.fair_share and len(queue) > 1:
+                usage = {t.share_key: self.usage(t.share_key) for t in queue if t.share_key}
+                ordered.extend(
+                    sorted(queue, key=lambda t: (usage.get(t.share_key, 0.0), t._seq))
+                )
+            else:
+                ordered.extend(queue)
+        return ordered
+
+    def _position(self, ticket: GenerationTicket) -> int:
+        if ticket._granted:
+            return 0
+        try:
+            return self._ordered().index(ticket) + 1
+        except ValueError:
+            return 0
+
+    def _should_yield(self, ticket: GenerationTicket) -> bool:
+        if self.time_slice_s <= 0 or not ticket._granted or ticket.started_at is None:
+            return False
+        if any(self._waiting_counts[:ticket.priority]):
+            return True
+        return (
+            self._waiting_counts[ticket.priority] > 0
+            and time.perf_counter() - ticket.started_at >= self.time_slice_s
+        )
+
+    def _charge(self, ticket: GenerationTicket) -> None:
+        if ticket.share_key is None or ticket.started_at is None:
+            return
+        now = time.perf_counter()
+        self._usage[ticket.share_key] = (
+            self.usage(ticket.share_key) + now - ticket.started_at,
+            now,
+        )
+        if len(self._usage) > _MAX_SHARE_KEYS:
+            for key in [k for k in self._usage if self.usage(k) < 0.01]:
+                del self._usage[key]
+
+    def _requeue(self, ticket: GenerationTicket) -> None:
+        if ticket not in self._active:
+            return
+        self._active.discard(ticket)
+        self._charge(ticket)
+        ticket._granted = False
+        ticket.preemptions += 1
+        ticket.enqueued_at = time.perf_counter()
+        metrics.generation_preemptions.labels(PRIORITIES[ticket.priority]).inc()
+        self._enqueue(ticket)
+        self._dispatch()
+
+    def _release(self, ticket: GenerationTicket) -> None:
+        if ticket in self._active:
+            self._active.discard(ticket)
+            self._charge(ticket)
+        else:
+            try:
+                self._waiting[ticket.priority].remove(ticket)
+            except ValueError:
+                return
+            self._waiting_counts[ticket.priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.queued_count and len(self._active) < self.max_concurrent:
+            ticket = self._ordered()[0]
+            self._waiting[ticket.priority].remove(ticket)
+            self._waiting_counts[ticket.priority] -= 1
+            ticket._granted = True
+            ticket.started_at = time.perf_counter()
+            metrics.scheduling_delay_seconds.labels(PRIORITIES[ticket.priority]).observe(
+                ticket.started_at - ticket.enqueued_at
+            )
+            self._active.add(ticket)
+            ticket._changed.set()
+        for queue in self._waiting:
+            for ticket in queue:
+                ticket._changed.set()
+
+
+class ModelReplica:
+    """One llama.cpp context and the per-context state that goes with it.
+
+    A replica decodes one generation at a time under ``lock``. ``cores``
+    is the slice of CPUs its decode threads are pinned to, or empty to
+    leave scheduling to the OS.
+    """
+
+    def __init__(self, index: int, model: Llama | None = None, cores: list[int] | None = None) -> None:
+        self.index = index
+        self.model = model
+        self.cores = cores or []
+        self.lock = threading.Lock()
+        self.resident_conversation: str | None = None
+        self.generations = 0
+        self.last_used = 0.0
+        self._active = 0
+        self._counter_lock = threading.Lock()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def begin(self) -> None:
+        with self._counter_lock:
+            self._active += 1
+            self.generations += 1
+            self.last_used = time.monotonic()
+
+    def finish(self) -> None:
+        with self._counter_lock:
+            self._active -= 1
+
+    def pin_current_thread(self) -> None:
+        # On Linux this sets the calling thread's affinity; the threads
+        # llama.cpp starts for each evaluation inherit it.
+        if self.cores and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cores)
+
+    def stats(self) -> dict[str, int | bool | list[int]]:
+        return {
+            "index": self.index,
+            "loaded": self.model is not None,
+            "active": self.active,
+            "generations": self.generations,
+            "cores": self.cores,
+        }
+
+
+def _resolve_model_file(repo_id: str, filename: str, local_path: str = "") -> str:
+    """Find a GGUF without touching the network when it is already on disk.
+
+    ``local_path`` wins when set. Otherwise the Hugging Face cache is read
+    directly, and only a cache miss downloads, unless ``model_local_only``
+    forbids it.
+    """
+    if local_path:
+        if not os.path.isfile(local_path):
+            raise FileNotFoundError(f"Model file not found: {local_path}")
+        return local_path
+    cached = None
+    if repo_id and filename:
+        cached = try_to_load_from_cache(repo_id=repo_id, filename=filename)
+    if isinstance(cached, str):
+        logger.info("Using cached model file %s", cached)
+        return cached
+    if settings.model_local_only:
+        raise FileNotFoundError(
+            f"{repo_id}/{filename} is not in the Hugging Face cache and "
+            "MODEL_LOCAL_ONLY forbids downloading it"
+        )
+    logger.info("Downloading model: %s / %s", repo_id, filename)
+    return hf_hub_download(repo_id=repo_id, filename=filename)
+
+
+def _prefetch_file(path: str, chunk_bytes: int = 16 * 1024 * 1024) -> int:
+    """Read ``path`` once, sequentially, so mmap'd weights start in the page cache.
+
+    One sequential pass is much cheaper than the random page faults the
+    first generation would otherwise take. Returns the number of bytes read.
+    """
+    total = 0
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = bytearray(chunk_bytes)
+        while read := f.readinto(buffer):
+            total += read
+    return total
+
+
+def _core_slices(n_replicas: int) -> list[list[int]]:
+    """Split the CPUs this process may use into one contiguous slice per replica."""
+    if n_replicas <= 1 or not hasattr(os, "sched_getaffinity"):
+        return [[] for _ in range(max(1, n_replicas))]
+    cores = sorted(os.sched_getaffinity(0))
+    size = max(1, len(cores) // n_replicas)
+    return [cores[i * size:(i + 1) * size] or cores[-size:] for i in range(n_replicas)]
 
 
 class ModelService:
-    def __init__(self) -> None:
-        self.model: Llama | None = None
+    def __init__(self, scheduler: GenerationScheduler | None = None) -> None:
+        self.replicas: list[ModelReplica] = []
+        self.batch_engine: BatchEngine | None = None
+        self.embedder: LlamaEmbedder | None = None
         self._loaded = False
+        self.model_path: str | None = None
+        self.generations_in_flight = 0
+        self.startup_phases: dict[str, float] = {}
+        self.scheduler = scheduler or GenerationScheduler(
+            max_concurrent=(
+                settings.max_concurrent_generations
+                or settings.batch_max_sequences
+                or settings.model_replicas
+            ),
+            max_queued=settings.max_queued_requests,
+            time_slice_s=settings.scheduler_time_slice_s,
+            fair_share=settings.scheduler_fair_share != "off",
+        )
+        self.kv_cache = KVStateCache(
+            capacity_bytes=settings.kv_cache_max_bytes,
+            spill_dir=settings.kv_cache_spill_dir or None,
+            spill_capacity_bytes=settings.kv_cache_spill_max_bytes,
+        )
+        self._prefix_formatter: Jinja2ChatFormatter | None = None
+        self._prompt_formatter: Jinja2ChatFormatter | None = None
+        self._message_overhead = _DEFAULT_TEMPLATE_OVERHEAD
+        self._generation_overhead = _DEFAULT_TEMPLATE_OVERHEAD
+        self._system_prefix: KVSnapshot | None = None
+        self._system_prefix_prompt: str | None = None
+
+    @property
+    def model(self) -> Llama | None:
+        """The first replica's model, used for tokenizing and templates."""
+        return self.replicas[0].model if self.replicas else None
+
+    @model.setter
+    def model(self, model: Llama | None) -> None:
+        self.replicas = [ModelReplica(0, model)]
 
     @property
     def is_loaded(self) -> bool:
         return self._loaded
 
-    def load_model(self) -> None:
-        num_threads = settings.num_threads
-        if num_threads <= 0:
-            num_threads = max(1, os.cpu_count() // 2)
+    def load_model(self, model_path: str | None = None) -> None:
+        """Load the GGUF at ``model_path``, or the configured model file."""
+        batching = settings.batch_max_sequences > 0
+        n_replicas = 1 if batching else max(1, settings.model_replicas)
+        num_threads = thread_budget()
+
+        phase_start = time.perf_counter()
+        if model_path is None:
+            model_path = _resolve_model_file(
+                settings.model_repo, settings.model_filename, settings.model_path
+            )
+        self.model_path = model_path
+
+        speculative_mode = settings.speculative_mode
+        if batching and speculative_mode != "off":
+            logger.warning("Speculative decoding is not used with continuous batching")
+            speculative_mode = "off"
+        draft_path = None
+        if speculative_mode == "draft_model":
+            draft_path = _resolve_model_file(
+                settings.draft_model_repo,
+                settings.draft_model_filename,
+                settings.draft_model_path,
+            )
+        self.startup_phases["resolve_s"] = time.perf_counter() - phase_start
+
+        tuned: TuneResult | None = None
+        if settings.autotune:
+            phase_start = time.perf_counter()
+            tuned = load_or_tune(settings.autotune_cache_path, model_path, num_threads)
+            self.startup_phases["autotune_s"] = time.perf_counter() - phase_start
+
+        phase_start = time.perf_counter()
+        if settings.model_prefetch:
+            _prefetch_file(model_path)
+        replicas = []
+        for index, cores in enumerate(_core_slices(n_replicas)):
+            threads = min(num_threads, len(cores)) if cores else num_threads
+            threads_batch, n_batch = threads, _DEFAULT_N_BATCH
+            if tuned is not None:
+                threads_batch = min(tuned.n_threads_batch, threads)
+                threads = min(tuned.n_threads, threads)
+                n_batch = tuned.n_batch
+            logger.info(
+                "Loading replica %d with %d threads (%d for prefill), n_batch=%d, n_ctx=%d",
+                index,
+                threads,
+                threads_batch,
+                n_batch,
+                settings.n_ctx,
+            )
+            draft_llama = None
+            if draft_path is not None:
+                draft_llama = Llama(
+                    model_path=draft_path,
+                    n_ctx=settings.n_ctx,
+                    n_threads=threads,
+                    n_threads_batch=threads,
+                    use_mmap=settings.use_mmap,
+                    use_mlock=settings.use_mlock,
+                    verbose=False,
+                )
+            model = Llama(
+                model_path=model_path,
+                n_ctx=_TOKENIZER_ONLY_CTX if batching else settings.n_ctx,
+                n_batch=n_batch,
+                n_threads=threads,
+                n_threads_batch=threads_batch,
+                draft_model=create_draft_model(
+                    speculative_mode,
+                    settings.speculative_draft_tokens,
+                    settings.speculative_ngram_size,
+                    draft_llama,
+                ),
+                use_mmap=settings.use_mmap,
+                use_mlock=settings.use_mlock,
+                verbose=False,
+            )
+            replicas.append(ModelReplica(index, model, cores))
+        self.replicas = replicas
+
+        self._prefix_formatter = self._build_chat_formatter(add_generation_prompt=False)
+        self._prompt_formatter = self._build_chat_formatter(add_generation_prompt=True)
+        self._measure_template_overhead()
+        if settings.semantic_cache_max_entries > 0:
+            self.embedder = LlamaEmbedder(self.model)
+        if batching:
+            self._start_batch_engine(num_threads, tuned)
+        self.startup_phases["load_s"] = time.perf_counter() - phase_start
+
+        phase_start = time.perf_counter()
+        self._warm_up()
+        if not batching:
+            # The snapshot is restored into the other replicas on first use.
+            self._prefill_system_prefix(self.replicas[0], SYSTEM_PROMPT)
+        self.startup_phases["warmup_s"] = time.perf_counter() - phase_start
 
+        self._loaded = True
         logger.info(
-            "Downloading model: %s / %s",
-            settings.model_repo,
-            settings.model_filename,
-        )
-        model_path = hf_hub_download(
-            repo_id=settings.model_repo,
-            filename=settings.model_filename,
+            "Model ready (llama.cpp): resolve %.2fs, load %.2fs, warm-up %.2fs",
+            self.startup_phases["resolve_s"],
+            self.startup_phases["load_s"],
+            self.startup_phases["warmup_s"],
         )
 
-        logger.info("Loading model with %d threads, n_ctx=%d", num_threads, settings.n_ctx)
-        self.model = Llama(
-            model_path=model_path,
+    def unload(self) -> None:
+        """Free the model. Generations still running on it must finish first."""
+        self._loaded = False
+        if self.batch_engine is not None:
+            self.batch_engine.close()
+            self.batch_engine = None
+        if self.embedder is not None:
+            # Its context holds a reference to the weights.
+            self.embedder.close()
+            self.embedder = None
+        for replica in self.replicas:
+            with replica.lock:
+                if replica.model is not None:
+                    replica.model.close()
+        self.replicas = []
+        self._system_prefix = None
+        self._system_prefix_prompt = None
+        self.kv_cache.clear()
+
+    def _warm_up(self) -> None:
+        """Generate ``warmup_tokens`` tokens on every context before serving.
+
+        The first evaluation pays for page faults on the weights and for
+        building compute graphs; doing it here keeps that off the first
+        user's time to first token.
+        """
+        n_tokens = settings.warmup_tokens
+        if n_tokens <= 0:
+            return
+        tokens = self.model.tokenize(b"Hello", add_bos=True)
+        if self.batch_engine is not None:
+            finished = threading.Event()
+
+            def emit(kind: str, payload: object) -> None:
+                if kind != "token":
+                    finished.set()
+
+            self.batch_engine.submit(
+                BatchRequest(
+                    tokens=tokens,
+                    max_tokens=n_tokens,
+                    emit=emit,
+                    cancel=threading.Event(),
+                    deadline=time.monotonic() + settings.generation_timeout_s,
+                )
+            )
+            finished.wait(settings.generation_timeout_s)
+            return
+        for replica in self.replicas:
+            stream = replica.model.generate(tokens, temp=0.0)
+            try:
+                for i, _ in enumerate(stream):
+                    if i + 1 >= n_tokens:
+                        break
+            finally:
+                stream.close()
+            replica.model.reset()
+
+    def _start_batch_engine(self, num_threads: int, tuned: TuneResult | None = None) -> None:
+        if self._prompt_formatter is None:
+            raise RuntimeError("Continuous batching needs a model with a chat template")
+        engine = BatchEngine(
+            self.model,
+            max_sequences=settings.batch_max_sequences,
             n_ctx=settings.n_ctx,
-            n_threads=num_threads,
-            n_threads_batch=num_threads,
-            verbose=False,
+            sampling=SamplingParams(
+                temperature=settings.temperature,
+                top_p=settings.top_p,
+                repeat_penalty=settings.repetition_penalty,
+            ),
+            n_batch=tuned.n_batch if tuned else _DEFAULT_N_BATCH,
+            n_threads=min(tuned.n_threads, num_threads) if tuned else num_threads,
+            n_threads_batch=min(tuned.n_threads_batch, num_threads) if tuned else None,
+        )
+        engine.set_prefix(
+            self._render_tokens([{"role": "system", "content": SYSTEM_PROMPT}])
+        )
+        engine.start()
+        self.batch_engine = engine
+        logger.info(
+            "Continuous batching: up to %d sequences sharing n_ctx=%d",
+            settings.batch_max_sequences,
+            settings.n_ctx,
         )
-
-        self._loaded = True
-        logger.info("Model ready (llama.cpp)")
 
     def _truncate_history(
-        self, messages: list[dict[str, str]]
+        self,
+        messages: list[dict[str, str]],
+        token_counts: list[int | None] | None = None,
     ) -> list[dict[str, str]]:
+        """Keep the system turn plus as many recent turns as the context allows.
+
+        Once the model is loaded, the oldest turns are dropped until the
+        prompt fits the token budget left after reserving room for the
+        reply. A positive ``max_history_messages`` also caps the number of
+        messages.
+        ``token_counts`` lines up with ``messages``; missing counts are
+        tokenized here.
+        """
+        return self._select_history(messages, token_counts)[0]
+
+    def prompt_history(
+        self,
+        messages: list[dict[str, str]],
+        token_counts: list[int | None] | None = None,
+    ) -> list[dict[str, str]]:
+        """The messages :meth:`generate_stream_async` would put in the prompt."""
+        return self._truncate_history(messages, token_counts)
+
+    def _select_history(
+        self,
+        messages: list[dict[str, str]],
+        token_counts: list[int | None] | None = None,
+    ) -> tuple[list[dict[str, str]], int | None]:
+        """:meth:`_truncate_history`, plus the prompt's size in tokens.
+
+        The size is ``None`` until the model is loaded.
+        """
+        if token_counts is None:
+            token_counts = [None] * len(messages)
+        system_idx = [i for i, m in enumerate(messages) if m["role"] == "system"]
+        other_idx = [i for i, m in enumerate(messages) if m["role"] != "system"]
+
         limit = settings.max_history_messages
-        if len(messages) <= limit:
-            return messages
-        system_msgs = [m for m in messages if m["role"] == "system"]
-        other_msgs = [m for m in messages if m["role"] != "system"]
-        return system_msgs + other_msgs[-(limit - len(system_msgs)):]
+        if 0 < limit < len(messages):
+            keep = max(0, limit - len(system_idx))
+            other_idx = other_idx[len(other_idx) - keep:]
+
+        prompt_tokens = None
+        budget = self._history_token_budget()
+        if budget is not None:
+            used = sum(
+                self._message_tokens(messages[i], token_counts[i]) for i in system_idx
+            )
+            kept = 0
+            for i in reversed(other_idx):
+                n_tokens = self._message_tokens(messages[i], token_counts[i])
+                # Always keep the newest turn; the model can't answer without it.
+                if used + n_tokens > budget and kept:
+                    break
+                used += n_tokens
+                kept += 1
+            other_idx = other_idx[len(other_idx) - kept:]
+            prompt_tokens = used + self._generation_overhead
+
+        if len(system_idx) + len(other_idx) == len(messages):
+            return messages, prompt_tokens
+        return [messages[i] for i in system_idx + other_idx], prompt_tokens
+
+    def _history_token_budget(self) -> int | None:
+        if self.model is None:
+            return None
+        n_ctx = self.batch_engine.n_ctx if self.batch_engine else self.model.n_ctx()
+        return n_ctx - settings.max_new_tokens - self._generation_overhead
+
+    def _message_tokens(self, message: dict[str, str], cached: int | None) -> int:
+        if cached is not None:
+            return cached
+        return self.count_message_tokens(message["content"])
+
+    def count_message_tokens(self, content: str) -> int:
+        """Tokens a message occupies in the prompt, including its template framing."""
+        tokens = self.model.tokenize(content.encode("utf-8"), add_bos=False, special=False)
+        return len(tokens) + self._message_overhead
+
+    def _render_tokens(
+        self, messages: list[dict[str, str]], add_generation_prompt: bool = False
+    ) -> list[int]:
+        formatter = (
+            self._prompt_formatter if add_generation_prompt else self._prefix_formatter
+        )
+        rendered = formatter(messages=messages)
+        return self.model.tokenize(
+            rendered.prompt.encode("utf-8"),
+            add_bos=not rendered.added_special,
+            special=True,
+        )
+
+    def _measure_template_overhead(self) -> None:
+        """Measure the tokens the chat template adds around each message."""
+        if self._prefix_formatter is None:
+            return
+        probe = [
+            {"role": "system", "content": "x"},
+            {"role": "user", "content": "x"},
+        ]
+        system_only = self._render_tokens(probe[:1])
+        with_turn = self._render_tokens(probe)
+        with_prompt = self._render_tokens(probe, add_generation_prompt=True)
+        content = self.model.tokenize(b"x", add_bos=False, special=False)
+        self._message_overhead = len(with_turn) - len(system_only) - len(content)
+        self._generation_overhead = len(with_prompt) - len(with_turn)
+
+    def _build_chat_formatter(
+        self, add_generation_prompt: bool
+    ) -> Jinja2ChatFormatter | None:
+        template = self.model.metadata.get("tokenizer.chat_template")
+        if not template:
+            return None
+
+        def token_text(token_id: int) -> str:
+            if token_id == -1:
+                return ""
+            return self.model.detokenize([token_id], special=True).decode(
+                "utf-8", errors="ignore"
+            )
+
+        return Jinja2ChatFormatter(
+            template=template,
+            eos_token=token_text(self.model.token_eos()),
+            bos_token=token_text(self.model.token_bos()),
+            add_generation_prompt=add_generation_prompt,
+        )
+
+    def _prefill_system_prefix(self, replica: ModelReplica, system_prompt: str) -> None:
+        """Evaluate the rendered system turn once and keep its KV state.
+
+        Every prompt starts with the same system turn, so new conversations
+        restore this snapshot instead of prefilling those tokens again. The
+        snapshot is shared by all replicas.
+        """
+        if self._prefix_formatter is None:
+            return
+        start = time.perf_counter()
+        tokens = self._render_tokens([{"role": "system", "content": system_prompt}])
+        replica.model.reset()
+        replica.model.eval(tokens)
+        self._system_prefix = capture_snapshot(replica.model)
+        self._system_prefix_prompt = system_prompt
+        replica.resident_conversation = None
+        logger.info(
+            "Prefilled system prompt: %d tokens in %.2fs",
+            len(tokens),
+            time.perf_counter() - start,
+        )
+
+    def _restore_system_prefix(
+        self, replica: ModelReplica, messages: list[dict[str, str]]
+    ) -> None:
+        if not messages or messages[0]["role"] != "system":
+            return
+        if messages[0]["content"] != SYSTEM_PROMPT:
+            # Other system prompts, such as the summarizer's, are prefilled
+            # as part of their prompt and leave the shared snapshot alone.
+            return
+        if self._system_prefix is None or self._system_prefix_prompt != SYSTEM_PROMPT:
+            self._prefill_system_prefix(replica, SYSTEM_PROMPT)
+            return
+        prefix = self._system_prefix
+        model = replica.model
+        n_prefix = len(prefix.tokens)
+        if model.n_tokens >= n_prefix and np.array_equal(
+            model.input_ids[:n_prefix], prefix.tokens
+        ):
+            return
+        restore_snapshot(model, prefix)
+
+    def _prepare_context(
+        self,
+        replica: ModelReplica,
+        messages: list[dict[str, str]],
+        conversation_id: str | None,
+    ) -> None:
+        """Seed the model context so only the unseen part of the prompt is prefilled.
+
+        llama.cpp reuses the longest token prefix shared between the context
+        and the new prompt. Restoring the state left by this conversation's
+        previous reply skips re-evaluating the earlier history; failing that,
+        the shared system prompt state still skips the system turn.
+        """
+        if conversation_id is None:
+            # This prompt replaces whatever conversation the context held.
+            replica.resident_conversation = None
+        elif self.kv_cache.enabled:
+            if conversation_id == replica.resident_conversation:
+                self.kv_cache.record_hit()
+                return
+            self._evict_resident(conversation_id)
+            snapshot = self.kv_cache.get(conversation_id)
+            replica.resident_conversation = conversation_id
+            if snapshot is not None:
+                restore_snapshot(replica.model, snapshot)
+                return
+        self._restore_system_prefix(replica, messages)
+
+    def _evict_resident(self, conversation_id: str) -> None:
+        # A conversation moving to another replica leaves stale state behind.
+        for replica in self.replicas:
+            if replica.resident_conversation == conversation_id:
+                replica.resident_conversation = None
+
+    def _save_conversation_state(
+        self, replica: ModelReplica, conversation_id: str | None
+    ) -> None:
+        if conversation_id is None or not self.kv_cache.enabled:
+            return
+        self.kv_cache.put(conversation_id, capture_snapshot(replica.model))
+
+    def forget_conversation(self, conversation_id: str) -> None:
+        self.kv_cache.discard(conversation_id)
+        self._evict_resident(conversation_id)
+
+    def _pick_replica(self, conversation_id: str | None) -> ModelReplica:
+        """Route to the replica holding this conversation, else the least loaded.
+
+        The replica holding a conversation's KV state only wins while it is
+        no busier than any other; otherwise restoring the state from the
+        cache on an idle replica beats queueing behind another generation.
+        """
+        least_load = min(r.active for r in self.replicas)
+        if conversation_id is not None:
+            for replica in self.replicas:
+                if (
+                    replica.resident_conversation == conversation_id
+                    and replica.active == least_load
+                ):
+                    return replica
+        return min(self.replicas, key=lambda r: (r.active, r.last_used))
+
+    def replica_stats(self) -> list[dict[str, int | bool | list[int]]]:
+        return [replica.stats() for replica in self.replicas]
+
+    def _decode(
+        self,
+        replica: ModelReplica,
+        messages: list[dict[str, str]],
+        conversation_id: str | None,
+        deadline: float,
+        cancel: threading.Event,
+        emit: Callable[[str, object], None],
+        report: dict[str, object] | None = None,
+        max_tokens: int | None = None,
+        profile: RequestProfile | None = None,
+        prompt: list[int] | None = None,
+        preempt: Callable[[], bool] | None = None,
+        resume: threading.Event | None = None,
+        interrupt: Callable[[], bool] | None = None,
+    ) -> None:
+        """Run one generation on the calling thread, handing events to ``emit``.
+
+        Holding the model lock for the whole generation means a cancelled
+        request keeps the model until its in-flight token finishes, and the
+        next request waits at most that long instead of racing it. With
+        speculative decoding on, draft statistics are stored in ``report``
+        under ``"speculative"`` before the terminal event is emitted. With
+        a ``profile``, context restore, prefill and decode times are added
+        to it, and ``prompt`` (the rendered prompt tokens) gives the number
+        of tokens actually prefilled.
+
+        When ``preempt`` returns true after a token, the generation is
+        parked (see :meth:`_park`): a ``("paused", None)`` event is emitted
+        and decoding continues once ``resume`` is set. Time spent parked
+        does not count towards the deadline or the decode timings.
+
+        ``interrupt`` is polled between prefill batches and after every
+        token; once it returns true the generation ends as cancelled.
+        """
+        reason: str | None = None
+        error: BaseException | None = None
+        can_pause = preempt is not None and resume is not None
+        try:
+            if profile is not None:
+                profile.thread_ids.add(threading.get_ident())
+            replica.pin_current_thread()
+            with replica.lock, metered_drafts(replica.model) as draft_stats:
+                start = time.perf_counter()
+                first_token_at: float | None = None
+                n_tokens = 0
+                self._prepare_context(replica, messages, conversation_id)
+                stream_start = time.perf_counter()
+                if profile is not None:
+                    profile.add("context_restore", stream_start - start)
+                    if prompt is not None:
+                        profile.set(
+                            "prefill_tokens",
+                            len(prompt) - _reused_prefix(replica.model, prompt),
+                        )
+                if interrupt is not None and not self._prefill_interruptibly(
+                    replica, messages, interrupt
+                ):
+                    reason = "cancelled"
+                else:
+                    stream = replica.model.create_chat_completion(
+                        messages=messages,
+                        max_tokens=max_tokens or settings.max_new_tokens,
+                        temperature=settings.temperature,
+                        top_p=settings.top_p,
+                        repeat_penalty=settings.repetition_penalty,
+                        stream=True,
+                    )
+                    try:
+                        for chunk in stream:
+                            if cancel.is_set() or (interrupt is not None and interrupt()):
+                                reason = "cancelled"
+                                break
+                            content = chunk["choices"][0].get("delta", {}).get("content", "")
+                            if content:
+                                if first_token_at is None:
+                                    first_token_at = time.perf_counter()
+                                n_tokens += 1
+                                emit("token", content)
+                            if time.monotonic() >= deadline:
+                                reason = "deadline"
+                                break
+                            if can_pause and n_tokens and preempt():
+                                parked_s = self._park(replica, emit, resume)
+                                deadline += parked_s
+                                start += parked_s
+                                stream_start += parked_s
+                                if first_token_at is not None:
+                                    first_token_at += parked_s
+                                if cancel.is_set():
+                                    reason = "cancelled"
+                                    break
+                    finally:
+                        stream.close()
+                self._record_decode_timing(start, first_token_at, n_tokens)
+                if profile is not None and first_token_at is not None:
+                    profile.add("prefill", first_token_at - stream_start)
+                    profile.add("decode", time.perf_counter() - first_token_at)
+                if draft_stats is not None:
+                    metrics.draft_tokens.inc(draft_stats.drafted)
+                    metrics.draft_tokens_accepted.inc(draft_stats.accepted)
+                    if report is not None:
+                        report["speculative"] = draft_stats.as_dict()
+                # Every evaluated token is still consistent with the context,
+                # so a cut-short reply is as reusable as a finished one.
+                self._save_conversation_state(replica, conversation_id)
+        except BaseException as exc:
+            # The context may hold a half-evaluated prompt; don't treat it
+            # as this conversation's state on the next turn.
+            replica.resident_conversation = None
+            error = exc
+        finally:
+            # Before the terminal event, so the replica reads as idle by the
+            # time the consumer sees the generation end.
+            replica.finish()
+        if error is not None:
+            emit("error", error)
+        else:
+            emit("done", reason)
+
+    def _prefill_interruptibly(
+        self,
+        replica: ModelReplica,
+        messages: list[dict[str, str]],
+        interrupt: Callable[[], bool],
+    ) -> bool:
+        """Evaluate the prompt one batch at a time, stopping if ``interrupt()``.
+
+        Everything but the last prompt token is evaluated, so the completion
+        that follows finds it all in the context and only evaluates that
+        token. Returns ``False`` if interrupted.
+        """
+        model = replica.model
+        if self._prompt_formatter is None or not isinstance(model, Llama):
+            return not interrupt()
+        prompt = self._render_tokens(messages, add_generation_prompt=True)
+        reused = _reused_prefix(model, prompt)
+        model.n_tokens = reused
+        pending = prompt[reused:-1]
+        for offset in range(0, len(pending), model.n_batch):
+            if interrupt():
+                return False
+            model.eval(pending[offset:offset + model.n_batch])
+        return not interrupt()
+
+    @staticmethod
+    def _park(
+        replica: ModelReplica,
+        emit: Callable[[str, object], None],
+        resume: threading.Event,
+    ) -> float:
+        """Lend ``replica`` to other generations until ``resume`` is set.
+
+        Called from :meth:`_decode` with ``replica.lock`` held, between two
+        tokens of a streaming completion. The context state and the
+        sampler, which carries the repetition-penalty history, are saved
+        before the lock is released, and put back once it is held again,
+        so the paused stream continues exactly where it stopped. Returns
+        the seconds spent parked.
+        """
+        model = replica.model
+        snapshot = capture_snapshot(model) if isinstance(model, Llama) else None
+        sampler = getattr(model, "_sampler", None)
+        resident = replica.resident_conversation
+        parked_at = time.perf_counter()
+        replica.finish()
+        replica.lock.release()
+        try:
+            emit("paused", None)
+            resume.wait()
+            resume.clear()
+        finally:
+            replica.lock.acquire()
+            replica.begin()
+        if snapshot is not None:
+            restore_snapshot(model, snapshot)
+            model._sampler = sampler
+        replica.resident_conversation = resident
+        return time.perf_counter() - parked_at
+
+    @staticmethod
+    def _record_decode_timing(
+        start: float, first_token_at: float | None, n_tokens: int
+    ) -> None:
+        if first_token_at is None:
+            return
+        decode_s = time.perf_counter() - first_token_at
+        metrics.prefill_seconds.observe(first_token_at - start)
+        metrics.decode_seconds.observe(decode_s)
+        if n_tokens > 1 and decode_s > 0:
+            metrics.tokens_per_second.observe((n_tokens - 1) / decode_s)
 
     async def generate_stream_async(
-        self, messages: list[dict[str, str]]
+        self,
+        messages: list[dict[str, str]],
+        conversation_id: str | None = None,
+        token_counts: list[int | None] | None = None,
+        cancel: threading.Event | None = None,
+        flush_interval_s: float = 0.0,
+        flush_max_tokens: int = 1,
+        max_tokens: int | None = None,
+        ticket: GenerationTicket | None = None,
+        interrupt: Callable[[], bool] | None = None,
     ) -> AsyncGenerator[dict, None]:
+        """Stream token events, then a metadata event.
+
+        A dedicated thread decodes and hands tokens over in batches. Each
+        token event carries every token available when the loop picks the
+        batch up; with ``flush_interval_s`` set, later batches also wait up
+        to that long for ``flush_max_tokens`` tokens. The first token is
+        always sent as soon as it exists.
+
+        Decoding stops within one token of ``generation_timeout_s`` or of
+        ``cancel`` being set; closing this generator sets ``cancel`` too.
+        The metadata event's ``truncated`` field says why a reply was cut
+        short, or is ``None`` if it finished normally. ``max_tokens``
+        overrides ``max_new_tokens`` for this generation. ``interrupt`` is
+        polled from the decoding thread, during prefill as well as between
+        tokens, and cancels the generation once it returns true.
+
+        Given the caller's scheduler ``ticket``, a generation asked to yield
+        (see :meth:`GenerationTicket.should_yield`) is paused at a token
+        boundary and put back in the queue. ``queued`` events report its
+        position until it gets a slot again and carries on; the metadata
+        counts its ``preemptions`` and leaves the paused time out of
+        ``elapsed_s`` and ``tokens_per_s``. Continuous batching already
+        interleaves sequences, so it never pauses.
+
+        When the caller is profiling (see :mod:`app.services.profiling`),
+        history selection, prompt rendering, prefill and decode are timed
+        into its profile. Without batching, llama.cpp renders the prompt
+        itself, so it is rendered once more here only to time and count it.
+        """
         if not self._loaded:
             raise RuntimeError("Model is not loaded")
 
-        truncated = self._truncate_history(messages)
+        profile = current_profile.get()
+        select_start = time.perf_counter()
+        truncated, prompt_tokens = self._select_history(messages, token_counts)
+        prompt: list[int] | None = None
+        if profile is not None:
+            profile.add("select_history", time.perf_counter() - select_start)
+            with profile.phase("render"):
+                prompt = self._render_tokens(truncated, add_generation_prompt=True)
+            profile.set("prompt_tokens", len(prompt))
+        if len(truncated) < len(messages):
+            metrics.history_truncations.inc()
+        if prompt_tokens is not None:
+            metrics.prompt_tokens.observe(prompt_tokens)
         start = time.perf_counter()
+        deadline = time.monotonic() + settings.generation_timeout_s
         tokens_generated = 0
+        first_token_at: float | None = None
+        truncated_reason: str | None = None
+        report: dict[str, object] = {}
 
-        loop = asyncio.get_running_loop()
+        buffer = TokenBuffer(asyncio.get_running_loop())
+        cancel = cancel or threading.Event()
+        resume = threading.Event()
+        paused_s = 0.0
 
-        stream = self.model.create_chat_completion(
-            messages=truncated,
-            max_tokens=settings.max_new_tokens,
-            temperature=settings.temperature,
-            top_p=settings.top_p,
-            repeat_penalty=settings.repetition_penalty,
-            stream=True,
-        )
-        stream_iter = iter(stream)
+        def emit(kind: str, payload: object) -> None:
+            try:
+                buffer.put(kind, payload)
+            except RuntimeError:
+                cancel.set()  # the event loop is gone; stop decoding
 
-        while True:
-            chunk = await loop.run_in_executor(
-                None, next, stream_iter, _SENTINEL
+        if self.batch_engine is not None:
+            if prompt is None:
+                prompt = self._render_tokens(truncated, add_generation_prompt=True)
+            if profile is not None:
+                profile.thread_ids.add(self.batch_engine.thread_id)
+                profile.set(
+                    "prefill_tokens", len(prompt) - self.batch_engine.shared_prefix_len(prompt)
+                )
+            self.batch_engine.submit(
+                BatchRequest(
+                    tokens=prompt,
+                    max_tokens=max_tokens or settings.max_new_tokens,
+                    emit=emit,
+                    cancel=cancel,
+                    deadline=deadline,
+                )
             )
-            if chunk is _SENTINEL:
-                break
+        else:
+            replica = self._pick_replica(conversation_id)
+            replica.begin()
+            preempt = None
+            if ticket is not None and self.scheduler.time_slice_s > 0:
+                preempt = ticket.should_yield
+            threading.Thread(
+                target=self._decode,
+                args=(
+                    replica,
+                    truncated,
+                    conversation_id,
+                    deadline,
+                    cancel,
+                    emit,
+                    report,
+                    max_tokens,
+                    profile,
+                    prompt,
+                    preempt,
+                    resume,
+                    interrupt,
+                ),
+                name="decode",
+                daemon=True,
+            ).start()
 
-            delta = chunk["choices"][0].get("delta", {})
-            content = delta.get("content", "")
-            if content:
-                tokens_generated += 1
-                yield {"event": "token", "data": content}
+        outcome = "error"
+        self.generations_in_flight += 1
+        try:
+            finished = False
+            while not finished:
+                max_delay = flush_interval_s if tokens_generated else 0.0
+                texts: list[str] = []
+                paused = False
+                for kind, payload in await buffer.get_batch(flush_max_tokens, max_delay):
+                    if kind == "token":
+                        texts.append(payload)
+                    elif kind == "error":
+                        raise payload
+                    elif kind == "paused":
+                        paused = True
+                    else:
+                        truncated_reason = payload
+                        finished = True
+                if texts:
+                    if not tokens_generated:
+                        first_token_at = time.perf_counter()
+                        metrics.time_to_first_token.observe(first_token_at - start)
+                    tokens_generated += len(texts)
+                    metrics.tokens_generated.inc(len(texts))
+                    yield {"event": "token", "data": "".join(texts)}
+                if paused and ticket is not None:
+                    paused_at = time.perf_counter()
+                    ticket.requeue()
+                    async for position in ticket.wait():
+                        yield {"event": "queued", "data": {"position": position}}
+                    resume.set()
+                    paused_s += time.perf_counter() - paused_at
+                    if profile is not None:
+                        profile.add("queue", time.perf_counter() - paused_at)
+            outcome = truncated_reason or "completed"
+        except (GeneratorExit, asyncio.CancelledError):
+            outcome = "cancelled"
+            raise
+        finally:
+            cancel.set()
+            # A parked decode thread wakes up, sees the cancel and finishes.
+            resume.set()
+            self.generations_in_flight -= 1
+            metrics.generations.labels(outcome).inc()
 
-        elapsed = time.perf_counter() - start
+        end = time.perf_counter()
+        if first_token_at is not None:
+            # Only generations past their first token are paused.
+            first_token_at += paused_s
+        elapsed = end - start - paused_s
         self._enforce_budget(elapsed, tokens_generated)
+        if profile is not None:
+            if self.batch_engine is not None and first_token_at is not None:
+                # Includes waiting for a batch slot; the engine interleaves
+                # sequences, so this is wall time, not compute time.
+                profile.add("prefill", first_token_at - start)
+                profile.add("decode", end - first_token_at)
+            _set_token_rates(profile, tokens_generated)
 
-        yield {
-            "event": "metadata",
-            "data": {
-                "tokens_generated": tokens_generated,
-                "elapsed_s": round(elapsed, 2),
-            },
+        # Effective rate after the first token, so speculation's effect on
+        # decode is not diluted by prefill time.
+        tokens_per_s = None
+        if first_token_at is not None and tokens_generated > 1 and end > first_token_at:
+            tokens_per_s = round((tokens_generated - 1) / (end - first_token_at), 1)
+        data = {
+            "tokens_generated": tokens_generated,
+            "elapsed_s": round(elapsed, 2),
+            "tokens_per_s": tokens_per_s,
+            "truncated": truncated_reason,
         }
+        if "speculative" in report:
+            data["speculative"] = report["speculative"]
+        if ticket is not None and ticket.preemptions:
+            data["preemptions"] = ticket.preemptions
+        yield {"event": "metadata", "data": data}
 
     def _enforce_budget(self, elapsed: float, tokens_generated: int) -> None:
         if elapsed > settings.generation_timeout_s:
@@ -120,3 +1251,26 @@ class ModelService:
 
 
 model_service = ModelService()
+
+for _phase in ("resolve", "autotune", "load", "warmup"):
+    metrics.registry.register(
+        metrics.Gauge(
+            f"chat_startup_{_phase}_seconds",
+            f"Time the last model load spent in the {_phase} phase.",
+            lambda key=f"{_phase}_s": model_service.startup_phases.get(key, 0.0),
+        )
+    )
+metrics.registry.register(
+    metrics.Gauge(
+        "chat_generations_in_flight",
+        "Requests holding a generation slot.",
+        lambda: model_service.scheduler.active_count,
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "chat_requests_queued",
+        "Requests waiting for a generation slot.",
+        lambda: model_service.scheduler.queued_count,
+    )
+)
@@ -0,0 +1,171 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from app.config import settings
+
+# The profile of the request being handled, if profiling is on. Set by the
+# chat router for the task streaming a reply; code running on other threads
+# gets the profile passed in explicitly.
+current_profile: ContextVar["RequestProfile | None"] = ContextVar(
+    "current_profile", default=None
+)
+
+
+class RequestProfile:
+    """Wall-clock breakdown of one chat request.
+
+    ``phases`` accumulates seconds per named phase; ``values`` holds derived
+    figures such as token counts and rates. ``thread_ids`` lists the threads
+    that worked on the request, for :class:`StackSampler`.
+    """
+
+    def __init__(self, conversation_id: str) -> None:
+        self.conversation_id = conversation_id
+        self.started_at = time.time()
+        self.phases: dict[str, float] = {}
+        self.values: dict[str, float | int | None] = {}
+        self.thread_ids: set[int] = set()
+        self.stacks: str | None = None
+        self._start = time.perf_counter()
+        self._end: float | None = None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def set(self, name: str, value: float | int | None) -> None:
+        self.values[name] = value
+
+    def since_start(self) -> float:
+        return time.perf_counter() - self._start
+
+    def finish(self) -> None:
+        if self._end is None:
+            self._end = time.perf_counter()
+
+    @property
+    def total_s(self) -> float:
+        return (self._end or time.perf_counter()) - self._start
+
+    def as_dict(self) -> dict[str, object]:
+        return {
+            "total_s": round(self.total_s, 4),
+            "phases": {name: round(s, 4) for name, s in self.phases.items()},
+            **{
+                name: round(v, 4) if isinstance(v, float) else v
+                for name, v in self.values.items()
+            },
+        }
+
+
+@contextmanager
+def profiled(name: str) -> Iterator[None]:
+    """Time the block as phase ``name`` of the current request's profile, if any."""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.phase(name):
+        yield
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None and len(names) < 64:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """Sample the stacks of a set of threads on a timer thread.
+
+    ``thread_ids`` is read on every tick, so threads added while sampling
+    runs are picked up. :meth:`stop` returns the samples in folded-stack
+    format (``frame;frame;frame count`` per line), which flame graph tools
+    read directly. The event loop thread also runs other requests, whose
+    frames show up in its samples.
+    """
+
+    def __init__(self, thread_ids: set[int], interval_s: float = 0.005) -> None:
+        self.thread_ids = thread_ids
+        self.interval_s = interval_s
+        self.counts: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frames = sys._current_frames()
+            for thread_id in list(self.thread_ids):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.counts[_fold(frame)] += 1
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return "\n".join(f"{stack} {n}" for stack, n in self.counts.most_common())
+
+
+class ProfileLog:
+    """Profiles of the most recent requests, plus armed and finished captures.
+
+    ``slowest`` ranks the last ``max_recent`` finished requests by total
+    time. A capture armed for a conversation samples the stacks of that
+    conversation's next request; the last ``max_captures`` are kept.
+    """
+
+    def __init__(self, max_recent: int, max_captures: int = 5) -> None:
+        self._recent: deque[RequestProfile] = deque(maxlen=max(1, max_recent))
+        self._captures: deque[RequestProfile] = deque(maxlen=max(1, max_captures))
+        self._armed: set[str] = set()
+        self._lock = threading.Lock()
+
+    def record(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._recent.append(profile)
+            if profile.stacks is not None:
+                self._captures.append(profile)
+
+    def slowest(self, limit: int) -> list[RequestProfile]:
+        with self._lock:
+            recent = list(self._recent)
+        return sorted(recent, key=lambda p: p.total_s, reverse=True)[:limit]
+
+    def captures(self) -> list[RequestProfile]:
+        with self._lock:
+            return list(self._captures)
+
+    def arm_capture(self, conversation_id: str) -> None:
+        with self._lock:
+            self._armed.add(conversation_id)
+
+    def take_capture(self, conversation_id: str) -> bool:
+        """Whether a capture is armed for this conversation; disarms it."""
+        with self._lock:
+            if conversation_id in self._armed:
+                self._armed.discard(conversation_id)
+                return True
+            return False
+
+
+profile_log = ProfileLog(max_recent=settings.profile_recent_requests)
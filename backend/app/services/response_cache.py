@@ -0,0 +1,299 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+
+from app.config import settings
+
+
+@dataclass
+class CachedResponse:
+    """A finished reply as it was streamed: its token chunks and metadata."""
+
+    chunks: list[str]
+    metadata: dict
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+
+@dataclass
+class CacheLookup:
+    """The keys computed for one request, reused to store its reply on a miss."""
+
+    key: str
+    scope: str
+    question: str | None
+    model: str = ""
+    vector: np.ndarray | None = None
+    hit: CachedResponse | None = None
+    tier: str | None = None
+
+
+class ExactCache:
+    """TTL + LRU map from a prompt hash to a :class:`CachedResponse`."""
+
+    def __init__(self, max_entries: int, ttl_s: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: OrderedDict[str, tuple[float, CachedResponse]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> CachedResponse | None:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, response = item
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def put(self, key: str, response: CachedResponse) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_s, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SemanticIndex:
+    """Fixed-size matrix of unit vectors searched with one matrix-vector product.
+
+    Rows carry an expiry time, a last-used time and a scope hash; a search
+    only considers live rows in the query's scope. A new entry takes an
+    expired row if there is one, else the least recently used.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float, threshold: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.threshold = threshold
+        self._vectors: np.ndarray | None = None
+        self._expires = np.full(max_entries, -np.inf)
+        self._last_used = np.zeros(max_entries)
+        self._scopes: list[str | None] = [None] * max_entries
+        self._values: list[CachedResponse | None] = [None] * max_entries
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._expires > time.monotonic()))
+
+    def search(self, vector: np.ndarray, scope: str) -> tuple[CachedResponse, float] | None:
+        with self._lock:
+            if self._vectors is None:
+                return None
+            now = time.monotonic()
+            scores = self._vectors @ vector
+            live = self._expires > now
+            live &= np.fromiter((s == scope for s in self._scopes), bool, self.max_entries)
+            scores[~live] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            self._last_used[best] = now
+            return self._values[best], float(scores[best])
+
+    def add(self, vector: np.ndarray, scope: str, response: CachedResponse) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            now = time.monotonic()
+            expired = np.flatnonzero(self._expires <= now)
+            row = int(expired[0]) if len(expired) else int(np.argmin(self._last_used))
+            self._vectors[row] = vector
+            self._expires[row] = now + self.ttl_s
+            self._last_used[row] = now
+            self._scopes[row] = scope
+            self._values[row] = response
+
+
+class LlamaEmbedder:
+    """Mean-pooled embeddings from the loaded model's weights.
+
+    Runs in a small context of its own with embeddings switched on, so it
+    never disturbs the KV state of the contexts that generate replies.
+    """
+
+    def __init__(self, model: Llama, n_ctx: int = 512) -> None:
+        self.model = model
+        self.n_ctx = n_ctx
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_ctx
+        params.n_ubatch = n_ctx
+        params.embeddings = True
+        params.pooling_type = llama_cpp.LLAMA_POOLING_TYPE_MEAN
+        self._context = internals.LlamaContext(model=model._model, params=params, verbose=False)
+        self._n_embd = model.n_embd()
+        self._batch = llama_cpp.llama_batch_init(n_ctx, 0, 1)
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> np.ndarray:
+        """Return the unit-length embedding of ``text`` (truncated to ``n_ctx``)."""
+        tokens = self.model.tokenize(text.encode("utf-8"), add_bos=False)[: self.n_ctx]
+        with self._lock:
+            ctx = self._context.ctx
+            llama_cpp.llama_kv_cache_clear(ctx)
+            batch = self._batch
+            batch.n_tokens = len(tokens)
+            for i, token in enumerate(tokens):
+                batch.token[i] = token
+                batch.pos[i] = i
+                batch.n_seq_id[i] = 1
+                batch.seq_id[i][0] = 0
+                batch.logits[i] = True
+            if llama_cpp.llama_decode(ctx, batch) != 0:
+                raise RuntimeError("Failed to compute embedding")
+            pointer = llama_cpp.llama_get_embeddings_seq(ctx, 0)
+            vector = np.ctypeslib.as_array(pointer, shape=(self._n_embd,)).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def close(self) -> None:
+        with self._lock:
+            llama_cpp.llama_batch_free(self._batch)
+            self._context.close()
+
+
+def _digest(payload: object) -> str:
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def _sampling_settings(model: str) -> dict[str, object]:
+    return {
+        "model": model,
+        "temperature": settings.temperature,
+        "top_p": settings.top_p,
+        "repetition_penalty": settings.repetition_penalty,
+        "max_new_tokens": settings.max_new_tokens,
+    }
+
+
+class ResponseCache:
+    """Replies to prompts seen before, matched exactly or by meaning.
+
+    The exact tier keys on the whole (truncated) prompt plus the model
+    and sampling settings. The semantic tier only covers first turns, a
+    system prompt and one user message: it compares the embedding of that
+    message with earlier first turns under the same system prompt and
+    settings, and serves the closest one at or above ``semantic_threshold``
+    cosine similarity. Each model gets a semantic index of its own, since
+    embeddings from different models are not comparable.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_s: float,
+        semantic_max_entries: int = 0,
+        semantic_threshold: float = 0.95,
+    ) -> None:
+        self.exact = ExactCache(max_entries, ttl_s)
+        self.ttl_s = ttl_s
+        self.semantic_max_entries = semantic_max_entries
+        self.semantic_threshold = semantic_threshold
+        self._semantic: dict[str, SemanticIndex] = {}
+        self.hits: dict[str, int] = {"exact": 0, "semantic": 0}
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.exact.max_entries > 0 or self.semantic_max_entries > 0
+
+    def semantic(self, model: str) -> SemanticIndex:
+        """The semantic index for replies generated by ``model``."""
+        index = self._semantic.get(model)
+        if index is None:
+            index = self._semantic[model] = SemanticIndex(
+                self.semantic_max_entries, self.ttl_s, self.semantic_threshold
+            )
+        return index
+
+    async def lookup(
+        self,
+        history: list[dict[str, str]],
+        embed: Callable[[str], np.ndarray] | None = None,
+        model: str | None = None,
+    ) -> CacheLookup:
+        """Look ``history`` up among replies generated by ``model``.
+
+        ``model`` defaults to the configured model's id.
+        """
+        if model is None:
+            model = f"{settings.model_repo}/{settings.model_filename}"
+        sampling = _sampling_settings(model)
+        system = [m for m in history if m["role"] == "system"]
+        turns = [m for m in history if m["role"] != "system"]
+        first_turn = len(turns) == 1 and turns[0]["role"] == "user"
+        lookup = CacheLookup(
+            key=_digest({"history": history, "sampling": sampling}),
+            scope=_digest({"system": system, "sampling": sampling}),
+            question=turns[0]["content"] if first_turn else None,
+            model=model,
+        )
+        lookup.hit = self.exact.get(lookup.key)
+        if lookup.hit is not None:
+            lookup.tier = "exact"
+        elif self._semantic_applies(lookup, embed):
+            lookup.vector = await asyncio.to_thread(embed, lookup.question)
+            found = self.semantic(model).search(lookup.vector, lookup.scope)
+            if found is not None:
+                lookup.hit, lookup.tier = found[0], "semantic"
+        if lookup.tier is None:
+            self.misses += 1
+        else:
+            self.hits[lookup.tier] += 1
+        return lookup
+
+    def store(self, lookup: CacheLookup, response: CachedResponse) -> None:
+        self.exact.put(lookup.key, response)
+        if lookup.vector is not None:
+            self.semantic(lookup.model).add(lookup.vector, lookup.scope, response)
+
+    def _semantic_applies(
+        self, lookup: CacheLookup, embed: Callable[[str], np.ndarray] | None
+    ) -> bool:
+        return (
+            embed is not None
+            and lookup.question is not None
+            and self.semantic_max_entries > 0
+        )
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "exact_entries": len(self.exact),
+            "semantic_entries": sum(len(index) for index in self._semantic.values()),
+            "exact_hits": self.hits["exact"],
+            "semantic_hits": self.hits["semantic"],
+            "misses": self.misses,
+        }
+
+
+response_cache = ResponseCache(
+    max_entries=settings.response_cache_max_entries,
+    ttl_s=settings.response_cache_ttl_s,
+    semantic_max_entries=settings.semantic_cache_max_entries,
+    semantic_threshold=settings.semantic_cache_threshold,
+)
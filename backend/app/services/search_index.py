@@ -0,0 +1,179 @@
+import bisect
+import heapq
+import math
+import re
+from array import array
+from typing import Iterator
+
+_TOKEN = re.compile(r"\w+")
+
+# BM25 parameters, the same defaults SQLite FTS5 uses.
+_K1 = 1.2
+_B = 0.75
+
+# Deleted messages stay in the posting lists until they outnumber live ones.
+_MIN_COMPACT = 1024
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased runs of letters, digits and underscores."""
+    return _TOKEN.findall(text.lower())
+
+
+def fts_query(text: str) -> str:
+    """An FTS5 ``MATCH`` expression for all of ``text``'s terms.
+
+    Every term is quoted, so operators and punctuation in user input are
+    searched for literally instead of parsed.
+    """
+    return " ".join(f'"{term}"' for term in dict.fromkeys(tokenize(text)))
+
+
+def snippet(content: str, terms: list[str], width: int = 160) -> str:
+    """About ``width`` characters of ``content`` around the first matching term."""
+    if len(content) <= width:
+        return content
+    pattern = "|".join(re.escape(term) for term in terms)
+    match = re.search(rf"\b(?:{pattern})\b", content, re.IGNORECASE) if terms else None
+    center = match.start() if match else 0
+    start = max(0, min(center - width // 3, len(content) - width))
+    end = start + width
+    # Widen to word boundaries so no word is cut in half.
+    while start > 0 and not content[start - 1].isspace():
+        start -= 1
+    while end < len(content) and not content[end].isspace():
+        end += 1
+    text = content[start:end].strip()
+    return ("…" if start > 0 else "") + text + ("…" if end < len(content) else "")
+
+
+class InvertedIndex:
+    """Term → messages index over every stored message, ranked with BM25.
+
+    Each message is a document numbered in insertion order, so posting
+    lists are ``array`` columns of ascending document numbers with their
+    term frequencies beside them, about 6 bytes per posting. A query
+    matches messages containing every term: it walks the shortest posting
+    list and looks the others up by bisection, then keeps the best
+    ``limit`` scores. Deleting a conversation only marks its documents;
+    the posting lists are compacted once dead documents outnumber live
+    ones.
+    """
+
+    def __init__(self) -> None:
+        self._postings: dict[str, tuple[array, array]] = {}
+        self._doc_conversation: list[str | None] = []
+        self._doc_position = array("I")
+        self._doc_length = array("I")
+        self._conversation_docs: dict[str, array] = {}
+        self._live = 0
+        self._dead = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return self._live
+
+    def add(self, conversation_id: str, position: int, content: str) -> None:
+        """Index message ``position`` of ``conversation_id``."""
+        terms = tokenize(content)
+        doc = len(self._doc_conversation)
+        self._doc_conversation.append(conversation_id)
+        self._doc_position.append(position)
+        self._doc_length.append(len(terms))
+        self._conversation_docs.setdefault(conversation_id, array("I")).append(doc)
+        self._live += 1
+        self._total_length += len(terms)
+        counts: dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = (array("I"), array("H"))
+            posting[0].append(doc)
+            posting[1].append(min(count, 0xFFFF))
+
+    def remove_conversation(self, conversation_id: str) -> None:
+        docs = self._conversation_docs.pop(conversation_id, None)
+        if docs is None:
+            return
+        for doc in docs:
+            self._doc_conversation[doc] = None
+            self._total_length -= self._doc_length[doc]
+        self._live -= len(docs)
+        self._dead += len(docs)
+        if self._dead >= _MIN_COMPACT and self._dead > self._live:
+            self._compact()
+
+    def _compact(self) -> None:
+        alive = self._doc_conversation
+        for term in list(self._postings):
+            docs, freqs = self._postings[term]
+            kept = [(d, f) for d, f in zip(docs, freqs) if alive[d] is not None]
+            if not kept:
+                del self._postings[term]
+                continue
+            self._postings[term] = (
+                array("I", (d for d, _ in kept)),
+                array("H", (f for _, f in kept)),
+            )
+        self._dead = 0
+
+    def search(self, query: str, limit: int = 20) -> list[tuple[str, int, float]]:
+        """Best ``(conversation_id, position, score)`` matches, highest score first."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        postings = [self._postings.get(term) for term in terms]
+        if not terms or any(p is None for p in postings) or not self._live:
+            return []
+        postings.sort(key=lambda p: len(p[0]))
+        n_docs = self._live + self._dead
+        average_length = self._total_length / self._live or 1.0
+        idf = [
+            math.log((n_docs - len(p[0]) + 0.5) / (len(p[0]) + 0.5) + 1.0)
+            for p in postings
+        ]
+        alive = self._doc_conversation
+        lengths = self._doc_length
+        # BM25's length normalization, k1 * (1 - b + b * length / average).
+        norm_base = _K1 * (1 - _B)
+        norm_per_token = _K1 * _B / average_length
+
+        if len(postings) == 1:
+            # Single words are the common case and can be scored in one pass.
+            docs, freqs = postings[0]
+            weight = idf[0] * (_K1 + 1)
+            scored = (
+                (weight * f / (f + norm_base + norm_per_token * lengths[doc]), doc)
+                for doc, f in zip(docs, freqs)
+                if alive[doc] is not None
+            )
+        else:
+            scored = self._score_all(postings, idf, norm_base, norm_per_token)
+
+        best = heapq.nlargest(limit, scored)
+        return [(alive[doc], self._doc_position[doc], score) for score, doc in best]
+
+    def _score_all(
+        self,
+        postings: list[tuple[array, array]],
+        idf: list[float],
+        norm_base: float,
+        norm_per_token: float,
+    ) -> Iterator[tuple[float, int]]:
+        """``(score, doc)`` for documents in every posting list, shortest list first."""
+        alive = self._doc_conversation
+        lengths = self._doc_length
+        head_docs, head_freqs = postings[0]
+        rest = postings[1:]
+        for doc, head_freq in zip(head_docs, head_freqs):
+            if alive[doc] is None:
+                continue
+            freqs = [head_freq]
+            for docs, term_freqs in rest:
+                j = bisect.bisect_left(docs, doc)
+                if j == len(docs) or docs[j] != doc:
+                    break
+                freqs.append(term_freqs[j])
+            else:
+                norm = norm_base + norm_per_token * lengths[doc]
+                yield sum(w * f * (_K1 + 1) / (f + norm) for w, f in zip(idf, freqs)), doc
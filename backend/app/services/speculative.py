@@ -0,0 +1,161 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+SPECULATIVE_MODES = ("off", "prompt_lookup", "draft_model")
+
+
+@dataclass
+class DraftStats:
+    """Draft tokens proposed and accepted during one generation.
+
+    ``Llama.generate`` calls the draft model with every token accepted so
+    far plus the newly sampled one. The previous draft was appended right
+    after the input of the previous call, so the accepted part of it is the
+    prefix that reappears there, short of the final, freshly sampled token.
+    """
+
+    mode: str
+    drafted: int = 0
+    accepted: int = 0
+    _last_input_len: int = field(default=0, repr=False)
+    _last_draft: npt.NDArray[np.intc] = field(
+        default_factory=lambda: np.array([], dtype=np.intc), repr=False
+    )
+
+    @property
+    def acceptance_rate(self) -> float | None:
+        if not self.drafted:
+            return None
+        return self.accepted / self.drafted
+
+    def record(self, input_ids: npt.NDArray[np.intc], draft: npt.NDArray[np.intc]) -> None:
+        """Settle the previous draft against ``input_ids`` and count ``draft``."""
+        previous = self._last_draft
+        if len(previous):
+            resolved = input_ids[self._last_input_len:len(input_ids) - 1]
+            n = min(len(previous), len(resolved))
+            matches = np.asarray(resolved[:n]) == np.asarray(previous[:n])
+            self.accepted += n if matches.all() else int(np.argmin(matches))
+        self._last_input_len = len(input_ids)
+        self._last_draft = draft
+        self.drafted += len(draft)
+
+    def as_dict(self) -> dict[str, object]:
+        rate = self.acceptance_rate
+        return {
+            "mode": self.mode,
+            "drafted": self.drafted,
+            "accepted": self.accepted,
+            "acceptance_rate": None if rate is None else round(rate, 3),
+        }
+
+
+class MeteredDraftModel(LlamaDraftModel):
+    """Wrap a draft model and count how many of its tokens the target keeps.
+
+    The counts live in the :class:`DraftStats` passed to each call, never on
+    the wrapper, so one generation cannot reset or add to another's.
+    """
+
+    def __init__(self, inner: LlamaDraftModel, mode: str) -> None:
+        self.inner = inner
+        self.mode = mode
+
+    def __call__(
+        self,
+        input_ids: npt.NDArray[np.intc],
+        /,
+        stats: DraftStats | None = None,
+        **kwargs,
+    ) -> npt.NDArray[np.intc]:
+        draft = self.inner(input_ids, **kwargs)
+        if stats is not None:
+            stats.record(input_ids, draft)
+        return draft
+
+
+class _GenerationDraft(LlamaDraftModel):
+    """A metered draft model bound to the stats of one generation."""
+
+    def __init__(self, metered: MeteredDraftModel, stats: DraftStats) -> None:
+        self.metered = metered
+        self.stats = stats
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        return self.metered(input_ids, stats=self.stats, **kwargs)
+
+
+@contextmanager
+def metered_drafts(model: Llama) -> Iterator[DraftStats | None]:
+    """Count the drafts ``model`` requests until exit, in fresh stats.
+
+    Yields ``None`` when ``model`` has no metered draft model. The caller
+    must hold the model exclusively for the duration.
+    """
+    draft = getattr(model, "draft_model", None)
+    if not isinstance(draft, MeteredDraftModel):
+        yield None
+        return
+    stats = DraftStats(draft.mode)
+    model.draft_model = _GenerationDraft(draft, stats)
+    try:
+        yield stats
+    finally:
+        model.draft_model = draft
+
+
+class LlamaModelDraft(LlamaDraftModel):
+    """Draft greedily with a smaller GGUF model sharing the target's vocabulary.
+
+    The draft keeps its own context and reuses the longest prefix it has
+    already evaluated, so each call only feeds the tokens since the last.
+    """
+
+    def __init__(self, model: Llama, num_pred_tokens: int = 10) -> None:
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        room = self.model.n_ctx() - len(input_ids)
+        limit = min(self.num_pred_tokens, room)
+        if limit <= 0:
+            return np.array([], dtype=np.intc)
+        draft: list[int] = []
+        eos = self.model.token_eos()
+        for token in self.model.generate(input_ids.tolist(), temp=0.0, reset=True):
+            if token == eos:
+                break
+            draft.append(token)
+            if len(draft) >= limit:
+                break
+        return np.array(draft, dtype=np.intc)
+
+
+def create_draft_model(
+    mode: str,
+    num_pred_tokens: int,
+    max_ngram_size: int = 2,
+    draft_llama: Llama | None = None,
+) -> MeteredDraftModel | None:
+    """Build the draft model for ``mode``, or ``None`` when speculation is off."""
+    if mode == "off":
+        return None
+    if mode == "prompt_lookup":
+        inner: LlamaDraftModel = LlamaPromptLookupDecoding(
+            max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens
+        )
+    elif mode == "draft_model":
+        if draft_llama is None:
+            raise ValueError("speculative mode 'draft_model' needs a draft GGUF model")
+        inner = LlamaModelDraft(draft_llama, num_pred_tokens)
+    else:
+        raise ValueError(
+            f"Unknown speculative mode {mode!r}; expected one of {SPECULATIVE_MODES}"
+        )
+    return MeteredDraftModel(inner, mode)
@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator, Callable
+
+
+_TERMINAL = ("done", "error")
+
+
+class TokenBuffer:
+    """Hands events from a decode thread to the event loop in batches.
+
+    The decode thread appends under a lock and only schedules a loop wakeup
+    when the consumer is actually waiting for more, so a burst of tokens
+    costs one wakeup instead of one per token. Any event other than
+    ``"token"`` always wakes the consumer; ``"done"`` and ``"error"`` are
+    terminal.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._items: list[tuple[str, object]] = []
+        self._ready = asyncio.Event()
+        self._armed = False
+        self._threshold = 1
+        self._finished = False
+        self.wakeups = 0
+
+    def put(self, kind: str, payload: object) -> None:
+        """Called from the decode thread."""
+        with self._lock:
+            self._items.append((kind, payload))
+            if kind in _TERMINAL:
+                self._finished = True
+            if not self._armed:
+                return
+            if len(self._items) < self._threshold and kind == "token":
+                return
+            self._armed = False
+            self.wakeups += 1
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def get_batch(
+        self, max_items: int = 1, max_delay: float = 0.0
+    ) -> list[tuple[str, object]]:
+        """Wait for at least one event and return everything buffered.
+
+        With ``max_delay`` set, keep collecting for up to that long after the
+        first event, or until ``max_items`` events are buffered. Returns an
+        empty list only once the terminal event has already been taken.
+        """
+        while True:
+            await self._wait(threshold=1, timeout=None)
+            if max_delay > 0:
+                await self._wait(threshold=max_items, timeout=max_delay)
+            with self._lock:
+                items, self._items = self._items, []
+                finished = self._finished
+            if items or finished:
+                return items
+
+    async def _wait(self, threshold: int, timeout: float | None) -> None:
+        with self._lock:
+            if len(self._items) >= threshold or self._finished:
+                return
+            self._threshold = threshold
+            self._ready.clear()
+            self._armed = True
+        try:
+            if timeout is None:
+                await self._ready.wait()
+            else:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._armed = False
+
+
+class SharedStream:
+    """Runs one async event stream and fans it out to any number of subscribers.
+
+    The source runs in its own task, so it does not belong to any one
+    client. Events are numbered from 0 and the last ``max_events`` are kept,
+    so a subscriber can start after any event still in that window: late
+    joiners replay from the start, reconnecting clients from their last
+    event id, and both then follow live. Once the last subscriber leaves
+    before the source has finished, the source is cancelled after
+    ``idle_grace_s``, unless someone subscribes again first.
+
+    ``on_write`` is called with the seconds each subscriber spent handing
+    an event to its client, i.e. suspended at a ``yield``.
+    """
+
+    def __init__(
+        self,
+        source: AsyncIterator[dict],
+        idle_grace_s: float = 0.0,
+        max_events: int | None = None,
+        on_write: Callable[[float], None] | None = None,
+    ) -> None:
+        self.stream_id = uuid.uuid4().hex
+        self.idle_grace_s = idle_grace_s
+        self.on_write = on_write
+        self._events: deque[dict] = deque(maxlen=max_events)
+        self._next_index = 0
+        self._finished = False
+        self._changed = asyncio.Event()
+        self._idle_timer: asyncio.TimerHandle | None = None
+        self.subscribers = 0
+        self.cancelled = False
+        self._task = asyncio.ensure_future(self._pump(source))
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    @property
+    def first_index(self) -> int:
+        """Number of the oldest event still available for replay."""
+        return self._next_index - len(self._events)
+
+    def can_resume_after(self, last_event_id: int) -> bool:
+        return self.first_index <= last_event_id + 1 <= self._next_index
+
+    def add_done_callback(self, callback: Callable[[], None]) -> None:
+        self._task.add_done_callback(lambda _: callback())
+
+    async def _pump(self, source: AsyncIterator[dict]) -> None:
+        try:
+            async for event in source:
+                self._events.append(event)
+                self._next_index += 1
+                self._notify()
+        finally:
+            self._finished = True
+            self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, after: int = -1) -> AsyncGenerator[dict, None]:
+        """Yield every event numbered above ``after``, each tagged with its ``id``."""
+        self.subscribers += 1
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        index = after + 1
+        try:
+            while True:
+                changed = self._changed
+                while index < self._next_index:
+                    if index < self.first_index:
+                        yield {"event": "error", "data": "Stream fell too far behind."}
+                        return
+                    event = self._events[index - self.first_index]
+                    written_at = time.perf_counter()
+                    yield {**event, "id": str(index)}
+                    if self.on_write is not None:
+                        self.on_write(time.perf_counter() - written_at)
+                    index += 1
+                if self._finished:
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            self.release_if_idle()
+
+    def release_if_idle(self) -> None:
+        """Cancel the source if nobody is listening to it any more."""
+        if self.subscribers or self._finished or self.cancelled:
+            return
+        if self.idle_grace_s <= 0:
+            self._cancel_if_idle()
+        elif self._idle_timer is None:
+            self._idle_timer = asyncio.get_running_loop().call_later(
+                self.idle_grace_s, self._cancel_if_idle
+            )
+
+    def _cancel_if_idle(self) -> None:
+        self._idle_timer = None
+        if not self.subscribers and not self._finished and not self.cancelled:
+            self.cancelled = True
+            self._task.cancel()
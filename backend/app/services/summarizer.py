@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+from app.config import settings
+from app.services import metrics
+from app.services.conversation_service import (
+    ConversationService,
+    SummaryJob,
+    conversation_service,
+)
+from app.services.model_registry import ModelRegistry, model_registry
+from app.services.model_service import ModelService, QueueFullError
+
+logger = logging.getLogger(__name__)
+
+SUMMARIZER_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an "
+    "assistant. Update the summary with the new turns. Keep names, facts, "
+    "decisions, preferences and open questions; drop greetings and filler. "
+    "Reply with the updated summary only, in a few sentences."
+)
+
+
+def summary_prompt(job: SummaryJob) -> list[dict[str, str]]:
+    """Messages asking the model to fold ``job``'s turns into its previous summary."""
+    transcript = "\n".join(
+        f"{m['role'].capitalize()}: {m['content']}" for m in job.messages
+    )
+    parts = []
+    if job.previous_summary:
+        parts.append(f"Summary so far:\n{job.previous_summary}")
+    parts.append(f"New turns:\n{transcript}")
+    return [
+        {"role": "system", "content": SUMMARIZER_PROMPT},
+        {"role": "user", "content": "\n\n".join(parts)},
+    ]
+
+
+class HistorySummarizer:
+    """Folds old turns into rolling summaries while the model has nothing else to do.
+
+    Conversations are queued with :meth:`schedule` after each reply. The
+    background loop started by :meth:`run` only takes a generation slot
+    when no request holds or waits for one, and gives it back within a
+    prefill batch or a token of a request queueing behind it; an interrupted summary is
+    dropped and retried at the next idle moment. Each summary extends the
+    previous one with the newly folded turns instead of re-reading the
+    whole conversation.
+    """
+
+    def __init__(
+        self,
+        conversations: ConversationService,
+        model: ModelService | ModelRegistry,
+        max_tokens: int,
+        poll_interval_s: float = 0.5,
+    ) -> None:
+        self.conversations = conversations
+        self.model = model
+        self.max_tokens = max_tokens
+        self.poll_interval_s = poll_interval_s
+        self._pending: OrderedDict[str, None] = OrderedDict()
+        self._wake: asyncio.Event | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.conversations.summary_trigger_tokens > 0
+
+    def schedule(self, conversation_id: str) -> None:
+        if not self.enabled:
+            return
+        self._pending[conversation_id] = None
+        if self._wake is not None:
+            self._wake.set()
+
+    def _idle(self) -> bool:
+        scheduler = self.model.scheduler
+        return (
+            self.model.is_loaded
+            and scheduler.active_count == 0
+            and scheduler.queued_count == 0
+        )
+
+    async def run(self) -> None:
+        # Created here so the event belongs to the loop running the app.
+        self._wake = asyncio.Event()
+        if self._pending:
+            self._wake.set()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._pending:
+                while not self._idle():
+                    await asyncio.sleep(self.poll_interval_s)
+                conversation_id, _ = self._pending.popitem(last=False)
+                try:
+                    if await self.summarize(conversation_id) is False:
+                        self._pending[conversation_id] = None
+                except Exception:
+                    metrics.history_summaries.labels("error").inc()
+                    logger.error(
+                        "Summarizing conversation %s failed",
+                        conversation_id,
+                        exc_info=True,
+                    )
+
+    async def summarize(self, conversation_id: str) -> bool | None:
+        """Summarize the conversation's due turns.
+
+        Returns ``None`` if nothing was due, ``True`` once a summary is
+        stored and ``False`` if it was interrupted and should be retried.
+        """
+        job = self.conversations.pending_summary(conversation_id)
+        if job is None:
+            return None
+        try:
+            ticket = self.model.scheduler.submit("low")
+        except QueueFullError:
+            return False
+        cancel = threading.Event()
+        text: list[str] = []
+        metadata: dict = {}
+        try:
+            async for _ in ticket.wait():
+                pass
+            # Polled by the decoding thread between prefill batches and
+            # tokens, so a long prompt does not hold the slot either.
+            async for chunk in self.model.generate_stream_async(
+                summary_prompt(job),
+                cancel=cancel,
+                max_tokens=self.max_tokens,
+                interrupt=lambda: self.model.scheduler.queued_count > 0,
+            ):
+                if chunk["event"] == "token":
+                    text.append(chunk["data"])
+                else:
+                    metadata = chunk["data"]
+                if self.model.scheduler.queued_count:
+                    cancel.set()  # the batch engine only watches cancel
+        finally:
+            ticket.release()
+        summary = "".join(text).strip()
+        truncated = metadata.get("truncated")
+        if truncated == "cancelled":
+            metrics.history_summaries.labels("interrupted").inc()
+            return False
+        if truncated is not None or not summary:
+            metrics.history_summaries.labels("failed").inc()
+            return None
+        stored = self.conversations.apply_summary(job, summary)
+        metrics.history_summaries.labels("stored" if stored else "stale").inc()
+        return stored or None
+
+
+history_summarizer = HistorySummarizer(
+    conversation_service,
+    model_registry,
+    max_tokens=settings.history_summary_max_tokens,
+)
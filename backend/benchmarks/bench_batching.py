@@ -0,0 +1,121 @@
+"""Benchmark: aggregate decode throughput, sequential vs continuous batching.
+
+Runs the same greedy generations twice on one GGUF model: one after another
+through ``Llama.generate`` (what a single replica does today), then all at
+once through ``BatchEngine``. Without ``--model`` a small random-weight
+model is built in a temp directory, so the run is offline; its text is
+noise but the matrix shapes, and so the batching win, are real.
+
+    python -m benchmarks.bench_batching --sequences 8 --tokens 64
+
+Prints one JSON object with tokens/s for each mode and the speed-up.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from llama_cpp import Llama
+
+from app.services.batching import BatchEngine, BatchRequest, SamplingParams
+
+_GREEDY = SamplingParams(temperature=0.0, top_p=1.0, repeat_penalty=1.0)
+
+
+def _prompts(llama: Llama, n: int) -> list[list[int]]:
+    return [
+        llama.tokenize(f"Question {i}: tell me about batching.".encode("utf-8"))
+        for i in range(n)
+    ]
+
+
+def run_sequential(llama: Llama, prompts: list[list[int]], max_tokens: int) -> tuple[int, float]:
+    produced = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        llama.reset()
+        for i, _ in enumerate(llama.generate(prompt, temp=0.0, repeat_penalty=1.0)):
+            produced += 1
+            if i + 1 == max_tokens:
+                break
+    return produced, time.perf_counter() - start
+
+
+def run_batched(
+    llama: Llama, prompts: list[list[int]], max_tokens: int, n_ctx: int
+) -> tuple[int, float, int]:
+    engine = BatchEngine(llama, max_sequences=len(prompts), n_ctx=n_ctx, sampling=_GREEDY)
+    done = threading.Semaphore(0)
+
+    def emit(kind: str, payload: object) -> None:
+        if kind != "token":
+            done.release()
+
+    requests = [
+        BatchRequest(
+            tokens=prompt,
+            max_tokens=max_tokens,
+            emit=emit,
+            cancel=threading.Event(),
+            deadline=time.monotonic() + 600,
+        )
+        for prompt in prompts
+    ]
+    engine.start()
+    try:
+        start = time.perf_counter()
+        for request in requests:
+            engine.submit(request)
+        for _ in requests:
+            done.acquire()
+        wall_s = time.perf_counter() - start
+    finally:
+        engine.close()
+    return sum(r.n_generated for r in requests), wall_s, engine.steps
+
+
+def main(args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model
+        if not model_path:
+            from tests.tiny_model import build_tiny_model
+
+            model_path = os.path.join(tmp, "bench.gguf")
+            build_tiny_model(model_path, n_embd=512, n_layer=8, n_head=8, n_ff=1536)
+        n_ctx = args.sequences * (48 + args.tokens)
+        llama = Llama(
+            model_path=model_path, n_ctx=n_ctx, n_threads=args.threads or None, verbose=False
+        )
+        prompts = _prompts(llama, args.sequences)
+        seq_tokens, seq_s = run_sequential(llama, prompts, args.tokens)
+        batch_tokens, batch_s, steps = run_batched(llama, prompts, args.tokens, n_ctx)
+
+    sequential = seq_tokens / seq_s
+    batched = batch_tokens / batch_s
+    return {
+        "benchmark": "batching",
+        "config": {
+            "model": args.model or "random-tiny",
+            "sequences": args.sequences,
+            "tokens": args.tokens,
+            "threads": args.threads,
+        },
+        "results": {
+            "sequential_tokens_per_s": round(sequential, 1),
+            "batched_tokens_per_s": round(batched, 1),
+            "batched_decode_steps": steps,
+            "speedup": round(batched / sequential, 2),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="", help="GGUF file; default builds a random one")
+    parser.add_argument("--sequences", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=0)
+    print(json.dumps(main(parser.parse_args()), indent=2))
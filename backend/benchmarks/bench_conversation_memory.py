@@ -0,0 +1,143 @@
+"""Benchmark: memory per stored message and ``get_history`` cost.
+
+Fills a :class:`ConversationService` with many conversations and compares
+it with the previous representation, a list of Pydantic ``ChatMessage``
+objects per conversation whose history dicts were rebuilt on every call.
+
+    python -m benchmarks.bench_conversation_memory --conversations 100000 --messages 10
+
+Prints one JSON object. Message contents are shared strings, so
+``bytes_per_message`` is the overhead of the representation itself,
+including each conversation's share of its own bookkeeping; real message
+text comes on top in both. ``get_history_us`` is the mean cost of one
+call made after each new message, as in a chat turn, while a
+conversation grows to ``--turns`` messages.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from app.schemas.chat import ChatMessage
+from app.services.conversation_service import ConversationService
+
+_CONTENTS = [
+    "What is the capital of France?",
+    "The capital of France is Paris.",
+]
+
+
+@dataclass
+class _LegacyConversation:
+    id: str
+    messages: list[ChatMessage] = field(default_factory=list)
+
+
+def _legacy_history(convo: _LegacyConversation) -> list[dict[str, str]]:
+    return [{"role": m.role, "content": m.content} for m in convo.messages]
+
+
+def _role(index: int) -> str:
+    return "user" if index % 2 == 0 else "assistant"
+
+
+def _fill_legacy(n_conversations: int, n_messages: int) -> dict:
+    conversations = {}
+    for c in range(n_conversations):
+        convo = _LegacyConversation(id=f"conv-{c}")
+        for m in range(n_messages):
+            convo.messages.append(
+                ChatMessage(role=_role(m), content=_CONTENTS[m % 2], timestamp=datetime.now())
+            )
+        conversations[convo.id] = convo
+    return conversations
+
+
+def _fill_compact(n_conversations: int, n_messages: int) -> ConversationService:
+    service = ConversationService()
+    for c in range(n_conversations):
+        for m in range(n_messages):
+            service.add_message(f"conv-{c}", _role(m), _CONTENTS[m % 2])
+    return service
+
+
+def _measure_memory(fill, n_conversations: int, n_messages: int) -> tuple[object, dict]:
+    gc.collect()
+    tracemalloc.start()
+    store = fill(n_conversations, n_messages)
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    n_total = n_conversations * n_messages
+    return store, {
+        "total_mb": round(used / 2**20, 1),
+        "bytes_per_message": round(used / n_total, 1),
+    }
+
+
+def _time_history_legacy(turns: int) -> float:
+    convo = _LegacyConversation(id="hot")
+    elapsed = 0.0
+    for m in range(turns):
+        convo.messages.append(ChatMessage(role=_role(m), content=_CONTENTS[m % 2]))
+        start = time.perf_counter()
+        _legacy_history(convo)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def _time_history_compact(service: ConversationService, turns: int) -> float:
+    elapsed = 0.0
+    for m in range(turns):
+        service.add_message("hot", _role(m), _CONTENTS[m % 2])
+        start = time.perf_counter()
+        service.get_history("hot")
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def main(args: argparse.Namespace) -> dict:
+    # One "Created conversation" line per conversation would swamp the output.
+    logging.disable(logging.INFO)
+    results = {}
+    for name, fill, timer in (
+        ("chat_message_list", _fill_legacy, lambda _: _time_history_legacy(args.turns)),
+        (
+            "message_log",
+            _fill_compact,
+            lambda service: _time_history_compact(service, args.turns),
+        ),
+    ):
+        store, memory = _measure_memory(fill, args.conversations, args.messages)
+        elapsed = timer(store)
+        results[name] = {
+            **memory,
+            "get_history_us": round(elapsed / args.turns * 1e6, 2),
+        }
+        del store
+    results["bytes_ratio"] = round(
+        results["message_log"]["bytes_per_message"]
+        / results["chat_message_list"]["bytes_per_message"],
+        3,
+    )
+    logging.disable(logging.NOTSET)
+    return {
+        "benchmark": "conversation_memory",
+        "conversations": args.conversations,
+        "messages_per_conversation": args.messages,
+        "turns": args.turns,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=500)
+    print(json.dumps(main(parser.parse_args()), indent=2))
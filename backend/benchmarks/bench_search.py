@@ -0,0 +1,157 @@
+"""Benchmark: conversation search latency over a large message history.
+
+Stores synthetic messages, with words drawn from a Zipf-like vocabulary,
+in the in-memory store (inverted index) and the SQLite store (FTS5), then
+times queries against both and against a plain scan of every message.
+
+    python -m benchmarks.bench_search --messages 1000000
+
+Prints one JSON object. Queries are a rare word, a common word and two
+mid-frequency words that must both match; ``p50_ms``/``p95_ms`` are over
+``--repeats`` runs each, returning the top ``--limit`` hits.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from app.services.conversation_service import ConversationService
+from app.services.conversation_store import InMemoryConversationStore, SQLiteConversationStore
+from app.services.search_index import tokenize
+
+_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def _vocabulary(size: int, rng: random.Random) -> list[str]:
+    words: set[str] = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(_LETTERS, k=rng.randint(3, 9))))
+    return sorted(words, key=lambda w: rng.random())
+
+
+def _messages(args: argparse.Namespace) -> tuple[list[str], list[str]]:
+    rng = random.Random(args.seed)
+    vocabulary = _vocabulary(args.vocabulary, rng)
+    ranks = range(1, len(vocabulary) + 1)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in ranks))
+    texts = [
+        " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(4, 20)))
+        for _ in range(args.messages)
+    ]
+    return texts, vocabulary
+
+
+def _queries(vocabulary: list[str]) -> dict[str, str]:
+    return {
+        "rare_word": vocabulary[len(vocabulary) // 2],
+        "common_word": vocabulary[5],
+        "two_words": f"{vocabulary[50]} {vocabulary[200]}",
+    }
+
+
+def _fill_memory(texts: list[str], per_conversation: int) -> ConversationService:
+    service = ConversationService(store=InMemoryConversationStore())
+    for i, text in enumerate(texts):
+        role = "user" if i % 2 == 0 else "assistant"
+        service.add_message(f"conv-{i // per_conversation}", role, text)
+    return service
+
+
+def _fill_sqlite(path: str, texts: list[str], per_conversation: int) -> ConversationService:
+    # Bulk insert through the same schema and triggers the store uses, in
+    # one transaction instead of one per message.
+    SQLiteConversationStore(path).close()
+    now = datetime.now().isoformat(timespec="microseconds")
+    conn = sqlite3.connect(path)
+    n_conversations = (len(texts) + per_conversation - 1) // per_conversation
+    conn.executemany(
+        "INSERT INTO conversations (id, title, created_at, updated_at, message_count) "
+        "VALUES (?, ?, ?, ?, ?)",
+        ((f"conv-{c}", f"conv-{c}", now, now, per_conversation) for c in range(n_conversations)),
+    )
+    conn.executemany(
+        "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+        (
+            (f"conv-{i // per_conversation}", "user" if i % 2 == 0 else "assistant", text, now)
+            for i, text in enumerate(texts)
+        ),
+    )
+    conn.commit()
+    conn.close()
+    return ConversationService(store=SQLiteConversationStore(path))
+
+
+def _scan(texts: list[str], query: str, limit: int) -> list[int]:
+    terms = set(tokenize(query))
+    return [i for i, text in enumerate(texts) if terms <= set(tokenize(text))][:limit]
+
+
+def _time(search, repeats: int) -> dict:
+    samples = []
+    hits = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        hits = len(search())
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "hits": hits,
+        "p50_ms": round(statistics.median(samples) * 1e3, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1e3, 3),
+    }
+
+
+def main(args: argparse.Namespace) -> dict:
+    # One "Created conversation" line per conversation would swamp the output.
+    logging.disable(logging.INFO)
+    texts, vocabulary = _messages(args)
+    queries = _queries(vocabulary)
+    results: dict[str, dict] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "inverted_index": lambda: _fill_memory(texts, args.per_conversation),
+            "sqlite_fts5": lambda: _fill_sqlite(
+                os.path.join(tmp, "search.db"), texts, args.per_conversation
+            ),
+        }
+        for name, fill in backends.items():
+            start = time.perf_counter()
+            service = fill()
+            results[name] = {"build_s": round(time.perf_counter() - start, 2)}
+            for label, query in queries.items():
+                results[name][label] = _time(
+                    lambda: service.search(query, limit=args.limit), args.repeats
+                )
+            del service
+        # Unranked, so a lower bound on what a ranked scan would cost.
+        results["scan"] = {
+            label: _time(lambda: _scan(texts, query, args.limit), max(1, args.repeats // 10))
+            for label, query in queries.items()
+        }
+    logging.disable(logging.NOTSET)
+    return {
+        "benchmark": "search",
+        "messages": args.messages,
+        "messages_per_conversation": args.per_conversation,
+        "queries": queries,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--per-conversation", type=int, default=50)
+    parser.add_argument("--vocabulary", type=int, default=20_000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    print(json.dumps(main(parser.parse_args()), indent=2))
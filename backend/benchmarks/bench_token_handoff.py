@@ -0,0 +1,116 @@
+"""Micro-benchmark: event-loop cost of handing decoded tokens to the stream.
+
+Compares the old per-token ``run_in_executor(None, next, ...)`` loop with
+``ModelService.generate_stream_async``, which decodes on a dedicated thread
+and hands tokens over in batches. A stubbed Llama emits tokens with a fixed
+per-token delay, so only the hand-off differs between the runs.
+
+    python -m benchmarks.bench_token_handoff --tokens 2000 --delay-ms 0.2
+
+Prints one JSON object. ``loop_cpu_us_per_token`` is CPU time spent on the
+event-loop thread per token, which is what competes with every other
+request being served.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from app.config import settings
+from app.services.model_service import ModelService
+from benchmarks.fake_llama import FakeLlama, install_fake_model
+
+_SENTINEL = object()
+_MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+async def _per_token_executor(model: FakeLlama) -> int:
+    loop = asyncio.get_running_loop()
+    stream_iter = iter(
+        model.create_chat_completion(
+            _MESSAGES, max_tokens=settings.max_new_tokens, stream=True
+        )
+    )
+    events = 0
+    while True:
+        chunk = await loop.run_in_executor(None, next, stream_iter, _SENTINEL)
+        if chunk is _SENTINEL:
+            return events
+        if chunk["choices"][0]["delta"].get("content"):
+            events += 1
+
+
+async def _decode_thread(
+    model: FakeLlama, flush_interval_s: float, flush_max_tokens: int
+) -> int:
+    service = ModelService()
+    install_fake_model(service, model)
+    events = 0
+    async for chunk in service.generate_stream_async(
+        _MESSAGES,
+        token_counts=[1],
+        flush_interval_s=flush_interval_s,
+        flush_max_tokens=flush_max_tokens,
+    ):
+        if chunk["event"] == "token":
+            events += 1
+    return events
+
+
+async def _measure(name: str, run, n_tokens: int) -> dict:
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    events = await run()
+    loop_cpu = time.thread_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    return {
+        "mode": name,
+        "tokens": n_tokens,
+        "sse_events": events,
+        "wall_s": round(wall, 4),
+        "tokens_per_s": round(n_tokens / wall, 1),
+        "loop_cpu_us_per_token": round(loop_cpu / n_tokens * 1e6, 2),
+    }
+
+
+async def main(args: argparse.Namespace) -> dict:
+    settings.generation_timeout_s = 3600.0
+    settings.max_new_tokens = args.tokens
+    model = FakeLlama(
+        tokens_per_s=1000 / args.delay_ms if args.delay_ms else float("inf"),
+        prefill_tokens_per_s=float("inf"),
+        reply_tokens=args.tokens,
+    )
+    results = [
+        await _measure(
+            "per_token_executor", lambda: _per_token_executor(model), args.tokens
+        ),
+        await _measure(
+            "decode_thread",
+            lambda: _decode_thread(model, 0.0, 1),
+            args.tokens,
+        ),
+        await _measure(
+            "decode_thread_coalesced",
+            lambda: _decode_thread(
+                model, args.flush_interval_ms / 1000, args.flush_max_tokens
+            ),
+            args.tokens,
+        ),
+    ]
+    baseline = results[0]["loop_cpu_us_per_token"]
+    for result in results:
+        result["loop_cpu_vs_baseline"] = round(
+            result["loop_cpu_us_per_token"] / baseline, 3
+        )
+    return {"benchmark": "token_handoff", "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--delay-ms", type=float, default=0.2)
+    parser.add_argument("--flush-interval-ms", type=float, default=20.0)
+    parser.add_argument("--flush-max-tokens", type=int, default=16)
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
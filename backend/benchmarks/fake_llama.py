@@ -0,0 +1,78 @@
+"""A deterministic stand-in for ``llama_cpp.Llama``.
+
+``FakeLlama`` implements just the parts of ``Llama`` that ``ModelService``
+calls while serving chat, and spends time the way a real model does: a
+prefill delay proportional to the prompt, then one token per decode step.
+Latencies are drawn from a seeded RNG, so two runs with the same settings
+see the same token timings and any difference comes from the server.
+"""
+
+import random
+import time
+
+from app.config import settings
+from app.services.kv_cache import KVStateCache
+from app.services.model_service import ModelReplica, ModelService
+
+
+class FakeLlama:
+    def __init__(
+        self,
+        tokens_per_s: float = 50.0,
+        prefill_tokens_per_s: float = 2000.0,
+        reply_tokens: int = 64,
+        jitter: float = 0.0,
+        seed: int = 0,
+        context_size: int | None = None,
+    ) -> None:
+        self.tokens_per_s = tokens_per_s
+        self.prefill_tokens_per_s = prefill_tokens_per_s
+        self.reply_tokens = reply_tokens
+        self.jitter = jitter
+        self._context_size = context_size or settings.n_ctx
+        self._rng = random.Random(seed)
+
+    def n_ctx(self) -> int:
+        return self._context_size
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list[int]:
+        # Roughly four bytes per token, like a BPE vocabulary on English text.
+        return list(range((len(text) + 3) // 4 + int(add_bos)))
+
+    def _sleep(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        if self.jitter:
+            seconds *= 1 + self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(seconds)
+
+    def create_chat_completion(
+        self, messages: list[dict[str, str]], max_tokens: int = 16, stream: bool = False, **kwargs
+    ):
+        if not stream:
+            raise NotImplementedError("FakeLlama only supports streaming")
+        prompt_tokens = sum(
+            len(self.tokenize(m["content"].encode("utf-8"), add_bos=False))
+            for m in messages
+        )
+        n_reply = min(self.reply_tokens, max_tokens)
+
+        def chunks():
+            self._sleep(prompt_tokens / self.prefill_tokens_per_s)
+            yield {"choices": [{"delta": {"role": "assistant"}}]}
+            for i in range(n_reply):
+                self._sleep(1 / self.tokens_per_s)
+                yield {"choices": [{"delta": {"content": f"tok{i} "}}]}
+
+        return chunks()
+
+
+def install_fake_model(service: ModelService, model: FakeLlama, replicas: int = 1) -> None:
+    """Make ``service`` serve from ``model`` as if it had been loaded.
+
+    ``replicas`` replicas share the one fake. KV state reuse is switched
+    off because the fake has no llama.cpp context to snapshot.
+    """
+    service.replicas = [ModelReplica(i, model) for i in range(max(1, replicas))]
+    service.kv_cache = KVStateCache(capacity_bytes=0)
+    service._loaded = True
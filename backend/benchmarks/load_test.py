@@ -0,0 +1,251 @@
+"""Load test: concurrent SSE chat clients against ``/api/chat``.
+
+By default the app is served in-process by uvicorn with ``FakeLlama``
+behind it, so the run is offline, CPU-only and deterministic in model
+timing; what it measures is the server's own routing, queueing, streaming
+and conversation handling. Point ``--url`` at a running server to measure
+a real model instead.
+
+    python -m benchmarks.load_test --concurrency 8 --requests 64
+
+Prints one JSON object with throughput and TTFT / latency percentiles.
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+from dataclasses import dataclass
+
+import httpx
+
+from app.config import settings
+from benchmarks.fake_llama import FakeLlama, install_fake_model
+
+
+@dataclass
+class RequestResult:
+    status: int
+    ttft_s: float | None = None
+    latency_s: float = 0.0
+    tokens: int = 0
+    error: bool = False
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    """Nearest-rank percentile; ``None`` for an empty sample."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _distribution_ms(values: list[float]) -> dict[str, float | None]:
+    result = {}
+    for pct in (50, 95, 99):
+        value = percentile(values, pct)
+        result[f"p{pct}"] = None if value is None else round(value * 1000, 2)
+    result["max"] = round(max(values) * 1000, 2) if values else None
+    return result
+
+
+async def _chat(
+    client: httpx.AsyncClient, base_url: str, conversation_id: str, message: str
+) -> RequestResult:
+    start = time.perf_counter()
+    result = RequestResult(status=0)
+    event = None
+    try:
+        async with client.stream(
+            "POST",
+            f"{base_url}/api/chat",
+            json={"conversation_id": conversation_id, "message": message},
+        ) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                return result
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:") and event == "token":
+                    if result.ttft_s is None:
+                        result.ttft_s = time.perf_counter() - start
+                elif line.startswith("data:") and event == "metadata":
+                    data = json.loads(line[len("data:"):])
+                    result.tokens = data.get("tokens_generated", 0)
+                elif line.startswith("data:") and event == "error":
+                    result.error = True
+    except httpx.HTTPError:
+        result.error = True
+    finally:
+        result.latency_s = time.perf_counter() - start
+    return result
+
+
+async def run_workload(
+    base_url: str, concurrency: int, n_requests: int, conversations: int
+) -> tuple[list[RequestResult], float]:
+    """Send ``n_requests`` chats from ``concurrency`` clients at once.
+
+    Requests are spread round-robin over ``conversations`` conversation ids
+    so later turns carry history, as a real chat session does.
+    """
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(n_requests):
+        queue.put_nowait(i)
+    results: list[RequestResult] = []
+
+    async def client_loop(client: httpx.AsyncClient) -> None:
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            conversation_id = f"load-{i % conversations}"
+            results.append(
+                await _chat(client, base_url, conversation_id, f"Question number {i}?")
+            )
+
+    limits = httpx.Limits(max_connections=concurrency)
+    timeout = httpx.Timeout(settings.generation_timeout_s * 4)
+    start = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    return results, time.perf_counter() - start
+
+
+def summarize(results: list[RequestResult], wall_s: float) -> dict:
+    ok = [r for r in results if r.status == 200 and not r.error]
+    tokens = sum(r.tokens for r in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "rejected": sum(1 for r in results if r.status == 429),
+        "failed": sum(1 for r in results if r.error or r.status not in (200, 429)),
+        "wall_s": round(wall_s, 3),
+        "requests_per_s": round(len(ok) / wall_s, 2),
+        "tokens_per_s": round(tokens / wall_s, 1),
+        "ttft_ms": _distribution_ms([r.ttft_s for r in ok if r.ttft_s is not None]),
+        "latency_ms": _distribution_ms([r.latency_s for r in ok]),
+    }
+
+
+class InProcessServer:
+    """Serve the app on a free local port from a background thread."""
+
+    def __init__(self, fake: FakeLlama, replicas: int = 1) -> None:
+        import uvicorn
+
+        from app.main import app
+        from app.services.model_service import model_service
+
+        model_service.load_model = lambda: install_fake_model(
+            model_service, fake, replicas
+        )
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        config = uvicorn.Config(
+            app, host="127.0.0.1", port=self.port, log_level="warning"
+        )
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "InProcessServer":
+        self._thread.start()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                health = httpx.get(f"{self.url}/api/health", timeout=1)
+                if health.json().get("model_loaded"):
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError("In-process server did not become ready")
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+def main(args: argparse.Namespace) -> dict:
+    config = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "conversations": args.conversations,
+    }
+    if args.url:
+        results, wall_s = asyncio.run(
+            run_workload(args.url, args.concurrency, args.requests, args.conversations)
+        )
+        return {
+            "benchmark": "load_test",
+            "target": args.url,
+            "config": config,
+            "results": summarize(results, wall_s),
+        }
+
+    settings.log_level = "WARNING"
+    settings.max_new_tokens = args.reply_tokens
+    settings.model_replicas = args.replicas
+    settings.max_concurrent_generations = args.max_concurrent
+    settings.max_queued_requests = max(args.concurrency, settings.max_queued_requests)
+    fake = FakeLlama(
+        tokens_per_s=args.tokens_per_s,
+        prefill_tokens_per_s=args.prefill_tokens_per_s,
+        reply_tokens=args.reply_tokens,
+        jitter=args.jitter,
+        seed=args.seed,
+    )
+    config.update(
+        tokens_per_s=args.tokens_per_s,
+        prefill_tokens_per_s=args.prefill_tokens_per_s,
+        reply_tokens=args.reply_tokens,
+        jitter=args.jitter,
+        seed=args.seed,
+        replicas=args.replicas,
+        max_concurrent=args.max_concurrent,
+    )
+    from app.services.model_service import GenerationScheduler, model_service
+
+    model_service.scheduler = GenerationScheduler(
+        settings.max_concurrent_generations or settings.model_replicas,
+        settings.max_queued_requests,
+    )
+    with InProcessServer(fake, args.replicas) as server:
+        results, wall_s = asyncio.run(
+            run_workload(server.url, args.concurrency, args.requests, args.conversations)
+        )
+    return {
+        "benchmark": "load_test",
+        "target": "fake_llama",
+        "config": config,
+        "results": summarize(results, wall_s),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="", help="Target a running server instead")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--conversations", type=int, default=16)
+    parser.add_argument("--tokens-per-s", type=float, default=200.0)
+    parser.add_argument("--prefill-tokens-per-s", type=float, default=5000.0)
+    parser.add_argument("--reply-tokens", type=int, default=32)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument(
+        "--max-concurrent", type=int, default=0, help="0 = one per replica"
+    )
+    print(json.dumps(main(parser.parse_args()), indent=2))
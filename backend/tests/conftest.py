@@ -1,14 +1,23 @@
 import pytest
-from unittest.mock import  patch
+from unittest.mock import MagicMock, patch
+
+from app.services.kv_cache import KVStateCache
+from app.services.model_registry import ModelRegistry
 
 from fastapi.testclient import TestClient
 
 
 @pytest.fixture()
 def mock_model_service():
-    """Patch model_service so no real model is loaded during tests."""
-    with patch("app.routers.chat.model_service") as mock:
-        mock.is_loaded = True
+    """Serve requests from a mock model so no real model is loaded during tests."""
+    mock = MagicMock()
+    mock.is_loaded = True
+    mock.kv_cache = KVStateCache(capacity_bytes=0)
+    mock.replica_stats.return_value = []
+    mock.batch_engine = None
+    mock.startup_phases = {}
+    mock.generations_in_flight = 0
+    with patch("app.routers.chat.model_registry", ModelRegistry(mock)):
         yield mock
 
 
@@ -16,5 +25,21 @@ def mock_model_service():
 def client(mock_model_service):
     """TestClient with model_service mocked out."""
     from app.main import app
+    from sse_starlette.sse import AppStatus
+
+    # sse-starlette binds this event to the first loop that streams; each
+    # TestClient runs its own loop.
+    AppStatus.should_exit_event = None
     with TestClient(app, raise_server_exceptions=False) as c:
         yield c
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    """Path to a tiny random-weight GGUF for exercising real llama.cpp paths."""
+    pytest.importorskip("gguf")
+    from tests.tiny_model import build_tiny_model
+
+    path = tmp_path_factory.mktemp("models") / "tiny.gguf"
+    build_tiny_model(str(path))
+    return str(path)
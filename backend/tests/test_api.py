@@ -1,3 +1,24 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import MagicMock, patch
+
+from app.config import settings
+from app.routers import chat as chat_module
+from app.routers.chat import (
+    _generation_for,
+    _inflight,
+    _priority,
+    _share_key,
+    _stream_response,
+)
+from app.services.conversation_service import ConversationService
+from app.services.model_service import GenerationScheduler
+from app.services.profiling import ProfileLog, RequestProfile
+from app.schemas.chat import ChatRequest
+from app.services.response_cache import ResponseCache
+
+
 class TestHealthEndpoint:
     def test_health_when_loaded(self, client):
         response = client.get("/api/health")
@@ -6,6 +27,8 @@ class TestHealthEndpoint:
         assert data["status"] == "ok"
         assert data["model_loaded"] is True
         assert "model_id" in data
+        assert data["kv_cache"]["hits"] == 0
+        assert data["model_variant"] == "default"
 
     def test_health_when_loading(self, client, mock_model_service):
         mock_model_service.is_loaded = False
@@ -16,12 +39,81 @@ class TestHealthEndpoint:
         assert data["model_loaded"] is False
 
 
+class TestModelsEndpoint:
+    ADMIN = {"X-API-Key": "admin-key"}
+
+    @pytest.fixture(autouse=True)
+    def admin_key(self, monkeypatch):
+        monkeypatch.setattr(settings, "admin_api_keys", ["admin-key"])
+
+    def test_lists_variants(self, client):
+        response = client.get("/api/models")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["active"] == data["serving"] == "default"
+        assert data["variants"]["default"]["state"] == "loaded"
+
+    def test_switching_requires_an_admin_key(self, client):
+        for path in ("/api/models/default/activate", "/api/models/default/unload"):
+            assert client.post(path).status_code == 403
+            assert client.post(path, headers={"X-API-Key": "guess"}).status_code == 403
+
+    def test_unknown_variant(self, client):
+        assert client.post("/api/models/nope/activate", headers=self.ADMIN).status_code == 404
+        assert client.post("/api/models/nope/unload", headers=self.ADMIN).status_code == 404
+
+    def test_activating_the_active_model(self, client):
+        response = client.post("/api/models/default/activate", headers=self.ADMIN)
+        assert response.status_code == 200
+
+    def test_configured_model_cannot_be_unloaded(self, client):
+        response = client.post("/api/models/default/unload", headers=self.ADMIN)
+        assert response.status_code == 409
+
+
 class TestConversationsEndpoint:
     def test_list_conversations_empty(self, client):
         response = client.get("/api/conversations")
         assert response.status_code == 200
         assert response.json() == []
 
+    def test_search_conversations(self, client):
+        from app.services.conversation_service import conversation_service
+
+        conversation_service.add_message("search-1", "user", "Where is the zanzibar archive?")
+        response = client.get("/api/conversations/search", params={"q": "Zanzibar"})
+        assert response.status_code == 200
+        hits = response.json()
+        assert [h["conversation_id"] for h in hits] == ["search-1"]
+        assert "zanzibar" in hits[0]["snippet"]
+        conversation_service.delete_conversation("search-1")
+
+    def test_search_requires_a_query(self, client):
+        assert client.get("/api/conversations/search").status_code == 422
+        assert client.get("/api/conversations/search", params={"q": ""}).status_code == 422
+
+    def test_list_conversations_rejects_bad_cursor(self, client):
+        response = client.get("/api/conversations", params={"before": "???"})
+        assert response.status_code == 400
+
+    def test_list_conversations_paginates(self, client):
+        from app.services.conversation_service import conversation_service
+
+        for i in range(3):
+            conversation_service.add_message(f"page-{i}", "user", "hello")
+        try:
+            first = client.get("/api/conversations", params={"limit": 2})
+            cursor = first.headers["X-Next-Cursor"]
+            rest = client.get(
+                "/api/conversations", params={"limit": 2, "before": cursor}
+            )
+            ids = [c["id"] for c in first.json() + rest.json()]
+            assert ids == ["page-2", "page-1", "page-0"]
+            assert "X-Next-Cursor" not in rest.headers
+        finally:
+            for i in range(3):
+                conversation_service.delete_conversation(f"page-{i}")
+
     def test_delete_nonexistent_conversation(self, client):
         response = client.delete("/api/conversations/nonexistent-id")
         assert response.status_code == 404
@@ -50,9 +142,313 @@ class TestChatEndpoint:
         )
         assert response.status_code == 422
 
+    def test_chat_rejects_when_queue_full(self, client, mock_model_service):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        scheduler.submit()
+        mock_model_service.scheduler = scheduler
+        response = client.post(
+            "/api/chat",
+            json={"conversation_id": "test", "message": "hello"},
+        )
+        assert response.status_code == 429
+
+    def test_chat_rejects_unknown_priority(self, client):
+        response = client.post(
+            "/api/chat",
+            json={"conversation_id": "test", "message": "hello", "priority": "urgent"},
+        )
+        assert response.status_code == 422
+
+    def test_share_key_follows_fair_share_mode(self, monkeypatch):
+        request = ChatRequest(conversation_id="conv-1", message="hi", priority="high")
+        monkeypatch.setattr(settings, "scheduler_fair_share", "off")
+        assert _share_key(request, "team-a") is None
+        monkeypatch.setattr(settings, "scheduler_fair_share", "api_key")
+        monkeypatch.setattr(settings, "priority_api_keys", ["team-a"])
+        assert _share_key(request, "team-a") == "key:team-a"
+        assert _share_key(request, "made-up", "10.0.0.7") == "client:10.0.0.7"
+        assert _share_key(request, None) == "conversation:conv-1"
+
+    def test_high_priority_needs_a_listed_key(self, monkeypatch):
+        request = ChatRequest(conversation_id="conv-1", message="hi", priority="high")
+        monkeypatch.setattr(settings, "priority_api_keys", ["team-a"])
+        assert _priority(request, "team-a") == "high"
+        assert _priority(request, "made-up") == "normal"
+        assert _priority(request, None) == "normal"
+        low = ChatRequest(conversation_id="conv-1", message="hi", priority="low")
+        assert _priority(low, None) == "low"
+
+    def test_chat_streams_tokens_and_releases_slot(self, client, mock_model_service):
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            yield {"event": "token", "data": "Hi"}
+            yield {"event": "metadata", "data": {"tokens_generated": 1, "elapsed_s": 0.0}}
+
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        mock_model_service.scheduler = scheduler
+        mock_model_service.generate_stream_async = fake_stream
+        response = client.post(
+            "/api/chat",
+            json={"conversation_id": "stream-test", "message": "hello"},
+        )
+        client.delete("/api/conversations/stream-test")
+        assert response.status_code == 200
+        assert "event: token" in response.text
+        assert "event: done" in response.text
+        assert scheduler.active_count == 0
+
+    def test_dropped_stream_resumes_from_last_event_id(self, client, mock_model_service):
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            for word in ("one", "two", "three"):
+                yield {"event": "token", "data": word}
+            yield {"event": "metadata", "data": {"tokens_generated": 3, "elapsed_s": 0.0}}
+
+        mock_model_service.scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        mock_model_service.generate_stream_async = fake_stream
+        response = client.post(
+            "/api/chat", json={"conversation_id": "resume-test", "message": "count"}
+        )
+        stream_id = response.headers["X-Stream-Id"]
+        assert "id: 1" in response.text
+
+        resumed = client.get(
+            f"/api/chat/streams/{stream_id}", headers={"Last-Event-ID": "0"}
+        )
+        client.delete("/api/conversations/resume-test")
+        assert resumed.status_code == 200
+        assert "data: one" not in resumed.text
+        assert "data: two" in resumed.text
+        assert "data: three" in resumed.text
+        assert "event: done" in resumed.text
+
+    def test_resume_unknown_stream(self, client):
+        assert client.get("/api/chat/streams/nope").status_code == 404
+
+    def test_resume_rejects_bad_last_event_id(self, client, mock_model_service):
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            yield {"event": "token", "data": "Hi"}
+
+        mock_model_service.scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        mock_model_service.generate_stream_async = fake_stream
+        response = client.post(
+            "/api/chat", json={"conversation_id": "resume-bad", "message": "hi"}
+        )
+        url = f"/api/chat/streams/{response.headers['X-Stream-Id']}"
+        assert client.get(url, headers={"Last-Event-ID": "x"}).status_code == 400
+        assert client.get(url, headers={"Last-Event-ID": "99"}).status_code == 410
+        client.delete("/api/conversations/resume-bad")
+
+    def test_metrics_endpoint(self, client):
+        response = client.get("/api/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "# TYPE chat_time_to_first_token_seconds histogram" in response.text
+        assert "chat_generations_in_flight" in response.text
+
+    def test_debug_profile_is_off_by_default(self, client):
+        assert client.get("/api/debug/profile").status_code == 404
+        assert (
+            client.post("/api/debug/profile/capture", params={"conversation_id": "c"}).status_code
+            == 404
+        )
+
+    def test_debug_profile_lists_slowest_requests(self, client, mock_model_service, monkeypatch):
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            yield {"event": "token", "data": "Hi"}
+            yield {"event": "metadata", "data": {"tokens_generated": 1, "elapsed_s": 0.0}}
+
+        monkeypatch.setattr(settings, "profile_requests", True)
+        mock_model_service.scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        mock_model_service.generate_stream_async = fake_stream
+        with patch("app.routers.chat.profile_log", ProfileLog(max_recent=10)):
+            armed = client.post(
+                "/api/debug/profile/capture", params={"conversation_id": "profile-test"}
+            )
+            response = client.post(
+                "/api/chat", json={"conversation_id": "profile-test", "message": "hi"}
+            )
+            profile = client.get("/api/debug/profile").json()
+        client.delete("/api/conversations/profile-test")
+        assert armed.status_code == 200
+        assert '"profile"' in response.text
+        slowest = profile["slowest"][0]
+        assert slowest["conversation_id"] == "profile-test"
+        assert {"store_message", "history", "queue"} <= set(slowest["phases"])
+        assert slowest["ttft_s"] <= slowest["total_s"]
+        assert profile["captures"][0]["conversation_id"] == "profile-test"
+        assert isinstance(profile["captures"][0]["stacks"], str)
+
     def test_chat_rejects_message_too_long(self, client):
         response = client.post(
             "/api/chat",
             json={"conversation_id": "test", "message": "a" * 2001},
         )
         assert response.status_code == 422
+
+
+class TestStreamResponse:
+    @pytest.mark.asyncio
+    async def test_disconnect_keeps_partial_reply(self, mock_model_service):
+        cancel_events = []
+
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            cancel_events.append(cancel)
+            yield {"event": "token", "data": "Partial"}
+            yield {"event": "token", "data": " reply"}
+
+        mock_model_service.generate_stream_async = fake_stream
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        service = ConversationService()
+        with patch("app.routers.chat.conversation_service", service):
+            stream = _stream_response(
+                "conv-1", "hello", mock_model_service, scheduler.submit()
+            )
+            async for event in stream:
+                if event["event"] == "token":
+                    break
+            await stream.aclose()
+
+        assert service.get_history("conv-1")[-1] == {
+            "role": "assistant",
+            "content": "Partial",
+        }
+        assert cancel_events[0].is_set()
+        assert scheduler.active_count == 0
+
+    @pytest.mark.asyncio
+    async def test_profile_rides_on_metadata(self, mock_model_service):
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            yield {"event": "token", "data": "Hi"}
+            yield {"event": "metadata", "data": {"tokens_generated": 1, "elapsed_s": 0.0}}
+
+        mock_model_service.generate_stream_async = fake_stream
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        profile = RequestProfile("conv-1")
+        log = ProfileLog(max_recent=10)
+        with patch("app.routers.chat.conversation_service", ConversationService()), patch(
+            "app.routers.chat.profile_log", log
+        ):
+            events = [
+                e
+                async for e in _stream_response(
+                    "conv-1", "hi", mock_model_service, scheduler.submit(), profile
+                )
+            ]
+
+        metadata = json.loads(next(e["data"] for e in events if e["event"] == "metadata"))
+        assert metadata["tokens_generated"] == 1
+        assert "history" in metadata["profile"]["phases"]
+        assert "ttft_s" in metadata["profile"]
+        assert log.slowest(1) == [profile]
+
+    @pytest.mark.asyncio
+    async def test_cached_reply_replays_the_same_events(self, mock_model_service):
+        calls = []
+
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            calls.append(history)
+            yield {"event": "token", "data": "Hello"}
+            yield {"event": "token", "data": " there"}
+            yield {"event": "metadata", "data": {"tokens_generated": 2, "elapsed_s": 0.5, "truncated": None}}
+
+        mock_model_service.generate_stream_async = fake_stream
+        mock_model_service.prompt_history.side_effect = lambda history, counts: history
+        mock_model_service.embedder = None
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        mock_model_service.scheduler = scheduler
+        service = ConversationService()
+        with patch("app.routers.chat.conversation_service", service), patch(
+            "app.routers.chat.response_cache", ResponseCache(max_entries=8, ttl_s=60)
+        ):
+            first = await _generation_for(ChatRequest(conversation_id="conv-1", message="hi"))
+            first_events = [e async for e in first.subscribe()]
+            # A full queue does not stop a cached reply.
+            busy = scheduler.submit()
+            second = await _generation_for(ChatRequest(conversation_id="conv-2", message="hi"))
+            second_events = [e async for e in second.subscribe()]
+            busy.release()
+
+        assert len(calls) == 1
+        assert [e["event"] for e in second_events] == [e["event"] for e in first_events]
+        tokens = [e["data"] for e in second_events if e["event"] == "token"]
+        assert tokens == ["Hello", " there"]
+        assert service.get_history("conv-2")[-1]["content"] == "Hello there"
+        await asyncio.sleep(0)
+        assert scheduler.active_count == 0
+
+    @pytest.mark.asyncio
+    async def test_failed_cache_lookup_falls_back_to_generating(self, mock_model_service):
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            yield {"event": "token", "data": "Hi"}
+            yield {"event": "metadata", "data": {"tokens_generated": 1, "elapsed_s": 0.0}}
+
+        mock_model_service.generate_stream_async = fake_stream
+        mock_model_service.prompt_history.side_effect = lambda history, counts: history
+        mock_model_service.embedder = MagicMock(side_effect=RuntimeError("embedder down"))
+        mock_model_service.scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        cache = ResponseCache(max_entries=8, ttl_s=60, semantic_max_entries=8)
+        with patch("app.routers.chat.conversation_service", ConversationService()), patch(
+            "app.routers.chat.response_cache", cache
+        ):
+            shared = await _generation_for(ChatRequest(conversation_id="conv-1", message="hi"))
+            events = [e async for e in shared.subscribe()]
+
+        assert [e["event"] for e in events] == ["token", "metadata", "done"]
+
+    @pytest.mark.asyncio
+    async def test_failure_before_generation_sends_error_event(self, mock_model_service):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        conversations = MagicMock()
+        conversations.add_message.side_effect = RuntimeError("store down")
+        with patch("app.routers.chat.conversation_service", conversations):
+            events = [
+                e
+                async for e in _stream_response(
+                    "conv-1", "hi", mock_model_service, scheduler.submit()
+                )
+            ]
+
+        assert [e["event"] for e in events] == ["error"]
+        assert scheduler.active_count == 0
+
+    @pytest.mark.asyncio
+    async def test_duplicate_requests_share_one_generation(self, mock_model_service):
+        release = asyncio.Event()
+        calls = []
+
+        async def fake_stream(history, conversation_id=None, token_counts=None, cancel=None, **kwargs):
+            calls.append(history)
+            yield {"event": "token", "data": "Hello"}
+            await release.wait()
+            yield {"event": "token", "data": " there"}
+
+        mock_model_service.generate_stream_async = fake_stream
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=0)
+        mock_model_service.scheduler = scheduler
+        service = ConversationService()
+        request = ChatRequest(conversation_id="conv-1", message="hi")
+        with patch("app.routers.chat.conversation_service", service):
+            first = await _generation_for(request)
+            first_events = first.subscribe()
+            assert (await first_events.__anext__())["event"] == "token"
+
+            # The queue is full, so a second generation would be rejected.
+            second = await _generation_for(request)
+            assert second is first
+            release.set()
+            replies = [
+                [e["data"] async for e in stream if e["event"] == "token"]
+                for stream in (first_events, second.subscribe())
+            ]
+
+        assert len(calls) == 1
+        assert replies == [[" there"], ["Hello", " there"]]
+        assert [m["role"] for m in service.get_history("conv-1")] == [
+            "system",
+            "user",
+            "assistant",
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.active_count == 0
+        assert not _inflight
+        # The variant was held for the generation and released with it.
+        assert chat_module.model_registry._requests == {"default": 0}
@@ -0,0 +1,106 @@
+import json
+from unittest.mock import patch
+
+from app.config import settings
+from app.services import autotune
+from app.services.autotune import (
+    TuneResult,
+    load_or_tune,
+    load_result,
+    save_result,
+    thread_budget,
+    thread_grid,
+)
+from app.services.model_service import ModelService
+
+RESULT = TuneResult(
+    n_threads=2,
+    n_threads_batch=4,
+    n_batch=256,
+    decode_tokens_per_s=10.0,
+    prefill_tokens_per_s=100.0,
+)
+
+
+class TestThreadGrid:
+    def test_powers_of_two_and_the_budget(self):
+        assert thread_grid(6) == [1, 2, 4, 5, 6]
+
+    def test_single_thread(self):
+        assert thread_grid(1) == [1]
+
+    def test_budget_is_split_between_replicas(self, monkeypatch):
+        monkeypatch.setattr(settings, "num_threads", 8)
+        monkeypatch.setattr(settings, "model_replicas", 2)
+        monkeypatch.setattr(settings, "batch_max_sequences", 0)
+        assert thread_budget() == 4
+        monkeypatch.setattr(settings, "batch_max_sequences", 4)
+        assert thread_budget() == 8
+
+
+class TestStoredResults:
+    def test_round_trip(self, tiny_model_path, tmp_path):
+        path = str(tmp_path / "tune" / "autotune.json")
+        save_result(path, tiny_model_path, 4, RESULT)
+        assert load_result(path, tiny_model_path, 4) == RESULT
+        entry = next(iter(json.loads(open(path).read()).values()))
+        assert "tuned_at" in entry
+
+    def test_keyed_by_thread_budget_and_cpu(self, tiny_model_path, tmp_path):
+        path = str(tmp_path / "autotune.json")
+        save_result(path, tiny_model_path, 4, RESULT)
+        assert load_result(path, tiny_model_path, 8) is None
+        with patch.object(autotune, "cpu_signature", return_value="other cpu"):
+            assert load_result(path, tiny_model_path, 4) is None
+
+    def test_unreadable_file_counts_as_empty(self, tiny_model_path, tmp_path):
+        path = tmp_path / "autotune.json"
+        path.write_text("not json")
+        assert load_result(str(path), tiny_model_path, 4) is None
+
+    def test_load_or_tune_reuses_stored_result(self, tiny_model_path, tmp_path):
+        path = str(tmp_path / "autotune.json")
+        save_result(path, tiny_model_path, 4, RESULT)
+        with patch.object(autotune, "autotune", side_effect=AssertionError):
+            assert load_or_tune(path, tiny_model_path, 4) == RESULT
+
+    def test_load_or_tune_stores_new_result(self, tiny_model_path, tmp_path):
+        path = str(tmp_path / "autotune.json")
+        with patch.object(autotune, "autotune", return_value=RESULT) as tune:
+            assert load_or_tune(path, tiny_model_path, 4) == RESULT
+            load_or_tune(path, tiny_model_path, 4)
+        assert tune.call_count == 1
+
+
+def test_autotune_measures_the_grid(tiny_model_path):
+    result = autotune.autotune(
+        tiny_model_path,
+        max_threads=2,
+        batch_sizes=(16, 32),
+        prompt_tokens=32,
+        decode_tokens=4,
+        repeats=1,
+    )
+    assert result.n_threads in (1, 2)
+    assert result.n_threads_batch in (1, 2)
+    assert result.n_batch in (16, 32)
+    assert result.decode_tokens_per_s > 0
+    assert result.prefill_tokens_per_s > 0
+
+
+def test_model_service_applies_tuned_settings(tiny_model_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "n_ctx", 1024)
+    monkeypatch.setattr(settings, "model_path", tiny_model_path)
+    monkeypatch.setattr(settings, "num_threads", 4)
+    monkeypatch.setattr(settings, "autotune", True)
+    monkeypatch.setattr(settings, "autotune_cache_path", str(tmp_path / "autotune.json"))
+    # What an offline run with the CLI's default budget stores.
+    save_result(settings.autotune_cache_path, tiny_model_path, thread_budget(), RESULT)
+    service = ModelService()
+    with patch.object(autotune, "autotune", side_effect=AssertionError):
+        service.load_model()
+    model = service.model
+    assert model.context_params.n_threads == 2
+    assert model.context_params.n_threads_batch == 4
+    assert model.n_batch == 256
+    assert "autotune_s" in service.startup_phases
@@ -0,0 +1,203 @@
+import threading
+import time
+
+import pytest
+
+from llama_cpp import Llama
+
+from app.config import settings
+from app.services.batching import BatchEngine, BatchRequest, SamplingParams, _split_on_stop
+from app.services.conversation_service import SYSTEM_PROMPT
+from app.services.model_service import ModelService
+
+GREEDY = SamplingParams(temperature=0.0, top_p=0.9, repeat_penalty=1.1)
+
+
+class _Collector:
+    def __init__(self) -> None:
+        self.events: list[tuple[str, object]] = []
+        self.finished = threading.Event()
+
+    def __call__(self, kind: str, payload: object) -> None:
+        self.events.append((kind, payload))
+        if kind != "token":
+            self.finished.set()
+
+    @property
+    def text(self) -> str:
+        return "".join(p for k, p in self.events if k == "token")
+
+    @property
+    def outcome(self) -> tuple[str, object]:
+        return self.events[-1]
+
+
+@pytest.fixture(scope="module")
+def tiny_llama(tiny_model_path):
+    return Llama(model_path=tiny_model_path, n_ctx=1024, verbose=False)
+
+
+@pytest.fixture()
+def engine(tiny_llama):
+    engine = BatchEngine(tiny_llama, max_sequences=4, n_ctx=1024, sampling=GREEDY)
+    yield engine
+    engine.close()
+
+
+def _prompt(llama: Llama, text: str) -> list[int]:
+    rendered = (
+        f"<|im_start|>system\n{SYSTEM_PROMPT}<|im_end|>\n"
+        f"<|im_start|>user\n{text}<|im_end|>\n<|im_start|>assistant\n"
+    )
+    return llama.tokenize(rendered.encode("utf-8"), add_bos=False, special=True)
+
+
+def _system_tokens(llama: Llama) -> list[int]:
+    rendered = f"<|im_start|>system\n{SYSTEM_PROMPT}<|im_end|>\n"
+    return llama.tokenize(rendered.encode("utf-8"), add_bos=False, special=True)
+
+
+def _reference(llama: Llama, tokens: list[int], max_tokens: int) -> list[int]:
+    """Greedy tokens from the sequential ``Llama.generate`` path."""
+    llama.reset()
+    output = []
+    for token in llama.generate(tokens, temp=0.0, repeat_penalty=GREEDY.repeat_penalty):
+        if token == llama.token_eos() or len(output) == max_tokens:
+            break
+        output.append(token)
+    return output
+
+
+def _text(llama: Llama, tokens: list[int]) -> str:
+    return llama.detokenize(tokens).decode("utf-8", errors="ignore")
+
+
+def _request(tokens: list[int], max_tokens: int = 16, **kwargs) -> BatchRequest:
+    return BatchRequest(
+        tokens=tokens,
+        max_tokens=max_tokens,
+        emit=kwargs.pop("emit", None) or _Collector(),
+        cancel=kwargs.pop("cancel", None) or threading.Event(),
+        deadline=time.monotonic() + 30,
+        **kwargs,
+    )
+
+
+class TestBatchEngine:
+    def test_single_sequence_matches_sequential_decode(self, engine, tiny_llama):
+        tokens = _prompt(tiny_llama, "What is Python?")
+        expected = _reference(tiny_llama, tokens, 16)
+
+        engine.start()
+        request = _request(tokens)
+        engine.submit(request)
+        assert request.emit.finished.wait(10)
+
+        assert request.emit.outcome == ("done", None)
+        assert request.output_tokens == expected
+        assert request.emit.text == _text(tiny_llama, expected)
+
+    def test_long_prompt_is_prefilled_in_chunks(self, tiny_llama):
+        engine = BatchEngine(
+            tiny_llama, max_sequences=4, n_ctx=1024, sampling=GREEDY, n_batch=64
+        )
+        try:
+            tokens = _prompt(tiny_llama, "tell me more " * 60)
+            assert len(tokens) > 1024 // 4  # beyond an even per-sequence split
+            expected = _reference(tiny_llama, tokens, 8)
+            engine.start()
+            request = _request(tokens, max_tokens=8)
+            engine.submit(request)
+            assert request.emit.finished.wait(10)
+            assert request.output_tokens == expected
+        finally:
+            engine.close()
+
+    def test_concurrent_sequences_stay_independent(self, engine, tiny_llama):
+        questions = ["What is Python?", "Name a colour", "hello there, friend"]
+        prompts = [_prompt(tiny_llama, q) for q in questions]
+        expected = [_reference(tiny_llama, p, 16) for p in prompts]
+
+        engine.set_prefix(_system_tokens(tiny_llama))
+        engine.start()
+        requests = [_request(p) for p in prompts]
+        for request in requests:
+            engine.submit(request)
+        for request in requests:
+            assert request.emit.finished.wait(10)
+
+        assert [r.output_tokens for r in requests] == expected
+        # Sequences were decoded together rather than one after another.
+        assert engine.steps < sum(r.n_generated + 1 for r in requests)
+        assert engine.stats()["running"] == 0
+
+    def test_cancelled_sequence_stops(self, engine, tiny_llama):
+        cancel = threading.Event()
+        cancel.set()
+        request = _request(_prompt(tiny_llama, "hi"), cancel=cancel)
+        engine.start()
+        engine.submit(request)
+        assert request.emit.finished.wait(10)
+        assert request.emit.outcome == ("done", "cancelled")
+
+    def test_rejects_request_larger_than_context(self, engine, tiny_llama):
+        with pytest.raises(ValueError):
+            engine.submit(_request(list(range(1000)), max_tokens=100))
+
+    def test_resident_prefix_counts_against_every_admission(self, engine, tiny_llama):
+        prefix = _system_tokens(tiny_llama)
+        engine.set_prefix(prefix)
+        reusing = _request(_prompt(tiny_llama, "hi"))
+        reserved = len(reusing.tokens) - len(prefix) + reusing.max_tokens
+        # Fits beside ``reusing`` only if the prefix cells were free.
+        other = _request([1] * 100, max_tokens=1024 - len(prefix) - reserved - 100 + 1)
+        with pytest.raises(ValueError):
+            engine.submit(_request([1] * 100, max_tokens=1024 - len(prefix) - 100 + 1))
+
+        engine.submit(reusing)
+        engine.submit(other)
+        engine._admit()
+        try:
+            assert engine.stats()["running"] == 1
+            assert engine.stats()["pending"] == 1
+        finally:
+            engine._finish(reusing, reason="cancelled")
+            engine._finish(other, reason="cancelled")
+
+
+class TestSplitOnStop:
+    def test_stop_string_cuts_text(self):
+        assert _split_on_stop("hello</s>rest", ["</s>"]) == ("hello", True, "")
+
+    def test_partial_stop_is_held_back(self):
+        assert _split_on_stop("hello</", ["</s>"]) == ("hello", False, "</")
+
+    def test_plain_text_passes_through(self):
+        assert _split_on_stop("hello", ["</s>"]) == ("hello", False, "")
+
+
+class TestBatchedModelService:
+    @pytest.mark.asyncio
+    async def test_generate_stream_uses_batch_engine(self, tiny_model_path, monkeypatch):
+        monkeypatch.setattr(settings, "batch_max_sequences", 2)
+        monkeypatch.setattr(settings, "n_ctx", 1024)
+        monkeypatch.setattr(settings, "max_new_tokens", 16)
+        monkeypatch.setattr(settings, "temperature", 0.0)
+        service = ModelService()
+        monkeypatch.setattr(settings, "model_path", tiny_model_path)
+        service.load_model()
+        try:
+            messages = [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": "What is Python?"},
+            ]
+            chunks = [c async for c in service.generate_stream_async(messages, "conv-1")]
+            text = "".join(c["data"] for c in chunks if c["event"] == "token")
+
+            reference = Llama(model_path=tiny_model_path, n_ctx=1024, verbose=False)
+            prompt = service._render_tokens(messages, add_generation_prompt=True)
+            expected = _text(reference, _reference(reference, prompt, 16))
+            assert text == expected
+            assert service.batch_engine.stats()["steps"] > 0
+        finally:
+            service.batch_engine.close()
@@ -0,0 +1,84 @@
+import argparse
+import time
+
+import pytest
+from benchmarks import bench_conversation_memory, bench_search
+from benchmarks.fake_llama import FakeLlama, install_fake_model
+from benchmarks.load_test import RequestResult, percentile, summarize
+from app.services.model_service import ModelService
+
+
+class TestFakeLlama:
+    def _timings(self, model: FakeLlama) -> list[float]:
+        timings = []
+        last = time.perf_counter()
+        for _ in model.create_chat_completion(
+            [{"role": "user", "content": "hi"}], max_tokens=5, stream=True
+        ):
+            now = time.perf_counter()
+            timings.append(now - last)
+            last = now
+        return timings
+
+    def test_reply_is_capped_by_max_tokens(self):
+        model = FakeLlama(tokens_per_s=float("inf"), reply_tokens=64)
+        chunks = list(
+            model.create_chat_completion(
+                [{"role": "user", "content": "hi"}], max_tokens=5, stream=True
+            )
+        )
+        contents = [c["choices"][0]["delta"].get("content") for c in chunks]
+        assert contents == [None, "tok0 ", "tok1 ", "tok2 ", "tok3 ", "tok4 "]
+
+    def test_decode_rate_is_respected(self):
+        model = FakeLlama(tokens_per_s=200, prefill_tokens_per_s=float("inf"))
+        timings = self._timings(model)
+        assert sum(timings[1:]) == pytest.approx(5 / 200, rel=0.5)
+
+    def test_serves_generations_through_model_service(self):
+        service = ModelService()
+        install_fake_model(service, FakeLlama(tokens_per_s=float("inf")))
+        assert service.is_loaded
+        assert not service.kv_cache.enabled
+        assert service.count_message_tokens("abcdefgh") == 2 + service._message_overhead
+
+
+class TestLoadTestSummary:
+    def test_percentile_nearest_rank(self):
+        values = [float(v) for v in range(1, 101)]
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([], 50) is None
+
+    def test_summarize_separates_rejections_and_failures(self):
+        results = [
+            RequestResult(status=200, ttft_s=0.1, latency_s=0.5, tokens=10),
+            RequestResult(status=429),
+            RequestResult(status=200, error=True, latency_s=0.2),
+        ]
+        summary = summarize(results, wall_s=1.0)
+        assert summary["succeeded"] == 1
+        assert summary["rejected"] == 1
+        assert summary["failed"] == 1
+        assert summary["tokens_per_s"] == 10
+        assert summary["ttft_ms"]["p50"] == 100
+
+
+def test_conversation_memory_benchmark_runs():
+    args = argparse.Namespace(conversations=20, messages=4, turns=10)
+    results = bench_conversation_memory.main(args)["results"]
+    assert results["message_log"]["bytes_per_message"] > 0
+    assert results["chat_message_list"]["get_history_us"] > 0
+
+
+def test_search_benchmark_runs():
+    args = argparse.Namespace(
+        messages=500, per_conversation=10, vocabulary=1000, limit=5, repeats=2, seed=0
+    )
+    results = bench_search.main(args)["results"]
+    for backend in ("inverted_index", "sqlite_fts5", "scan"):
+        assert results[backend]["common_word"]["hits"] == 5
+    assert (
+        results["inverted_index"]["two_words"]["hits"]
+        == results["sqlite_fts5"]["two_words"]["hits"]
+    )
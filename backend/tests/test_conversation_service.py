@@ -1,5 +1,10 @@
 import pytest
-from app.services.conversation_service import ConversationService, SYSTEM_PROMPT
+from app.services.conversation_service import (
+    ConversationService,
+    SUMMARY_PREFIX,
+    SYSTEM_PROMPT,
+    encode_cursor,
+)
 
 
 @pytest.fixture()
@@ -12,7 +17,7 @@ class TestGetOrCreate:
         convo = service.get_or_create("conv-1")
         assert convo.id == "conv-1"
         assert convo.title == "New conversation"
-        assert convo.messages == []
+        assert len(convo.messages) == 0
 
     def test_returns_existing_conversation(self, service):
         first = service.get_or_create("conv-1")
@@ -61,6 +66,121 @@ class TestGetHistory:
         assert history[1] == {"role": "user", "content": "hello"}
         assert history[2] == {"role": "assistant", "content": "hi there"}
 
+    def test_history_is_extended_not_rebuilt(self, service):
+        service.add_message("conv-1", "user", "hello")
+        first = service.get_history("conv-1")
+        service.add_message("conv-1", "assistant", "hi there")
+        second = service.get_history("conv-1")
+        assert second[1] is first[1]
+        assert second[2] == {"role": "assistant", "content": "hi there"}
+
+    def test_views_are_bounded(self):
+        service = ConversationService(view_cache_size=2)
+        for i in range(3):
+            service.add_message(f"conv-{i}", "user", f"message {i}")
+            service.get_history(f"conv-{i}")
+        assert list(service._views) == ["conv-1", "conv-2"]
+        assert service.get_history("conv-0")[1]["content"] == "message 0"
+
+
+class TestTokenCounts:
+    def test_counts_unknown_without_tokenizer(self, service):
+        service.add_message("conv-1", "user", "hello")
+        assert service.get_token_counts("conv-1") == [None, None]
+
+    def test_counts_line_up_with_history(self):
+        service = ConversationService(token_counter=len)
+        service.add_message("conv-1", "user", "hello")
+        service.add_message("conv-1", "assistant", "hi")
+        assert service.get_token_counts("conv-1") == [len(SYSTEM_PROMPT), 5, 2]
+
+    def test_each_message_is_counted_once(self):
+        calls = []
+
+        def counter(content: str) -> int:
+            calls.append(content)
+            return 1
+
+        service = ConversationService(token_counter=counter)
+        service.add_message("conv-1", "user", "hello")
+        service.get_token_counts("conv-1")
+        service.get_token_counts("conv-1")
+        assert calls == ["hello", SYSTEM_PROMPT]
+
+    def test_messages_stored_before_tokenizer_are_counted_lazily(self, service):
+        service.add_message("conv-1", "user", "hello")
+        service.set_token_counter(len)
+        assert service.get_token_counts("conv-1") == [len(SYSTEM_PROMPT), 5]
+
+
+def _chat(service: ConversationService, *turns: str) -> None:
+    for i, content in enumerate(turns):
+        service.add_message("conv-1", "user" if i % 2 == 0 else "assistant", content)
+
+
+class TestRollingSummary:
+    def test_nothing_due_under_budget(self):
+        service = ConversationService(token_counter=len, summary_trigger_tokens=100)
+        _chat(service, "hello", "hi there")
+        assert service.pending_summary("conv-1") is None
+
+    def test_disabled_without_tokenizer(self):
+        service = ConversationService(summary_trigger_tokens=1)
+        _chat(service, "hello", "hi there")
+        assert service.pending_summary("conv-1") is None
+
+    def test_oldest_turns_are_due_and_cut_on_a_user_turn(self):
+        service = ConversationService(token_counter=len, summary_trigger_tokens=20)
+        _chat(service, "aaaaaaaaaa", "bbbbbbbbbb", "cccc", "dddd")
+        job = service.pending_summary("conv-1")
+        assert (job.start, job.end) == (0, 2)
+        assert [m["content"] for m in job.messages] == ["aaaaaaaaaa", "bbbbbbbbbb"]
+
+    def test_latest_exchange_is_kept(self):
+        service = ConversationService(token_counter=len, summary_trigger_tokens=4)
+        _chat(service, "aaaaaaaaaa", "bbbbbbbbbb", "cccccccccc", "dddddddddd")
+        assert service.pending_summary("conv-1").end == 2
+
+    def test_history_replaces_summarized_turns(self):
+        service = ConversationService(token_counter=len, summary_trigger_tokens=20)
+        _chat(service, "aaaaaaaaaa", "bbbbbbbbbb", "cccc", "dddd")
+        assert service.apply_summary(service.pending_summary("conv-1"), "gist")
+        history = service.get_history("conv-1")
+        assert history[1] == {"role": "system", "content": SUMMARY_PREFIX + "gist"}
+        assert [m["content"] for m in history[2:]] == ["cccc", "dddd"]
+        assert service.get_token_counts("conv-1") == [
+            len(SYSTEM_PROMPT),
+            len(SUMMARY_PREFIX + "gist"),
+            4,
+            4,
+        ]
+
+    def test_existing_view_drops_summarized_turns(self):
+        service = ConversationService(token_counter=len, summary_trigger_tokens=20)
+        _chat(service, "aaaaaaaaaa", "bbbbbbbbbb", "cccc", "dddd")
+        assert len(service.get_history("conv-1")) == 5
+        service.apply_summary(service.pending_summary("conv-1"), "gist")
+        history = service.get_history("conv-1")
+        assert [m["content"] for m in history[2:]] == ["cccc", "dddd"]
+
+    def test_next_summary_starts_where_the_last_ended(self):
+        service = ConversationService(token_counter=len, summary_trigger_tokens=20)
+        _chat(service, "aaaaaaaaaa", "bbbbbbbbbb", "cccc", "dddd")
+        service.apply_summary(service.pending_summary("conv-1"), "gist")
+        _chat(service, "eeeeeeeeee", "ffffffffff")
+        job = service.pending_summary("conv-1")
+        assert job.start == 2
+        assert job.previous_summary == "gist"
+
+    def test_stale_job_is_not_applied(self):
+        service = ConversationService(token_counter=len, summary_trigger_tokens=20)
+        _chat(service, "aaaaaaaaaa", "bbbbbbbbbb", "cccc", "dddd")
+        job = service.pending_summary("conv-1")
+        assert service.apply_summary(job, "gist")
+        assert not service.apply_summary(job, "gist again")
+        service.delete_conversation("conv-1")
+        assert not service.apply_summary(job, "gist")
+
 
 class TestListConversations:
     def test_empty_store(self, service):
@@ -79,6 +199,27 @@ class TestListConversations:
         result = service.list_conversations()
         assert result[0]["message_count"] == 2
 
+    def test_pages_follow_cursor(self, service):
+        for i in range(5):
+            service.add_message(f"conv-{i}", "user", f"message {i}")
+
+        first = service.list_conversations(limit=2)
+        second = service.list_conversations(limit=2, before=encode_cursor(first[-1]))
+        third = service.list_conversations(limit=2, before=encode_cursor(second[-1]))
+        ids = [c["id"] for c in first + second + third]
+        assert ids == ["conv-4", "conv-3", "conv-2", "conv-1", "conv-0"]
+
+    def test_updated_conversation_moves_to_front(self, service):
+        service.add_message("conv-1", "user", "first")
+        service.add_message("conv-2", "user", "second")
+        service.add_message("conv-1", "assistant", "reply")
+        result = service.list_conversations(limit=1)
+        assert [c["id"] for c in result] == ["conv-1"]
+
+    def test_invalid_cursor_raises(self, service):
+        with pytest.raises(ValueError):
+            service.list_conversations(before="not a cursor")
+
 
 class TestDeleteConversation:
     def test_delete_existing(self, service):
@@ -0,0 +1,242 @@
+import sqlite3
+
+import pytest
+from app.services.conversation_service import ConversationService, encode_cursor
+from app.services.conversation_store import (
+    InMemoryConversationStore,
+    MessageLog,
+    SQLiteConversationStore,
+    create_conversation_store,
+)
+
+
+@pytest.fixture()
+def db_path(tmp_path):
+    return str(tmp_path / "conversations.db")
+
+
+class TestMessageLog:
+    def test_reads_back_appended_messages(self):
+        log = MessageLog()
+        log.append("user", "hello", timestamp=1.5, token_count=3)
+        log.append("assistant", "hi")
+        assert len(log) == 2
+        assert log[0] == ("user", "hello", 1.5, 3)
+        assert log[-1].role == "assistant"
+        assert log.token_count(1) is None
+        log.set_token_count(1, 2)
+        assert [m.token_count for m in log] == [3, 2]
+
+    def test_rejects_unknown_role(self):
+        with pytest.raises(KeyError):
+            MessageLog().append("tool", "output")
+
+
+class TestSQLiteConversationStore:
+    def test_conversations_survive_reopen(self, db_path):
+        store = SQLiteConversationStore(db_path)
+        service = ConversationService(store=store)
+        service.add_message("conv-1", "user", "What is Python?")
+        service.add_message("conv-1", "assistant", "A language.")
+        store.close()
+
+        reopened = ConversationService(store=SQLiteConversationStore(db_path))
+        history = reopened.get_history("conv-1")
+        assert [m["content"] for m in history[1:]] == [
+            "What is Python?",
+            "A language.",
+        ]
+        assert reopened.get_or_create("conv-1").title == "What is Python?"
+
+    def test_message_timestamps_survive_reopen(self, db_path):
+        store = SQLiteConversationStore(db_path)
+        service = ConversationService(store=store)
+        service.add_message("conv-1", "user", "hello")
+        stored = store.get("conv-1").messages[0]
+        store.close()
+
+        reloaded = SQLiteConversationStore(db_path).get("conv-1").messages[0]
+        assert reloaded == stored
+
+    def test_cached_conversation_is_served_from_memory(self, db_path):
+        store = SQLiteConversationStore(db_path)
+        service = ConversationService(store=store)
+        service.add_message("conv-1", "user", "hello")
+
+        first = store.get("conv-1")
+        second = store.get("conv-1")
+        assert first is second
+
+    def test_hot_cache_is_bounded(self, db_path):
+        store = SQLiteConversationStore(db_path, cache_size=2)
+        service = ConversationService(store=store)
+        for i in range(3):
+            service.add_message(f"conv-{i}", "user", f"message {i}")
+
+        assert list(store._hot) == ["conv-1", "conv-2"]
+        # The evicted conversation is still loaded back from disk.
+        assert store.get("conv-0").messages[0].content == "message 0"
+
+    def test_external_writes_invalidate_hot_cache(self, db_path):
+        store = SQLiteConversationStore(db_path)
+        service = ConversationService(store=store)
+        service.add_message("conv-1", "user", "hello")
+        cached = store.get("conv-1")
+
+        other = ConversationService(store=SQLiteConversationStore(db_path))
+        other.add_message("conv-1", "assistant", "hi from another worker")
+
+        reloaded = store.get("conv-1")
+        assert reloaded is not cached
+        assert [m.content for m in reloaded.messages] == [
+            "hello",
+            "hi from another worker",
+        ]
+
+    def test_external_writes_keep_other_conversations_cached(self, db_path):
+        store = SQLiteConversationStore(db_path)
+        service = ConversationService(store=store)
+        service.add_message("conv-1", "user", "hello")
+        service.add_message("conv-2", "user", "hey")
+        cached = store.get("conv-1")
+
+        other = ConversationService(store=SQLiteConversationStore(db_path))
+        other.add_message("conv-2", "assistant", "hi from another worker")
+
+        assert store.get("conv-1") is cached
+        assert len(store.get("conv-2").messages) == 2
+        other.delete_conversation("conv-1")
+        assert store.get("conv-1") is None
+
+    def test_delete_removes_messages(self, db_path):
+        store = SQLiteConversationStore(db_path)
+        service = ConversationService(store=store)
+        service.add_message("conv-1", "user", "hello")
+
+        assert service.delete_conversation("conv-1") is True
+        assert service.delete_conversation("conv-1") is False
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
+
+    def test_list_is_ordered_with_counts(self, db_path):
+        service = ConversationService(store=SQLiteConversationStore(db_path))
+        service.add_message("conv-1", "user", "first")
+        service.add_message("conv-2", "user", "second")
+        service.add_message("conv-1", "assistant", "reply")
+
+        result = service.list_conversations()
+        assert [c["id"] for c in result] == ["conv-1", "conv-2"]
+        assert [c["message_count"] for c in result] == [2, 1]
+
+    def test_pages_follow_cursor(self, db_path):
+        service = ConversationService(store=SQLiteConversationStore(db_path))
+        for i in range(5):
+            service.add_message(f"conv-{i}", "user", f"message {i}")
+
+        first = service.list_conversations(limit=3)
+        rest = service.list_conversations(limit=3, before=encode_cursor(first[-1]))
+        assert [c["id"] for c in first + rest] == [
+            "conv-4",
+            "conv-3",
+            "conv-2",
+            "conv-1",
+            "conv-0",
+        ]
+
+    def test_summary_survives_reopen(self, db_path):
+        store = SQLiteConversationStore(db_path)
+        service = ConversationService(store=store, token_counter=len, summary_trigger_tokens=10)
+        service.add_message("conv-1", "user", "first question")
+        service.add_message("conv-1", "assistant", "first answer")
+        service.add_message("conv-1", "user", "second")
+        service.add_message("conv-1", "assistant", "ok")
+        job = service.pending_summary("conv-1")
+        assert service.apply_summary(job, "They asked a first question.")
+        store.close()
+
+        reopened = ConversationService(store=SQLiteConversationStore(db_path))
+        history = reopened.get_history("conv-1")
+        assert "They asked a first question." in history[1]["content"]
+        assert [m["content"] for m in history[2:]] == ["second", "ok"]
+
+    def test_adds_summary_columns_to_older_databases(self, db_path):
+        conn = sqlite3.connect(db_path)
+        conn.execute(
+            "CREATE TABLE conversations (id TEXT PRIMARY KEY, title TEXT NOT NULL, "
+            "created_at TEXT NOT NULL, updated_at TEXT NOT NULL, "
+            "message_count INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.commit()
+        conn.close()
+        service = ConversationService(store=SQLiteConversationStore(db_path))
+        service.add_message("conv-1", "user", "hello")
+        assert service.get_or_create("conv-1").summarized_count == 0
+
+    def test_uses_wal_journal(self, db_path):
+        SQLiteConversationStore(db_path)
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def _filled(store) -> ConversationService:
+    service = ConversationService(store=store)
+    service.add_message("trip", "user", "Plan a weekend in Paris")
+    service.add_message("trip", "assistant", "Paris in spring: the Louvre, then Montmartre.")
+    service.add_message("food", "user", "Best cheese in France?")
+    service.add_message("food", "assistant", "Comté and Roquefort.")
+    return service
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, db_path):
+    return create_conversation_store(request.param, db_path, cache_size=10)
+
+
+class TestSearch:
+    def test_finds_messages_with_every_term(self, store):
+        service = _filled(store)
+        hits = service.search("paris")
+        assert {(h["conversation_id"], h["message_index"]) for h in hits} == {
+            ("trip", 0),
+            ("trip", 1),
+        }
+        hit = service.search("France cheese")[0]
+        assert hit["conversation_id"] == "food"
+        assert hit["title"] == "Best cheese in France?"
+        assert hit["role"] == "user"
+        assert hit["snippet"] == "Best cheese in France?"
+        assert hit["score"] >= 0
+        assert service.search("paris cheese") == []
+        assert service.search("\"paris\" OR") == []
+
+    def test_deleted_conversations_are_not_found(self, store):
+        service = _filled(store)
+        service.delete_conversation("trip")
+        assert service.search("paris") == []
+        assert len(service.search("cheese")) == 1
+
+    def test_indexes_messages_stored_before_search(self, db_path):
+        _filled(SQLiteConversationStore(db_path))
+        conn = sqlite3.connect(db_path)
+        conn.executescript(
+            "DROP TRIGGER messages_fts_insert; DROP TRIGGER messages_fts_delete; "
+            "DROP TABLE messages_fts;"
+        )
+        conn.close()
+        service = ConversationService(store=SQLiteConversationStore(db_path))
+        assert len(service.search("louvre")) == 1
+
+
+class TestCreateConversationStore:
+    def test_memory_backend(self, db_path):
+        store = create_conversation_store("memory", db_path, 10)
+        assert isinstance(store, InMemoryConversationStore)
+
+    def test_sqlite_backend(self, db_path):
+        store = create_conversation_store("sqlite", db_path, 10)
+        assert isinstance(store, SQLiteConversationStore)
+        assert store.cache_size == 10
+
+    def test_unknown_backend(self, db_path):
+        with pytest.raises(ValueError):
+            create_conversation_store("redis", db_path, 10)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from app.services.kv_cache import KVSnapshot, KVStateCache
+
+
+def _snapshot(n_tokens: int, state_bytes: int) -> KVSnapshot:
+    return KVSnapshot(
+        tokens=np.arange(n_tokens, dtype=np.intc),
+        state=bytes(range(256)) * (state_bytes // 256),
+    )
+
+
+@pytest.fixture()
+def snapshot():
+    return _snapshot(n_tokens=4, state_bytes=1024)
+
+
+class TestMemoryTier:
+    def test_miss_then_hit(self, snapshot):
+        cache = KVStateCache(capacity_bytes=10_000)
+        assert cache.get("conv-1") is None
+        cache.put("conv-1", snapshot)
+        assert cache.get("conv-1") is snapshot
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["bytes"] == snapshot.nbytes
+
+    def test_evicts_least_recently_used_by_bytes(self, snapshot):
+        cache = KVStateCache(capacity_bytes=snapshot.nbytes * 2)
+        cache.put("conv-1", snapshot)
+        cache.put("conv-2", snapshot)
+        cache.get("conv-1")
+        cache.put("conv-3", snapshot)
+        assert cache.get("conv-2") is None
+        assert cache.get("conv-1") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_replacing_entry_does_not_double_count(self, snapshot):
+        cache = KVStateCache(capacity_bytes=10_000)
+        cache.put("conv-1", snapshot)
+        cache.put("conv-1", snapshot)
+        assert cache.stats()["bytes"] == snapshot.nbytes
+
+    def test_disabled_cache_stores_nothing(self, snapshot):
+        cache = KVStateCache(capacity_bytes=0)
+        cache.put("conv-1", snapshot)
+        assert cache.enabled is False
+        assert cache.get("conv-1") is None
+
+    def test_discard_removes_entry(self, snapshot):
+        cache = KVStateCache(capacity_bytes=10_000)
+        cache.put("conv-1", snapshot)
+        cache.discard("conv-1")
+        assert cache.get("conv-1") is None
+        assert cache.stats()["bytes"] == 0
+
+
+class TestDiskTier:
+    def test_evicted_snapshot_is_spilled_and_promoted(self, tmp_path, snapshot):
+        cache = KVStateCache(
+            capacity_bytes=snapshot.nbytes,
+            spill_dir=str(tmp_path),
+            spill_capacity_bytes=10_000,
+        )
+        cache.put("conv-1", snapshot)
+        cache.put("conv-2", snapshot)
+        assert cache.stats()["disk_entries"] == 1
+
+        restored = cache.get("conv-1")
+        assert restored is not None
+        assert np.array_equal(restored.tokens, snapshot.tokens)
+        assert restored.state == snapshot.state
+        stats = cache.stats()
+        assert stats["disk_hits"] == 1
+        assert stats["entries"] == 1
+        assert stats["disk_entries"] == 1  # conv-2 was spilled to make room
+
+    def test_disk_tier_is_bounded(self, tmp_path, snapshot):
+        cache = KVStateCache(
+            capacity_bytes=snapshot.nbytes,
+            spill_dir=str(tmp_path),
+            spill_capacity_bytes=snapshot.nbytes,
+        )
+        for key in ("conv-1", "conv-2", "conv-3"):
+            cache.put(key, snapshot)
+        assert cache.stats()["disk_entries"] == 1
+        assert len(list(tmp_path.iterdir())) == 1
+
+    def test_discard_removes_spilled_file(self, tmp_path, snapshot):
+        cache = KVStateCache(
+            capacity_bytes=snapshot.nbytes,
+            spill_dir=str(tmp_path),
+            spill_capacity_bytes=10_000,
+        )
+        cache.put("conv-1", snapshot)
+        cache.put("conv-2", snapshot)
+        cache.discard("conv-1")
+        assert list(tmp_path.iterdir()) == []
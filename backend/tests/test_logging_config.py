@@ -0,0 +1,143 @@
+import io
+import json
+import logging
+import threading
+
+import pytest
+
+from app.logging_config import (
+    JSONFormatter,
+    QueuedStreamHandler,
+    RequestSampler,
+    setup_logging,
+)
+
+
+def _record(message: str = "hello", level: int = logging.INFO, **extra) -> logging.LogRecord:
+    record = logging.LogRecord("test", level, __file__, 1, message, None, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class _CountingStream(io.StringIO):
+    def __init__(self) -> None:
+        super().__init__()
+        self.writes = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def write(self, text: str) -> int:
+        self.release.wait()
+        self.writes += 1
+        return super().write(text)
+
+
+@pytest.fixture()
+def stream():
+    return _CountingStream()
+
+
+def _handler(stream, max_records: int = 100, batch_size: int = 256) -> QueuedStreamHandler:
+    handler = QueuedStreamHandler(stream, max_records, batch_size)
+    handler.setFormatter(JSONFormatter())
+    return handler
+
+
+class TestJSONFormatter:
+    def test_uses_record_time_and_extras(self):
+        record = _record(conversation_id="conv-1", elapsed_s=1.5)
+        record.created = 0.0
+        entry = json.loads(JSONFormatter().format(record))
+        assert entry["timestamp"] == "1970-01-01T00:00:00+00:00"
+        assert entry["conversation_id"] == "conv-1"
+        assert entry["elapsed_s"] == 1.5
+
+
+class TestQueuedStreamHandler:
+    def test_writes_every_record_in_batches(self, stream):
+        stream.release.clear()
+        handler = _handler(stream)
+        for i in range(20):
+            handler.handle(_record(f"line {i}"))
+        stream.release.set()
+        handler.flush()
+        lines = stream.getvalue().splitlines()
+        assert [json.loads(line)["message"] for line in lines] == [
+            f"line {i}" for i in range(20)
+        ]
+        # At most one write for the record the writer took before the stream
+        # unblocked, and one for everything queued behind it.
+        assert stream.writes <= 2
+        handler.close()
+
+    def test_message_arguments_are_frozen_at_emit(self, stream):
+        handler = _handler(stream)
+        items = ["a"]
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "%s", (items,), None)
+        handler.handle(record)
+        items.append("b")
+        handler.flush()
+        assert json.loads(stream.getvalue())["message"] == "['a']"
+        handler.close()
+
+    def test_full_queue_drops_and_reports(self, stream):
+        stream.release.clear()
+        handler = _handler(stream, max_records=2)
+        handler.handle(_record("taken by the writer"))
+        while handler._queue.qsize():
+            pass
+        for i in range(5):
+            handler.handle(_record(f"queued {i}"))
+        assert handler.dropped == 3
+        stream.release.set()
+        handler.flush()
+        handler.handle(_record("after"))
+        handler.flush()
+        messages = [json.loads(line)["message"] for line in stream.getvalue().splitlines()]
+        assert "Log queue full; dropped 3 records" in messages
+        assert messages[-1] == "after"
+        handler.close()
+
+    def test_close_writes_pending_records(self, stream):
+        handler = _handler(stream)
+        for i in range(5):
+            handler.handle(_record(f"line {i}"))
+        handler.close()
+        assert len(stream.getvalue().splitlines()) == 5
+
+
+class TestRequestSampler:
+    def test_rate_zero_drops_per_request_info(self):
+        sampler = RequestSampler(0.0)
+        assert not sampler.filter(_record(conversation_id="conv-1"))
+        assert sampler.sampled_out == 1
+
+    def test_warnings_and_untagged_lines_always_pass(self):
+        sampler = RequestSampler(0.0)
+        assert sampler.filter(_record(level=logging.WARNING, conversation_id="conv-1"))
+        assert sampler.filter(_record())
+
+    def test_decision_is_per_conversation(self):
+        sampler = RequestSampler(0.5)
+        kept = {
+            f"conv-{i}": sampler.filter(_record(conversation_id=f"conv-{i}"))
+            for i in range(200)
+        }
+        assert 50 < sum(kept.values()) < 150
+        for conversation_id, keep in kept.items():
+            assert sampler.filter(_record(conversation_id=conversation_id)) is keep
+
+
+def test_setup_logging_replaces_queued_handler():
+    root = logging.getLogger()
+    saved = root.handlers[:], root.level
+    try:
+        first = setup_logging("DEBUG", queue_size=10, sample_rate=0.5)
+        assert isinstance(first, QueuedStreamHandler)
+        assert any(isinstance(f, RequestSampler) for f in first.filters)
+        second = setup_logging("INFO")
+        assert not first._thread.is_alive()
+        assert root.handlers == [second]
+    finally:
+        root.handlers[:] = saved[0]
+        root.setLevel(saved[1])
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+from app.services.metrics import Counter, Gauge, Histogram, MetricsRegistry, _Metric
+
+
+class TestCounter:
+    def test_sums_increments_across_threads(self):
+        counter = Counter("test_total", "Test counter.")
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        counter.inc(2)
+
+        assert counter.value == 4002
+
+    def test_exited_threads_keep_their_counts(self):
+        counter = Counter("test_total", "Test counter.")
+        for _ in range(3):
+            t = threading.Thread(target=counter.inc)
+            t.start()
+            t.join()
+        assert counter.value == 3
+        # Scraping folded the dead threads' shards into one total.
+        assert counter.labels()._values._shards == []
+        assert counter.value == 3
+
+    def test_dead_shards_are_folded_without_scrapes(self):
+        counter = Counter("test_total", "Test counter.")
+        for _ in range(50):
+            t = threading.Thread(target=counter.inc)
+            t.start()
+            t.join()
+        # Each new thread retires the previous one's shard.
+        assert len(counter.labels()._values._shards) == 1
+        assert counter.value == 50
+
+    def test_labels_are_separate_series(self):
+        counter = Counter("test_total", "Test counter.", labelnames=("outcome",))
+        counter.labels("ok").inc()
+        counter.labels("ok").inc()
+        counter.labels("error").inc()
+        lines = counter.expose()
+        assert 'test_total{outcome="error"} 1' in lines
+        assert 'test_total{outcome="ok"} 2' in lines
+
+    def test_wrong_label_count_raises(self):
+        counter = Counter("test_total", "Test counter.", labelnames=("outcome",))
+        with pytest.raises(ValueError):
+            counter.labels()
+
+
+class TestHistogram:
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram("test_seconds", "Test histogram.", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        cumulative, count, total = histogram.snapshot()
+        assert cumulative == [2, 3, 4]
+        assert count == 4
+        assert total == pytest.approx(2.65)
+
+    def test_exposition(self):
+        histogram = Histogram("test_seconds", "Test histogram.", buckets=(1.0,))
+        histogram.observe(0.5)
+        assert histogram.expose() == [
+            "# HELP test_seconds Test histogram.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="1"} 1',
+            'test_seconds_bucket{le="+Inf"} 1',
+            "test_seconds_sum 0.5",
+            "test_seconds_count 1",
+        ]
+
+
+class TestRegistry:
+    def test_gauge_reads_callback_at_scrape(self):
+        registry = MetricsRegistry()
+        value = {"n": 1}
+        registry.register(Gauge("test_gauge", "Test gauge.", lambda: value["n"]))
+        value["n"] = 3
+        assert "test_gauge 3\n" in registry.expose()
+
+    def test_metric_kinds_must_define_their_children(self):
+        class Untyped(_Metric):
+            kind = "untyped"
+
+        with pytest.raises(TypeError):
+            Untyped("test_untyped", "Missing child hooks.")
+
+    def test_reregistering_replaces_metric(self):
+        registry = MetricsRegistry()
+        registry.register(Counter("test_total", "Old."))
+        registry.register(Counter("test_total", "New."))
+        assert registry.expose().count("# TYPE test_total") == 1
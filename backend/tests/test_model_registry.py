@@ -0,0 +1,213 @@
+from unittest.mock import patch
+
+import pytest
+
+from app.config import settings
+from app.services import model_registry as registry_module
+from app.services.model_registry import ModelRegistry, parse_variants
+from app.services.model_service import GenerationScheduler, ModelService
+
+
+class TestParseVariants:
+    def test_parses_names_and_files(self):
+        assert parse_variants(" q4=model-q4.gguf, local=/models/q2.gguf ,") == {
+            "q4": "model-q4.gguf",
+            "local": "/models/q2.gguf",
+        }
+
+    def test_empty(self):
+        assert parse_variants("") == {}
+
+    @pytest.mark.parametrize("spec", ["q4", "=x.gguf", "q4=", "default=x.gguf"])
+    def test_rejects_malformed(self, spec):
+        with pytest.raises(ValueError):
+            parse_variants(spec)
+
+
+def _fake_load(self, model_path=None):
+    self.model_path = model_path
+    self._loaded = True
+
+
+@pytest.fixture()
+def variant_file(tmp_path):
+    path = tmp_path / "small.gguf"
+    path.write_bytes(b"")
+    return str(path)
+
+
+def _registry(variant_file, **kwargs) -> ModelRegistry:
+    primary = ModelService(scheduler=GenerationScheduler(max_concurrent=1, max_queued=8))
+    primary._loaded = True
+    return ModelRegistry(primary, files={"small": variant_file}, **kwargs)
+
+
+class TestSwitching:
+    def test_activate_requires_a_loaded_variant(self, variant_file):
+        registry = _registry(variant_file)
+        with pytest.raises(ValueError):
+            registry.activate("small")
+        assert registry.state("small") == "unloaded"
+
+    def test_new_requests_switch_and_old_ones_keep_their_model(self, variant_file):
+        registry = _registry(variant_file)
+        before = registry.serving()
+        with patch.object(ModelService, "load_model", _fake_load):
+            variant = registry.load("small")
+        assert registry.serving() is before
+        registry.activate("small")
+        assert registry.serving() is variant
+        assert registry.serving_name == "small"
+        assert registry.serving_variant() == ("small", variant)
+        assert variant.model_path == variant_file
+        # Variants queue with the primary's requests.
+        assert variant.scheduler is before.scheduler
+
+    def test_background_load_activates_when_ready(self, variant_file):
+        registry = _registry(variant_file)
+        with patch.object(ModelService, "load_model", _fake_load):
+            with patch("threading.Thread.start", lambda t: t.run()):
+                registry.load_in_background("small", activate=True)
+        assert registry.active == "small"
+
+    def test_failed_load_is_reported(self, tmp_path):
+        registry = _registry(str(tmp_path / "missing.gguf"))
+        with pytest.raises(FileNotFoundError):
+            registry.load("small")
+        assert registry.state("small") == "failed"
+        assert registry.active == "default"
+
+    def test_spilled_snapshots_are_kept_apart(self, variant_file, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "kv_cache_spill_dir", str(tmp_path / "spill"))
+        registry = _registry(variant_file)
+        with patch.object(ModelService, "load_model", _fake_load):
+            variant = registry.load("small")
+        assert variant.kv_cache.spill_dir == str(tmp_path / "spill" / "small")
+
+
+class TestUnload:
+    def test_refuses_models_in_use(self, variant_file):
+        registry = _registry(variant_file)
+        with patch.object(ModelService, "load_model", _fake_load):
+            variant = registry.load("small")
+        with pytest.raises(ValueError):
+            registry.unload("default")
+        registry.activate("small")
+        with pytest.raises(ValueError):
+            registry.unload("small")
+        registry.activate("default")
+        variant.generations_in_flight = 1
+        with pytest.raises(ValueError):
+            registry.unload("small")
+
+    def test_refuses_variants_with_queued_requests(self, variant_file):
+        registry = _registry(variant_file)
+        with patch.object(ModelService, "load_model", _fake_load):
+            registry.load("small")
+        registry.activate("small")
+        name, variant = registry.acquire()
+        assert (name, variant) == ("small", registry.serving())
+        registry.activate("default")
+        # Still waiting in the queue: nothing is generating on it yet.
+        assert variant.generations_in_flight == 0
+        with pytest.raises(ValueError):
+            registry.unload("small")
+        registry.release("small")
+        registry.unload("small")
+
+    def test_unloads_an_idle_variant(self, variant_file):
+        registry = _registry(variant_file)
+        with patch.object(ModelService, "load_model", _fake_load):
+            variant = registry.load("small")
+        registry.unload("small")
+        assert registry.state("small") == "unloaded"
+        assert not variant.is_loaded
+        with pytest.raises(KeyError):
+            registry.unload("small")
+
+
+class TestLoadShedding:
+    def _shedding(self, variant_file, **kwargs) -> ModelRegistry:
+        registry = _registry(variant_file, shed_variant="small", **kwargs)
+        with patch.object(ModelService, "load_model", _fake_load):
+            registry.load("small")
+        return registry
+
+    def test_unknown_variant_is_rejected(self, variant_file):
+        with pytest.raises(ValueError):
+            _registry(variant_file, shed_variant="tiny")
+
+    def test_queue_depth_routes_to_the_smaller_variant(self, variant_file, monkeypatch):
+        monkeypatch.setattr(registry_module, "_SHED_MIN_HOLD_S", 0.0)
+        registry = self._shedding(variant_file, shed_queue_depth=2)
+        scheduler = registry.scheduler
+        tickets = [scheduler.submit() for _ in range(2)]
+        assert registry.serving_name == "default"
+        assert registry.serving() is registry._services["default"]
+
+        tickets.append(scheduler.submit())
+        assert registry.serving() is registry._services["small"]
+        assert registry.shedding
+        assert registry.active == "default"
+
+        # One waiting request is not yet below half the threshold.
+        tickets.pop().release()
+        registry.serving()
+        assert registry.shedding
+        tickets.pop().release()
+        assert registry.serving() is registry._services["default"]
+        tickets.pop().release()
+
+    def test_ttft_average_triggers_and_releases(self, variant_file, monkeypatch):
+        monkeypatch.setattr(registry_module, "_SHED_MIN_HOLD_S", 0.0)
+        registry = self._shedding(variant_file, shed_ttft_s=2.0)
+        registry.record_ttft(1.0)
+        assert registry.serving_name == "default"
+        for _ in range(10):
+            registry.record_ttft(5.0)
+        assert registry.serving() is registry._services["small"]
+        for _ in range(30):
+            registry.record_ttft(0.1)
+        assert registry.serving_name == "small"
+        assert registry.serving() is registry._services["default"]
+
+    def test_holds_for_a_minimum_time(self, variant_file):
+        registry = self._shedding(variant_file, shed_ttft_s=2.0)
+        registry.record_ttft(5.0)
+        registry.serving()
+        for _ in range(30):
+            registry.record_ttft(0.0)
+        assert registry.serving() is registry._services["small"]
+
+    def test_not_loaded_variant_is_not_used(self, variant_file):
+        registry = _registry(variant_file, shed_variant="small", shed_ttft_s=1.0)
+        registry.record_ttft(5.0)
+        assert registry.serving_name == "default"
+        assert not registry.shedding
+
+
+def test_stats(variant_file):
+    registry = _registry(variant_file)
+    stats = registry.stats()
+    assert stats["active"] == stats["serving"] == "default"
+    assert stats["variants"]["default"]["state"] == "loaded"
+    assert stats["variants"]["small"] == {
+        "state": "unloaded",
+        "model_id": variant_file,
+        "in_flight": 0,
+    }
+
+
+def test_loads_and_unloads_a_real_variant(tiny_model_path, monkeypatch):
+    monkeypatch.setattr(settings, "n_ctx", 512)
+    monkeypatch.setattr(settings, "warmup_tokens", 0)
+    monkeypatch.setattr(settings, "semantic_cache_max_entries", 8)
+    registry = _registry(tiny_model_path)
+    variant = registry.load("small")
+    assert variant.is_loaded and variant.replicas
+    embedder = variant.embedder
+    with patch.object(embedder, "close", wraps=embedder.close) as close:
+        registry.unload("small")
+    close.assert_called_once()
+    assert variant.replicas == []
+    assert variant.embedder is None
@@ -1,5 +1,27 @@
+import asyncio
+import os
+import threading
+import time
+
 import pytest
-from app.services.model_service import ModelService
+from unittest.mock import MagicMock, patch
+
+from llama_cpp import Llama
+
+from app.config import settings
+from app.services import metrics
+from app.services.conversation_service import SYSTEM_PROMPT
+from app.services.kv_cache import KVStateCache, restore_snapshot
+from app.services.profiling import RequestProfile, current_profile
+from app.services.model_service import (
+    GenerationScheduler,
+    ModelReplica,
+    ModelService,
+    QueueFullError,
+    _core_slices,
+    _prefetch_file,
+    _resolve_model_file,
+)
 
 
 @pytest.fixture()
@@ -7,7 +29,22 @@ def service():
     return ModelService()
 
 
+@pytest.fixture()
+def loaded_service(tiny_model_path, monkeypatch):
+    monkeypatch.setattr(settings, "n_ctx", 1024)
+    monkeypatch.setattr(settings, "max_new_tokens", 16)
+    monkeypatch.setattr(settings, "temperature", 0.0)
+    service = ModelService()
+    monkeypatch.setattr(settings, "model_path", tiny_model_path)
+    service.load_model()
+    return service
+
+
 class TestTruncateHistory:
+    @pytest.fixture(autouse=True)
+    def message_cap(self, monkeypatch):
+        monkeypatch.setattr(settings, "max_history_messages", 10)
+
     def _make_messages(self, n: int, with_system: bool = True):
         msgs = []
         if with_system:
@@ -38,9 +75,57 @@ class TestTruncateHistory:
     def test_truncated_length_within_limit(self, service):
         msgs = self._make_messages(20)
         result = service._truncate_history(msgs)
-        from app.config import settings
         assert len(result) <= settings.max_history_messages
 
+    def test_zero_means_no_cap(self, service, monkeypatch):
+        monkeypatch.setattr(settings, "max_history_messages", 0)
+        msgs = self._make_messages(20)
+        assert service._truncate_history(msgs) == msgs
+
+
+class TestTokenBudgetTruncation:
+    @pytest.fixture()
+    def budget_service(self, service, monkeypatch):
+        monkeypatch.setattr(settings, "max_new_tokens", 20)
+        service.model = MagicMock()
+        service.model.n_ctx.return_value = 100
+        service._generation_overhead = 0
+        return service
+
+    def _messages(self, n: int):
+        msgs = [{"role": "system", "content": "sys"}]
+        for i in range(n):
+            msgs.append({"role": "user" if i % 2 == 0 else "assistant", "content": f"m{i}"})
+        return msgs
+
+    def test_drops_oldest_turns_over_budget(self, budget_service):
+        msgs = self._messages(4)
+        result = budget_service._truncate_history(msgs, [10, 30, 30, 25, 20])
+        assert result == [msgs[0], msgs[3], msgs[4]]
+
+    def test_keeps_many_short_messages_within_budget(self, budget_service):
+        msgs = self._messages(30)
+        result = budget_service._truncate_history(msgs, [10] + [2] * 30)
+        assert result == msgs
+
+    def test_keeps_everything_within_budget(self, budget_service):
+        msgs = self._messages(4)
+        result = budget_service._truncate_history(msgs, [10, 10, 10, 10, 10])
+        assert result == msgs
+
+    def test_always_keeps_newest_turn(self, budget_service):
+        msgs = self._messages(2)
+        result = budget_service._truncate_history(msgs, [10, 5, 500])
+        assert result == [msgs[0], msgs[2]]
+
+    def test_missing_counts_are_tokenized(self, budget_service):
+        budget_service._message_overhead = 0
+        budget_service.model.tokenize.return_value = list(range(40))
+        msgs = self._messages(3)
+        result = budget_service._truncate_history(msgs, [10, None, None, None])
+        assert result == [msgs[0], msgs[3]]
+        assert budget_service.model.tokenize.call_count == 2
+
 
 class TestIsLoaded:
     def test_initially_not_loaded(self, service):
@@ -53,6 +138,116 @@ class TestIsLoaded:
             await gen.__anext__()
 
 
+class _FakeStreamingModel:
+    """Stands in for Llama, emitting one chunk per token after ``delay`` seconds."""
+
+    def __init__(self, n_tokens: int = 50, delay: float = 0.0) -> None:
+        self.n_tokens = n_tokens
+        self.delay = delay
+        self.closed = threading.Event()
+
+    def n_ctx(self) -> int:
+        return 8192
+
+    def create_chat_completion(self, **kwargs):
+        def stream():
+            try:
+                for i in range(self.n_tokens):
+                    time.sleep(self.delay)
+                    yield {"choices": [{"delta": {"content": f"t{i} "}}]}
+            finally:
+                self.closed.set()
+
+        return stream()
+
+
+class TestCancellation:
+    MESSAGES = [{"role": "user", "content": "hi"}]
+
+    @pytest.fixture()
+    def fake_service(self, service):
+        service.model = _FakeStreamingModel()
+        service._loaded = True
+        return service
+
+    async def _collect(self, gen):
+        return [chunk async for chunk in gen]
+
+    @pytest.mark.asyncio
+    async def test_complete_reply_is_not_truncated(self, fake_service):
+        chunks = await self._collect(
+            fake_service.generate_stream_async(self.MESSAGES, token_counts=[1])
+        )
+        text = "".join(c["data"] for c in chunks if c["event"] == "token")
+        assert text == "".join(f"t{i} " for i in range(50))
+        assert chunks[-1]["data"]["tokens_generated"] == 50
+        assert chunks[-1]["data"]["truncated"] is None
+
+    @pytest.mark.asyncio
+    async def test_deadline_stops_decoding(self, fake_service, monkeypatch):
+        monkeypatch.setattr(settings, "generation_timeout_s", 0.05)
+        fake_service.model.delay = 0.01
+        chunks = await self._collect(
+            fake_service.generate_stream_async(self.MESSAGES, token_counts=[1])
+        )
+        assert 0 < chunks[-1]["data"]["tokens_generated"] < 50
+        assert chunks[-1]["data"]["truncated"] == "deadline"
+        assert fake_service.model.closed.is_set()
+
+    @pytest.mark.asyncio
+    async def test_cancel_event_stops_decoding(self, fake_service):
+        fake_service.model.delay = 0.005
+        cancel = threading.Event()
+        chunks = []
+        async for chunk in fake_service.generate_stream_async(
+            self.MESSAGES, token_counts=[1], cancel=cancel
+        ):
+            chunks.append(chunk)
+            cancel.set()
+        assert chunks[-1]["data"]["tokens_generated"] < 50
+        assert chunks[-1]["data"]["truncated"] == "cancelled"
+
+    @pytest.mark.asyncio
+    async def test_tokens_are_coalesced_after_the_first(self, fake_service):
+        fake_service.model.delay = 0.001
+        chunks = await self._collect(
+            fake_service.generate_stream_async(
+                self.MESSAGES,
+                token_counts=[1],
+                flush_interval_s=0.05,
+                flush_max_tokens=10,
+            )
+        )
+        tokens = [c["data"] for c in chunks if c["event"] == "token"]
+        assert tokens[0] == "t0 "
+        assert len(tokens) < 50
+        assert "".join(tokens) == "".join(f"t{i} " for i in range(50))
+
+    @pytest.mark.asyncio
+    async def test_generation_is_recorded_in_metrics(self, fake_service):
+        completed = metrics.generations.labels("completed")
+        before = (
+            completed.value,
+            metrics.tokens_generated.value,
+            metrics.time_to_first_token.snapshot()[1],
+        )
+        await self._collect(
+            fake_service.generate_stream_async(self.MESSAGES, token_counts=[1])
+        )
+        assert completed.value == before[0] + 1
+        assert metrics.tokens_generated.value == before[1] + 50
+        assert metrics.time_to_first_token.snapshot()[1] == before[2] + 1
+
+    @pytest.mark.asyncio
+    async def test_closing_stream_releases_model(self, fake_service):
+        fake_service.model.delay = 0.01
+        gen = fake_service.generate_stream_async(self.MESSAGES, token_counts=[1])
+        await gen.__anext__()
+        await gen.aclose()
+        assert fake_service.replicas[0].lock.acquire(timeout=1)
+        assert fake_service.model.closed.is_set()
+
+
 class TestEnforceBudget:
     def test_no_warning_within_budget(self, service, caplog):
         import logging
@@ -65,3 +260,498 @@ class TestEnforceBudget:
         with caplog.at_level(logging.WARNING):
             service._enforce_budget(elapsed=999.0, tokens_generated=50)
         assert "exceeded budget" in caplog.text
+
+
+class TestGenerationScheduler:
+    @pytest.mark.asyncio
+    async def test_first_ticket_is_granted_immediately(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=2)
+        ticket = scheduler.submit()
+        assert ticket.granted is True
+        assert ticket.position == 0
+        assert [p async for p in ticket.wait()] == []
+
+    @pytest.mark.asyncio
+    async def test_waiting_tickets_report_fifo_positions(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=2)
+        scheduler.submit()
+        second = scheduler.submit()
+        third = scheduler.submit()
+        assert second.position == 1
+        assert third.position == 2
+
+    def test_rejects_when_queue_is_full(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=1)
+        scheduler.submit()
+        scheduler.submit()
+        with pytest.raises(QueueFullError):
+            scheduler.submit()
+
+    @pytest.mark.asyncio
+    async def test_release_grants_next_ticket_and_updates_positions(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=2)
+        first = scheduler.submit()
+        second = scheduler.submit()
+        third = scheduler.submit()
+
+        positions = third.wait()
+        assert await positions.__anext__() == 2
+        first.release()
+        assert second.granted is True
+        assert await positions.__anext__() == 1
+        second.release()
+        with pytest.raises(StopAsyncIteration):
+            await positions.__anext__()
+        assert third.granted is True
+
+    def test_releasing_queued_ticket_frees_its_place(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=1)
+        scheduler.submit()
+        queued = scheduler.submit()
+        queued.release()
+        queued.release()
+        assert scheduler.queued_count == 0
+        scheduler.submit()
+
+    @pytest.mark.asyncio
+    async def test_higher_priority_is_granted_first(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=3)
+        first = scheduler.submit()
+        low = scheduler.submit("low")
+        normal = scheduler.submit()
+        high = scheduler.submit("high")
+        assert [high.position, normal.position, low.position] == [1, 2, 3]
+        first.release()
+        assert high.granted
+
+    def test_fair_share_serves_the_lighter_key_first(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=3, fair_share=True)
+        heavy = scheduler.submit(share_key="a")
+        heavy.started_at -= 10.0
+        again = scheduler.submit(share_key="a")
+        other = scheduler.submit(share_key="b")
+        heavy.release()
+        assert scheduler.usage("a") == pytest.approx(10.0, rel=0.01)
+        assert other.granted and not again.granted
+
+    def test_yield_after_time_slice_or_for_higher_class(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=3, time_slice_s=5.0)
+        running = scheduler.submit("normal")
+        scheduler.submit("low")
+        assert not running.should_yield()
+        waiting = scheduler.submit("normal")
+        assert not running.should_yield()
+        running.started_at -= 5.0
+        assert running.should_yield()
+        waiting.release()
+        running.started_at += 5.0
+        scheduler.submit("high")
+        assert running.should_yield()
+
+    def test_requeue_hands_the_slot_on(self):
+        scheduler = GenerationScheduler(max_concurrent=1, max_queued=1, time_slice_s=1.0)
+        running = scheduler.submit()
+        waiting = scheduler.submit()
+        preempted = metrics.generation_preemptions.labels("normal")
+        before = preempted.value
+        running.requeue()
+        assert waiting.granted and not running.granted
+        assert running.position == 1
+        assert running.preemptions == 1
+        assert preempted.value == before + 1
+        waiting.release()
+        assert running.granted
+
+
+class TestPreemption:
+    MESSAGES = [{"role": "user", "content": "hi"}]
+
+    async def _run_interrupted(self, service, messages, conversation_id=None):
+        """Stream ``messages``, letting a second request run once it has paused."""
+        first = service.scheduler.submit()
+        second = None
+        chunks = []
+        other_chunks = []
+        async for chunk in service.generate_stream_async(
+            messages, conversation_id, [1] * len(messages), ticket=first
+        ):
+            chunks.append(chunk)
+            if chunk["event"] == "token" and second is None:
+                second = service.scheduler.submit()
+            if chunk["event"] == "queued":
+                assert second.granted
+                other_chunks = [
+                    c
+                    async for c in service.generate_stream_async(
+                        [{"role": "user", "content": "something else"}], "other", [1]
+                    )
+                ]
+                second.release()
+        first.release()
+        return chunks, other_chunks
+
+    @pytest.mark.asyncio
+    async def test_long_generation_pauses_for_queued_request(self, service):
+        service.model = _FakeStreamingModel(n_tokens=20)
+        service.kv_cache = KVStateCache(capacity_bytes=0)
+        service._loaded = True
+        service.scheduler = GenerationScheduler(1, 4, time_slice_s=1e-6)
+        chunks, other = await self._run_interrupted(service, self.MESSAGES)
+        text = "".join(c["data"] for c in chunks if c["event"] == "token")
+        assert text == "".join(f"t{i} " for i in range(20))
+        assert chunks[-1]["data"]["preemptions"] == 1
+        assert other[-1]["data"]["tokens_generated"] == 20
+        assert service.scheduler.active_count == 0
+
+    @pytest.mark.asyncio
+    async def test_event_loop_keeps_running_after_resume(self, service):
+        service.model = _FakeStreamingModel(n_tokens=30, delay=0.01)
+        service.kv_cache = KVStateCache(capacity_bytes=0)
+        service._loaded = True
+        service.scheduler = GenerationScheduler(1, 4, time_slice_s=1e-6)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.005)
+
+        ticker = asyncio.create_task(tick())
+        first = service.scheduler.submit()
+        second = None
+        resumed_at = None
+        async for chunk in service.generate_stream_async(
+            self.MESSAGES, token_counts=[1], ticket=first
+        ):
+            if chunk["event"] == "token" and second is None:
+                second = service.scheduler.submit()
+            elif chunk["event"] == "queued":
+                second.release()
+                resumed_at = time.perf_counter()
+        finished_at = time.perf_counter()
+        ticker.cancel()
+        first.release()
+        assert resumed_at is not None
+        # The resumed generation waits for its tokens instead of spinning.
+        assert sum(resumed_at < t < finished_at for t in ticks) >= 10
+
+    @pytest.mark.asyncio
+    async def test_resumed_output_matches_uninterrupted(self, loaded_service):
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": "Tell me a long story"},
+        ]
+        baseline = [
+            c async for c in loaded_service.generate_stream_async(messages, "conv-1")
+        ]
+        loaded_service.forget_conversation("conv-1")
+        loaded_service.scheduler = GenerationScheduler(1, 4, time_slice_s=1e-6)
+        chunks, _ = await self._run_interrupted(loaded_service, messages, "conv-1")
+
+        def text(events):
+            return "".join(c["data"] for c in events if c["event"] == "token")
+
+        assert text(chunks) == text(baseline)
+        if baseline[-1]["data"]["tokens_generated"] > 1:
+            assert chunks[-1]["data"]["preemptions"] == 1
+
+
+class TestInterrupt:
+    MESSAGES = [{"role": "user", "content": "Summarize this. " * 40}]
+
+    @pytest.mark.asyncio
+    async def test_interrupt_during_prefill_stops_before_decoding(self, loaded_service):
+        polls = []
+
+        def interrupt():
+            polls.append(loaded_service.model.n_tokens)
+            return len(polls) > 1
+
+        chunks = [
+            c
+            async for c in loaded_service.generate_stream_async(
+                self.MESSAGES, interrupt=interrupt
+            )
+        ]
+        assert chunks[-1]["data"]["truncated"] == "cancelled"
+        assert chunks[-1]["data"]["tokens_generated"] == 0
+        # Stopped after the first batch of a longer prompt.
+        assert polls[1] - polls[0] == loaded_service.model.n_batch
+
+    @pytest.mark.asyncio
+    async def test_batched_prefill_matches_the_plain_path(self, loaded_service):
+        baseline = [c async for c in loaded_service.generate_stream_async(self.MESSAGES)]
+        chunks = [
+            c
+            async for c in loaded_service.generate_stream_async(
+                self.MESSAGES, interrupt=lambda: False
+            )
+        ]
+
+        def text(events):
+            return "".join(c["data"] for c in events if c["event"] == "token")
+
+        assert text(chunks) == text(baseline)
+        assert chunks[-1]["data"]["truncated"] == baseline[-1]["data"]["truncated"]
+
+
+class TestConversationState:
+    def test_resident_conversation_is_not_reloaded(self, service):
+        service.model = MagicMock()
+        with patch("app.services.model_service.restore_snapshot") as restore:
+            service._prepare_context(service.replicas[0], [], "conv-1")
+            service._prepare_context(service.replicas[0], [], "conv-1")
+        restore.assert_not_called()
+        stats = service.kv_cache.stats()
+        assert stats["misses"] == 1
+        assert stats["hits"] == 1
+
+    def test_switching_conversation_restores_snapshot(self, service):
+        service.model = MagicMock()
+        snapshot = MagicMock(nbytes=10)
+        service.kv_cache.put("conv-1", snapshot)
+        service._prepare_context(service.replicas[0], [], "conv-2")
+        with patch("app.services.model_service.restore_snapshot") as restore:
+            service._prepare_context(service.replicas[0], [], "conv-1")
+        restore.assert_called_once_with(service.model, snapshot)
+
+    def test_forget_conversation_drops_snapshot(self, service):
+        snapshot = MagicMock(nbytes=10)
+        service.kv_cache.put("conv-1", snapshot)
+        service.forget_conversation("conv-1")
+        assert service.kv_cache.get("conv-1") is None
+
+
+class TestProfiling:
+    @pytest.mark.asyncio
+    async def test_profile_breaks_down_the_generation(self, loaded_service):
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": "hello there"},
+        ]
+        profile = RequestProfile("conv-1")
+        token = current_profile.set(profile)
+        try:
+            async for _ in loaded_service.generate_stream_async(messages, "conv-1"):
+                pass
+        finally:
+            current_profile.reset(token)
+        assert {"select_history", "render", "context_restore", "prefill", "decode"} <= set(
+            profile.phases
+        )
+        # The system turn was prefilled at load time and is reused.
+        assert 0 < profile.values["prefill_tokens"] < profile.values["prompt_tokens"]
+        assert profile.values["prefill_tokens_per_s"] > 0
+
+    @pytest.mark.asyncio
+    async def test_no_profile_no_extra_work(self, loaded_service):
+        messages = [{"role": "user", "content": "hello"}]
+        with patch.object(
+            loaded_service, "_render_tokens", side_effect=AssertionError
+        ):
+            async for _ in loaded_service.generate_stream_async(messages):
+                pass
+
+
+class TestReplicaRouting:
+    @pytest.fixture()
+    def pool(self, service):
+        service.replicas = [ModelReplica(i, MagicMock()) for i in range(3)]
+        return service
+
+    def test_conversation_returns_to_its_replica(self, pool):
+        pool.replicas[2].resident_conversation = "conv-1"
+        assert pool._pick_replica("conv-1") is pool.replicas[2]
+
+    def test_busy_replica_falls_back_to_least_loaded(self, pool):
+        pool.replicas[2].resident_conversation = "conv-1"
+        pool.replicas[2].begin()
+        pool.replicas[0].begin()
+        assert pool._pick_replica("conv-1") is pool.replicas[1]
+
+    def test_new_conversation_goes_to_least_recently_used(self, pool):
+        pool.replicas[0].begin()
+        pool.replicas[0].finish()
+        pool.replicas[1].begin()
+        pool.replicas[1].finish()
+        assert pool._pick_replica("conv-new") is pool.replicas[2]
+
+    def test_moving_conversation_clears_old_residency(self, pool):
+        pool.replicas[0].resident_conversation = "conv-1"
+        pool._prepare_context(pool.replicas[1], [], "conv-1")
+        assert pool.replicas[0].resident_conversation is None
+        assert pool.replicas[1].resident_conversation == "conv-1"
+
+    @pytest.mark.asyncio
+    async def test_generations_run_on_separate_replicas(self, service):
+        service.replicas = [
+            ModelReplica(i, _FakeStreamingModel(n_tokens=5, delay=0.02)) for i in range(2)
+        ]
+        service.kv_cache = KVStateCache(capacity_bytes=0)
+        service._loaded = True
+
+        async def run(conversation_id):
+            return [
+                chunk
+                async for chunk in service.generate_stream_async(
+                    [{"role": "user", "content": "hi"}], conversation_id, [1]
+                )
+            ]
+
+        start = time.perf_counter()
+        await asyncio.gather(run("conv-1"), run("conv-2"))
+        elapsed = time.perf_counter() - start
+        assert [r.generations for r in service.replicas] == [1, 1]
+        assert [r.active for r in service.replicas] == [0, 0]
+        assert elapsed < 0.18  # two 0.1s generations overlapped
+
+    def test_core_slices_partition_available_cpus(self):
+        slices = _core_slices(2)
+        assert len(slices) == 2
+        if hasattr(os, "sched_getaffinity") and len(os.sched_getaffinity(0)) >= 2:
+            assert slices[0] and slices[1]
+            assert not set(slices[0]) & set(slices[1])
+
+
+class TestSystemPrefix:
+    MESSAGES = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": "What is Python?"},
+    ]
+
+    async def _generate(self, service, messages, conversation_id=None) -> str:
+        tokens = []
+        async for chunk in service.generate_stream_async(messages, conversation_id):
+            if chunk["event"] == "token":
+                tokens.append(chunk["data"])
+        return "".join(tokens)
+
+    def test_load_model_prefills_system_prompt(self, loaded_service):
+        prefix = loaded_service._system_prefix
+        assert prefix is not None
+        assert loaded_service.model.n_tokens == len(prefix.tokens)
+
+    @pytest.mark.asyncio
+    async def test_output_matches_uncached_path(self, loaded_service, tiny_model_path):
+        cached = await self._generate(loaded_service, self.MESSAGES)
+
+        reference = Llama(model_path=tiny_model_path, n_ctx=1024, verbose=False)
+        expected = "".join(
+            chunk["choices"][0]["delta"].get("content", "")
+            for chunk in reference.create_chat_completion(
+                messages=self.MESSAGES,
+                max_tokens=16,
+                temperature=0.0,
+                top_p=settings.top_p,
+                repeat_penalty=settings.repetition_penalty,
+                stream=True,
+            )
+        )
+        assert cached
+        assert cached == expected
+
+    @pytest.mark.asyncio
+    async def test_new_conversation_starts_from_prefix(self, loaded_service):
+        await self._generate(loaded_service, self.MESSAGES, "conv-1")
+        prefix = loaded_service._system_prefix
+        with patch(
+            "app.services.model_service.restore_snapshot", wraps=restore_snapshot
+        ) as restore:
+            loaded_service._prepare_context(
+                loaded_service.replicas[0],
+                [{"role": "system", "content": SYSTEM_PROMPT}],
+                "conv-2",
+            )
+        restore.assert_not_called()  # conv-1's context already starts with it
+        n_prefix = len(prefix.tokens)
+        assert list(loaded_service.model.input_ids[:n_prefix]) == list(prefix.tokens)
+
+    def test_other_system_prompts_keep_the_shared_prefix(self, loaded_service):
+        old_prefix = loaded_service._system_prefix
+        replica = loaded_service.replicas[0]
+        replica.resident_conversation = "conv-1"
+        with patch.object(loaded_service, "_prefill_system_prefix") as prefill:
+            loaded_service._prepare_context(
+                replica, [{"role": "system", "content": "You are terse."}], None
+            )
+        prefill.assert_not_called()
+        assert loaded_service._system_prefix is old_prefix
+        assert loaded_service._system_prefix_prompt == SYSTEM_PROMPT
+        # The summarizer's prompt displaces the resident conversation.
+        assert replica.resident_conversation is None
+
+
+class TestTemplateOverhead:
+    def test_overhead_measured_from_chat_template(self, loaded_service):
+        # "<|im_start|>user\n" ... "<|im_end|>\n" around the content, and
+        # "<|im_start|>assistant\n" to open the reply.
+        assert loaded_service._message_overhead == 8
+        assert loaded_service._generation_overhead == 11
+
+    def test_message_count_matches_rendered_prompt(self, loaded_service):
+        content = "How do I reverse a list?"
+        system = [{"role": "system", "content": SYSTEM_PROMPT}]
+        turn = system + [{"role": "user", "content": content}]
+        expected = len(loaded_service._render_tokens(turn)) - len(
+            loaded_service._render_tokens(system)
+        )
+        assert loaded_service.count_message_tokens(content) == expected
+
+
+class TestStartup:
+    def test_local_model_path_skips_hugging_face(self, tiny_model_path, monkeypatch):
+        monkeypatch.setattr(settings, "n_ctx", 1024)
+        monkeypatch.setattr(settings, "model_path", tiny_model_path)
+        service = ModelService()
+        with patch(
+            "app.services.model_service.hf_hub_download", side_effect=AssertionError
+        ), patch(
+            "app.services.model_service.try_to_load_from_cache", side_effect=AssertionError
+        ):
+            service.load_model()
+        assert service.is_loaded
+        assert set(service.startup_phases) == {"resolve_s", "load_s", "warmup_s"}
+
+    def test_cached_file_is_used_without_download(self, tmp_path):
+        cached = tmp_path / "model.gguf"
+        cached.write_bytes(b"GGUF")
+        with patch(
+            "app.services.model_service.try_to_load_from_cache", return_value=str(cached)
+        ), patch(
+            "app.services.model_service.hf_hub_download", side_effect=AssertionError
+        ):
+            assert _resolve_model_file("org/repo", "model.gguf") == str(cached)
+
+    def test_local_only_refuses_to_download(self, monkeypatch):
+        monkeypatch.setattr(settings, "model_local_only", True)
+        with patch(
+            "app.services.model_service.try_to_load_from_cache", return_value=None
+        ), patch(
+            "app.services.model_service.hf_hub_download", side_effect=AssertionError
+        ):
+            with pytest.raises(FileNotFoundError):
+                _resolve_model_file("org/repo", "model.gguf")
+
+    def test_warm_up_runs_before_ready(self, tiny_model_path, monkeypatch):
+        monkeypatch.setattr(settings, "n_ctx", 1024)
+        monkeypatch.setattr(settings, "warmup_tokens", 2)
+        service = ModelService()
+        seen = []
+        original = service._warm_up
+
+        def warm_up():
+            seen.append(service.is_loaded)
+            original()
+
+        service._warm_up = warm_up
+        monkeypatch.setattr(settings, "model_path", tiny_model_path)
+        service.load_model()
+        assert seen == [False]
+        # Warm-up leaves the context holding only the system prefix.
+        assert service.model.n_tokens == len(service._system_prefix.tokens)
+
+    def test_prefetch_reads_whole_file(self, tmp_path):
+        path = tmp_path / "weights.bin"
+        path.write_bytes(b"x" * 1000)
+        # 1000 is not a multiple of the chunk size, so the last read is partial.
+        assert _prefetch_file(str(path), chunk_bytes=64) == 1000
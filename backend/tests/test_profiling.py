@@ -0,0 +1,82 @@
+import threading
+import time
+
+from app.services.profiling import (
+    ProfileLog,
+    RequestProfile,
+    StackSampler,
+    current_profile,
+    profiled,
+)
+
+
+class TestRequestProfile:
+    def test_phases_accumulate(self):
+        profile = RequestProfile("conv-1")
+        profile.add("decode", 0.25)
+        profile.add("decode", 0.5)
+        with profile.phase("history"):
+            pass
+        profile.set("prefill_tokens", 12)
+        data = profile.as_dict()
+        assert data["phases"]["decode"] == 0.75
+        assert "history" in data["phases"]
+        assert data["prefill_tokens"] == 12
+
+    def test_total_is_frozen_by_finish(self):
+        profile = RequestProfile("conv-1")
+        profile.finish()
+        total = profile.total_s
+        time.sleep(0.01)
+        assert profile.total_s == total
+
+    def test_profiled_is_a_no_op_without_a_profile(self):
+        with profiled("history"):
+            pass
+        profile = RequestProfile("conv-1")
+        token = current_profile.set(profile)
+        try:
+            with profiled("history"):
+                pass
+        finally:
+            current_profile.reset(token)
+        assert "history" in profile.phases
+
+
+class TestProfileLog:
+    def test_slowest_ranks_recent_requests(self):
+        log = ProfileLog(max_recent=2)
+        profiles = []
+        for seconds in (0.03, 0.01, 0.02):
+            profile = RequestProfile("conv")
+            profile._start -= seconds
+            profile.finish()
+            log.record(profile)
+            profiles.append(profile)
+        # The oldest, slowest one has left the ring buffer.
+        assert log.slowest(5) == [profiles[2], profiles[1]]
+
+    def test_capture_is_armed_once(self):
+        log = ProfileLog(max_recent=2)
+        log.arm_capture("conv-1")
+        assert log.take_capture("conv-1")
+        assert not log.take_capture("conv-1")
+        assert not log.take_capture("conv-2")
+
+
+def _busy_wait(stop: threading.Event) -> None:
+    while not stop.is_set():
+        pass
+
+
+def test_stack_sampler_records_watched_threads():
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy_wait, args=(stop,))
+    worker.start()
+    sampler = StackSampler({worker.ident}, interval_s=0.001).start()
+    time.sleep(0.05)
+    stacks = sampler.stop()
+    stop.set()
+    worker.join()
+    assert "test_profiling.py:_busy_wait" in stacks
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in stacks.splitlines())
@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+from llama_cpp import Llama
+
+from app.services.response_cache import (
+    CachedResponse,
+    ExactCache,
+    LlamaEmbedder,
+    ResponseCache,
+    SemanticIndex,
+)
+
+SYSTEM = {"role": "system", "content": "You are helpful."}
+
+
+def _response(text: str) -> CachedResponse:
+    return CachedResponse(chunks=[text], metadata={"tokens_generated": 1, "truncated": None})
+
+
+def _unit(*values: float) -> np.ndarray:
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class TestExactCache:
+    def test_evicts_least_recently_used(self):
+        cache = ExactCache(max_entries=2, ttl_s=60)
+        cache.put("a", _response("A"))
+        cache.put("b", _response("B"))
+        cache.get("a")
+        cache.put("c", _response("C"))
+        assert cache.get("b") is None
+        assert cache.get("a").text == "A"
+
+    def test_expired_entries_are_dropped(self):
+        cache = ExactCache(max_entries=2, ttl_s=0)
+        cache.put("a", _response("A"))
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+
+class TestSemanticIndex:
+    def test_returns_closest_entry_above_threshold(self):
+        index = SemanticIndex(max_entries=4, ttl_s=60, threshold=0.9)
+        index.add(_unit(1, 0, 0), "s", _response("x"))
+        index.add(_unit(0, 1, 0), "s", _response("y"))
+        response, score = index.search(_unit(1, 0.1, 0), "s")
+        assert response.text == "x"
+        assert score > 0.9
+        assert index.search(_unit(1, 1, 0), "s") is None
+
+    def test_other_scopes_are_ignored(self):
+        index = SemanticIndex(max_entries=4, ttl_s=60, threshold=0.9)
+        index.add(_unit(1, 0), "s", _response("x"))
+        assert index.search(_unit(1, 0), "other") is None
+
+    def test_full_index_replaces_least_recently_used(self):
+        index = SemanticIndex(max_entries=2, ttl_s=60, threshold=0.9)
+        index.add(_unit(1, 0, 0), "s", _response("x"))
+        index.add(_unit(0, 1, 0), "s", _response("y"))
+        index.search(_unit(1, 0, 0), "s")
+        index.add(_unit(0, 0, 1), "s", _response("z"))
+        assert index.search(_unit(0, 1, 0), "s") is None
+        assert index.search(_unit(1, 0, 0), "s")[0].text == "x"
+
+
+class TestResponseCache:
+    @pytest.mark.asyncio
+    async def test_exact_hit_after_store(self):
+        cache = ResponseCache(max_entries=8, ttl_s=60)
+        history = [SYSTEM, {"role": "user", "content": "hi"}]
+        miss = await cache.lookup(history)
+        assert miss.hit is None
+        cache.store(miss, _response("hello"))
+
+        hit = await cache.lookup(list(history))
+        assert hit.tier == "exact"
+        assert hit.hit.text == "hello"
+        assert cache.stats()["exact_hits"] == 1
+
+    @pytest.mark.asyncio
+    async def test_sampling_settings_are_part_of_the_key(self, monkeypatch):
+        from app.config import settings
+
+        cache = ResponseCache(max_entries=8, ttl_s=60)
+        history = [SYSTEM, {"role": "user", "content": "hi"}]
+        cache.store(await cache.lookup(history), _response("hello"))
+        monkeypatch.setattr(settings, "temperature", settings.temperature + 0.1)
+        assert (await cache.lookup(history)).hit is None
+
+    @pytest.mark.asyncio
+    async def test_models_do_not_share_replies(self):
+        vectors = {"What is Python?": _unit(1, 0)}
+        small_vectors = {"What is Python?": _unit(1, 0, 0)}
+        cache = ResponseCache(max_entries=8, ttl_s=60, semantic_max_entries=8)
+        history = [SYSTEM, {"role": "user", "content": "What is Python?"}]
+        cache.store(await cache.lookup(history, vectors.get), _response("A language."))
+
+        # Embeddings of another size go to that model's own index.
+        other = await cache.lookup(history, small_vectors.get, model="repo/small.gguf")
+        assert other.hit is None
+        cache.store(other, _response("A snake."))
+        assert (await cache.lookup(history, vectors.get)).hit.text == "A language."
+        again = await cache.lookup(history, small_vectors.get, model="repo/small.gguf")
+        assert again.hit.text == "A snake."
+        assert cache.stats()["semantic_entries"] == 2
+
+    @pytest.mark.asyncio
+    async def test_semantic_hit_for_similar_first_turn(self):
+        vectors = {"What is Python?": _unit(1, 0), "what's python": _unit(1, 0.05)}
+        cache = ResponseCache(
+            max_entries=8, ttl_s=60, semantic_max_entries=8, semantic_threshold=0.95
+        )
+        first = await cache.lookup(
+            [SYSTEM, {"role": "user", "content": "What is Python?"}], vectors.get
+        )
+        cache.store(first, _response("A language."))
+
+        similar = await cache.lookup(
+            [SYSTEM, {"role": "user", "content": "what's python"}], vectors.get
+        )
+        assert similar.tier == "semantic"
+        assert similar.hit.text == "A language."
+
+    @pytest.mark.asyncio
+    async def test_semantic_tier_skips_later_turns(self):
+        def embed(text):
+            raise AssertionError("later turns must not be embedded")
+
+        cache = ResponseCache(max_entries=8, ttl_s=60, semantic_max_entries=8)
+        history = [
+            SYSTEM,
+            {"role": "user", "content": "hi"},
+            {"role": "assistant", "content": "hello"},
+            {"role": "user", "content": "and?"},
+        ]
+        assert (await cache.lookup(history, embed)).tier is None
+
+
+class TestLlamaEmbedder:
+    def test_embeddings_are_unit_length_and_deterministic(self, tiny_model_path):
+        llama = Llama(model_path=tiny_model_path, n_ctx=256, verbose=False)
+        embedder = LlamaEmbedder(llama, n_ctx=128)
+        try:
+            first = embedder("What is Python?")
+            again = embedder("What is Python?")
+            other = embedder("zzzz qqqq")
+        finally:
+            embedder.close()
+        assert first.shape == (llama.n_embd(),)
+        assert np.linalg.norm(first) == pytest.approx(1.0, abs=1e-5)
+        assert float(first @ again) == pytest.approx(1.0, abs=1e-5)
+        assert float(first @ other) < 0.999
@@ -0,0 +1,67 @@
+from app.services import search_index
+from app.services.search_index import InvertedIndex, fts_query, snippet, tokenize
+
+
+def test_tokenize_lowercases_words():
+    assert tokenize("Where's Paris? In FRANCE, 2024.") == [
+        "where", "s", "paris", "in", "france", "2024",
+    ]
+
+
+def test_fts_query_quotes_terms():
+    assert fts_query('paris OR "france" paris*') == '"paris" "or" "france"'
+
+
+class TestSnippet:
+    def test_short_content_is_returned_whole(self):
+        assert snippet("The capital is Paris.", ["paris"]) == "The capital is Paris."
+
+    def test_window_around_first_match(self):
+        content = " ".join(["filler"] * 50 + ["Paris", "is", "lovely"] + ["more"] * 50)
+        text = snippet(content, ["paris"], width=60)
+        assert "Paris is lovely" in text
+        assert text.startswith("…") and text.endswith("…")
+        assert len(text) < 80
+
+
+class TestInvertedIndex:
+    def test_matches_every_term(self):
+        index = InvertedIndex()
+        index.add("a", 0, "The capital of France is Paris")
+        index.add("a", 1, "Paris in spring")
+        index.add("b", 0, "France has good cheese")
+        assert {(c, p) for c, p, _ in index.search("paris")} == {("a", 0), ("a", 1)}
+        assert [(c, p) for c, p, _ in index.search("France PARIS")] == [("a", 0)]
+        assert index.search("paris cheese") == []
+        assert index.search("london") == []
+        assert index.search("?!") == []
+
+    def test_ranks_denser_matches_first(self):
+        index = InvertedIndex()
+        index.add("a", 0, "paris " + "word " * 40)
+        index.add("b", 0, "paris paris trip")
+        index.add("c", 0, "rome")
+        hits = index.search("paris")
+        assert [c for c, _, _ in hits] == ["b", "a"]
+        assert hits[0][2] > hits[1][2] > 0
+
+    def test_limit(self):
+        index = InvertedIndex()
+        for i in range(10):
+            index.add("a", i, f"note {i}")
+        assert len(index.search("note", limit=3)) == 3
+
+    def test_removed_conversations_stop_matching(self, monkeypatch):
+        monkeypatch.setattr(search_index, "_MIN_COMPACT", 2)
+        index = InvertedIndex()
+        index.add("a", 0, "paris")
+        index.add("b", 0, "paris rome")
+        index.add("b", 1, "rome")
+        index.remove_conversation("b")
+        index.remove_conversation("missing")
+        assert len(index) == 1
+        assert [c for c, _, _ in index.search("paris")] == ["a"]
+        # Compacted: postings of removed messages are gone.
+        assert "rome" not in index._postings
+        index.add("c", 0, "rome")
+        assert [c for c, _, _ in index.search("rome")] == ["c"]
@@ -0,0 +1,154 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from llama_cpp import Llama
+
+from app.config import settings
+from app.services.conversation_service import SYSTEM_PROMPT
+from app.services.model_service import ModelService
+from app.services.speculative import (
+    DraftStats,
+    MeteredDraftModel,
+    create_draft_model,
+    metered_drafts,
+)
+
+MESSAGES = [
+    {"role": "system", "content": SYSTEM_PROMPT},
+    {"role": "user", "content": "Repeat after me: one two three, one two three"},
+]
+
+
+class _FixedDraft:
+    def __init__(self, draft: list[int]) -> None:
+        self.draft = draft
+
+    def __call__(self, input_ids, **kwargs):
+        return np.array(self.draft, dtype=np.intc)
+
+
+def _ids(*tokens: int):
+    return np.array(tokens, dtype=np.intc)
+
+
+class TestMeteredDraftModel:
+    def test_counts_accepted_prefix_of_previous_draft(self):
+        metered = MeteredDraftModel(_FixedDraft([7, 8, 9]), "prompt_lookup")
+        stats = DraftStats("prompt_lookup")
+        metered(_ids(1, 2, 3), stats=stats)
+        # 7 and 8 kept, 9 replaced by the target's own sample 5.
+        metered(_ids(1, 2, 3, 7, 8, 5), stats=stats)
+        assert stats.drafted == 6
+        assert stats.accepted == 2
+
+    def test_fully_accepted_draft_ends_with_bonus_token(self):
+        metered = MeteredDraftModel(_FixedDraft([7, 8]), "prompt_lookup")
+        stats = DraftStats("prompt_lookup")
+        metered(_ids(1), stats=stats)
+        metered(_ids(1, 7, 8, 4), stats=stats)
+        assert stats.accepted == 2
+        assert stats.acceptance_rate == 0.5
+
+    def test_generations_keep_separate_stats(self):
+        metered = MeteredDraftModel(_FixedDraft([7]), "prompt_lookup")
+        first, second = DraftStats("prompt_lookup"), DraftStats("prompt_lookup")
+        metered(_ids(1), stats=first)
+        metered(_ids(1, 7, 2), stats=second)  # the earlier draft belongs to ``first``
+        metered(_ids(1, 7, 3), stats=first)
+        assert (first.drafted, first.accepted) == (2, 1)
+        assert (second.drafted, second.accepted) == (1, 0)
+
+    def test_metered_drafts_binds_fresh_stats_to_the_model(self):
+        metered = MeteredDraftModel(_FixedDraft([7]), "prompt_lookup")
+        model = SimpleNamespace(draft_model=metered)
+        with metered_drafts(model) as stats:
+            model.draft_model(_ids(1))
+            model.draft_model(_ids(1, 7, 2))
+        assert model.draft_model is metered
+        assert (stats.drafted, stats.accepted) == (2, 1)
+        with metered_drafts(model) as again:
+            assert again is not stats and again.drafted == 0
+
+    def test_unmetered_model_yields_no_stats(self):
+        with metered_drafts(SimpleNamespace(draft_model=None)) as stats:
+            assert stats is None
+
+    def test_no_draft_means_no_rate(self):
+        assert DraftStats("prompt_lookup").acceptance_rate is None
+
+
+class TestCreateDraftModel:
+    def test_off_returns_none(self):
+        assert create_draft_model("off", 10) is None
+
+    def test_draft_model_mode_needs_a_model(self):
+        with pytest.raises(ValueError):
+            create_draft_model("draft_model", 10)
+
+    def test_unknown_mode_is_rejected(self):
+        with pytest.raises(ValueError):
+            create_draft_model("medusa", 10)
+
+
+@pytest.fixture()
+def speculative_settings(tiny_model_path, monkeypatch):
+    monkeypatch.setattr(settings, "model_path", tiny_model_path)
+    monkeypatch.setattr(settings, "draft_model_path", tiny_model_path)
+    monkeypatch.setattr(settings, "n_ctx", 1024)
+    monkeypatch.setattr(settings, "max_new_tokens", 16)
+    monkeypatch.setattr(settings, "temperature", 0.0)
+    monkeypatch.setattr(settings, "speculative_draft_tokens", 4)
+
+
+async def _generate(service) -> tuple[str, dict]:
+    text, metadata = [], {}
+    async for chunk in service.generate_stream_async(MESSAGES, "conv-1"):
+        if chunk["event"] == "token":
+            text.append(chunk["data"])
+        else:
+            metadata = chunk["data"]
+    return "".join(text), metadata
+
+
+class TestSpeculativeModelService:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("mode", ["prompt_lookup", "draft_model"])
+    async def test_output_matches_plain_decoding(
+        self, mode, tiny_model_path, speculative_settings, monkeypatch
+    ):
+        monkeypatch.setattr(settings, "speculative_mode", mode)
+        service = ModelService()
+        service.load_model()
+        text, metadata = await _generate(service)
+
+        reference = Llama(model_path=tiny_model_path, n_ctx=1024, verbose=False)
+        expected = "".join(
+            chunk["choices"][0]["delta"].get("content", "")
+            for chunk in reference.create_chat_completion(
+                messages=MESSAGES,
+                max_tokens=16,
+                temperature=0.0,
+                top_p=settings.top_p,
+                repeat_penalty=settings.repetition_penalty,
+                stream=True,
+            )
+        )
+        assert text == expected
+        speculative = metadata["speculative"]
+        assert speculative["mode"] == mode
+        assert 0 <= speculative["accepted"] <= speculative["drafted"]
+        if mode == "draft_model":
+            # The draft is the target model itself, so it proposes every step.
+            assert speculative["drafted"] > 0
+
+    @pytest.mark.asyncio
+    async def test_metadata_has_no_speculative_stats_when_off(
+        self, tiny_model_path, speculative_settings
+    ):
+        service = ModelService()
+        service.load_model()
+        _, metadata = await _generate(service)
+        assert "speculative" not in metadata
+        assert "tokens_per_s" in metadata
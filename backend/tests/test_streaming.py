@@ -0,0 +1,164 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.services.streaming import SharedStream, TokenBuffer
+
+
+def _produce(buffer: TokenBuffer, n_tokens: int, finish: bool = True) -> threading.Thread:
+    def run():
+        for i in range(n_tokens):
+            buffer.put("token", str(i))
+        if finish:
+            buffer.put("done", None)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+class TestTokenBuffer:
+    @pytest.mark.asyncio
+    async def test_returns_events_in_order(self):
+        buffer = TokenBuffer(asyncio.get_running_loop())
+        _produce(buffer, 100).join()
+        items = []
+        while not items or items[-1][0] != "done":
+            items.extend(await buffer.get_batch())
+        assert [p for k, p in items if k == "token"] == [str(i) for i in range(100)]
+
+    @pytest.mark.asyncio
+    async def test_burst_costs_one_wakeup(self):
+        buffer = TokenBuffer(asyncio.get_running_loop())
+        waiter = asyncio.ensure_future(buffer.get_batch())
+        await asyncio.sleep(0)
+        _produce(buffer, 100).join()
+        items = await waiter
+        assert len(items) == 101
+        assert buffer.wakeups == 1
+        assert await buffer.get_batch() == []
+
+    @pytest.mark.asyncio
+    async def test_waits_for_max_items_within_delay(self):
+        buffer = TokenBuffer(asyncio.get_running_loop())
+        buffer.put("token", "a")
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, buffer.put, "token", "b")
+        items = await buffer.get_batch(max_items=2, max_delay=1.0)
+        assert [p for _, p in items] == ["a", "b"]
+
+    @pytest.mark.asyncio
+    async def test_delay_bounds_the_wait(self):
+        buffer = TokenBuffer(asyncio.get_running_loop())
+        buffer.put("token", "a")
+        items = await asyncio.wait_for(
+            buffer.get_batch(max_items=10, max_delay=0.01), timeout=1.0
+        )
+        assert items == [("token", "a")]
+
+    @pytest.mark.asyncio
+    async def test_terminal_event_ends_the_wait(self):
+        buffer = TokenBuffer(asyncio.get_running_loop())
+        buffer.put("token", "a")
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, buffer.put, "done", None)
+        items = await asyncio.wait_for(
+            buffer.get_batch(max_items=10, max_delay=5.0), timeout=1.0
+        )
+        assert items[-1] == ("done", None)
+
+
+async def _events(n: int, gate: asyncio.Event | None = None, log: list | None = None):
+    try:
+        for i in range(n):
+            if gate is not None and i == 1:
+                await gate.wait()
+            yield {"event": "token", "data": str(i)}
+    finally:
+        if log is not None:
+            log.append("closed")
+
+
+class TestSharedStream:
+    @pytest.mark.asyncio
+    async def test_late_subscriber_gets_every_event(self):
+        gate = asyncio.Event()
+        shared = SharedStream(_events(3, gate))
+        first = shared.subscribe()
+        assert (await first.__anext__())["data"] == "0"
+
+        late = shared.subscribe()
+        gate.set()
+        rest = [e["data"] async for e in first]
+        assert rest == ["1", "2"]
+        assert [e["data"] async for e in late] == ["0", "1", "2"]
+        assert shared.finished
+
+    @pytest.mark.asyncio
+    async def test_source_is_cancelled_when_last_subscriber_leaves(self):
+        gate, log = asyncio.Event(), []
+        shared = SharedStream(_events(3, gate, log))
+        a, b = shared.subscribe(), shared.subscribe()
+        await a.__anext__()
+        await b.__anext__()
+
+        await a.aclose()
+        assert not shared.cancelled
+        await b.aclose()
+        assert shared.cancelled
+        await asyncio.sleep(0)
+        assert log == ["closed"]
+
+    @pytest.mark.asyncio
+    async def test_unsubscribed_stream_is_released(self):
+        gate, log = asyncio.Event(), []
+        shared = SharedStream(_events(3, gate, log))
+        await asyncio.sleep(0)
+        shared.release_if_idle()
+        await asyncio.sleep(0)
+        assert shared.cancelled
+        assert log == ["closed"]
+
+    @pytest.mark.asyncio
+    async def test_resume_after_last_event_id(self):
+        shared = SharedStream(_events(4))
+        events = [e async for e in shared.subscribe()]
+        assert [e["id"] for e in events] == ["0", "1", "2", "3"]
+
+        resumed = [e async for e in shared.subscribe(after=1)]
+        assert [(e["id"], e["data"]) for e in resumed] == [("2", "2"), ("3", "3")]
+
+    @pytest.mark.asyncio
+    async def test_replay_buffer_is_bounded(self):
+        shared = SharedStream(_events(5), max_events=2)
+        assert [e["id"] async for e in shared.subscribe(after=2)] == ["3", "4"]
+        assert shared.can_resume_after(2)
+        assert not shared.can_resume_after(1)
+        assert not shared.can_resume_after(5)
+
+    @pytest.mark.asyncio
+    async def test_reconnect_within_grace_keeps_source_running(self):
+        gate, log = asyncio.Event(), []
+        shared = SharedStream(_events(3, gate, log), idle_grace_s=0.05)
+        first = shared.subscribe()
+        await first.__anext__()
+        await first.aclose()
+
+        await asyncio.sleep(0.01)
+        resumed = shared.subscribe(after=0)
+        gate.set()
+        assert [e["data"] async for e in resumed] == ["1", "2"]
+        assert not shared.cancelled
+
+    @pytest.mark.asyncio
+    async def test_source_is_cancelled_after_grace(self):
+        gate, log = asyncio.Event(), []
+        shared = SharedStream(_events(3, gate, log), idle_grace_s=0.01)
+        first = shared.subscribe()
+        await first.__anext__()
+        await first.aclose()
+        assert not shared.cancelled
+        await asyncio.sleep(0.05)
+        assert shared.cancelled
+        assert log == ["closed"]
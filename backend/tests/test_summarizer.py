@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from app.config import settings
+from app.services.conversation_service import SUMMARY_PREFIX, ConversationService
+from app.services.model_service import GenerationScheduler, ModelService
+from app.services.summarizer import HistorySummarizer, summary_prompt
+
+
+class _StubModel:
+    """Streams fixed tokens, letting a test queue a request mid-generation."""
+
+    def __init__(self, tokens: list[str], on_token=None) -> None:
+        self.tokens = tokens
+        self.on_token = on_token
+        self.is_loaded = True
+        self.scheduler = GenerationScheduler(max_concurrent=1, max_queued=4)
+
+    async def generate_stream_async(self, messages, cancel=None, max_tokens=None, interrupt=None):
+        for token in self.tokens:
+            if cancel.is_set() or interrupt():
+                yield {"event": "metadata", "data": {"truncated": "cancelled"}}
+                return
+            yield {"event": "token", "data": token}
+            if self.on_token is not None:
+                self.on_token(self)
+        yield {"event": "metadata", "data": {"truncated": None}}
+
+
+def _conversations() -> ConversationService:
+    service = ConversationService(token_counter=len, summary_trigger_tokens=20)
+    for role, content in [
+        ("user", "My name is Ada and I like tea."),
+        ("assistant", "Nice to meet you, Ada."),
+        ("user", "Thanks"),
+        ("assistant", "Sure"),
+    ]:
+        service.add_message("conv-1", role, content)
+    return service
+
+
+def test_prompt_carries_previous_summary_and_new_turns():
+    conversations = _conversations()
+    conversations.apply_summary(conversations.pending_summary("conv-1"), "Ada likes tea.")
+    conversations.add_message("conv-1", "user", "x" * 40)
+    conversations.add_message("conv-1", "assistant", "ok")
+    messages = summary_prompt(conversations.pending_summary("conv-1"))
+    assert "Summary so far:\nAda likes tea." in messages[1]["content"]
+    assert "User: Thanks" in messages[1]["content"]
+
+
+@pytest.mark.asyncio
+async def test_summary_is_stored():
+    conversations = _conversations()
+    summarizer = HistorySummarizer(conversations, _StubModel(["Ada ", "likes tea."]), 32)
+    assert await summarizer.summarize("conv-1") is True
+    history = conversations.get_history("conv-1")
+    assert history[1]["content"] == SUMMARY_PREFIX + "Ada likes tea."
+    assert [m["content"] for m in history[2:]] == ["Thanks", "Sure"]
+    assert summarizer.model.scheduler.active_count == 0
+
+
+@pytest.mark.asyncio
+async def test_queued_request_interrupts_summary():
+    waiting = []
+
+    def queue_request(model):
+        if not waiting:
+            waiting.append(model.scheduler.submit())
+
+    conversations = _conversations()
+    summarizer = HistorySummarizer(
+        conversations, _StubModel(["a", "b", "c"], on_token=queue_request), 32
+    )
+    assert await summarizer.summarize("conv-1") is False
+    assert len(conversations.get_history("conv-1")) == 5
+    # The slot went to the waiting request.
+    assert waiting[0].granted
+
+
+@pytest.mark.asyncio
+async def test_run_waits_for_idle_then_summarizes():
+    conversations = _conversations()
+    model = _StubModel(["gist"])
+    busy = model.scheduler.submit()
+    summarizer = HistorySummarizer(conversations, model, 32, poll_interval_s=0.01)
+    task = asyncio.create_task(summarizer.run())
+    summarizer.schedule("conv-1")
+    await asyncio.sleep(0.05)
+    assert conversations.get_or_create("conv-1").summary == ""
+    busy.release()
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert conversations.get_or_create("conv-1").summary == "gist"
+
+
+@pytest.mark.asyncio
+async def test_summarizes_with_the_model(tiny_model_path, monkeypatch):
+    monkeypatch.setattr(settings, "n_ctx", 1024)
+    model = ModelService()
+    monkeypatch.setattr(settings, "model_path", tiny_model_path)
+    model.load_model()
+    conversations = _conversations()
+    conversations.set_token_counter(len)
+    summarizer = HistorySummarizer(conversations, model, max_tokens=8)
+    result = await summarizer.summarize("conv-1")
+    convo = conversations.get_or_create("conv-1")
+    # Random weights may well produce only whitespace; either way the
+    # scheduler slot is handed back.
+    assert result in (True, None)
+    assert (convo.summarized_count == 2) is bool(convo.summary)
+    assert model.scheduler.active_count == 0
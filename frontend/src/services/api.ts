@@ -30,10 +30,15 @@ function extractSSEValue(line: string, prefix: string): string {
   return raw.startsWith(" ") ? raw.slice(1) : raw;
 }
 
+interface SSEState {
+  currentEvent: string;
+  lastEventId: string | null;
+}
+
 function parseSSE(
   chunk: string,
   callbacks: StreamCallbacks,
-  state: { currentEvent: string },
+  state: SSEState,
 ): void {
   const lines = chunk.split("\n");
 
@@ -41,7 +46,9 @@ function parseSSE(
     const line = rawLine.replace(/\r$/, "");
     if (!line) continue;
 
-    if (line.startsWith("event:")) {
+    if (line.startsWith("id:")) {
+      state.lastEventId = extractSSEValue(line, "id:").trim();
+    } else if (line.startsWith("event:")) {
       state.currentEvent = extractSSEValue(line, "event:").trim();
     } else if (line.startsWith("data:")) {
       const data = extractSSEValue(line, "data:");
@@ -69,12 +76,83 @@ function parseSSE(
   }
 }
 
+async function readSSE(
+  res: Response,
+  callbacks: StreamCallbacks,
+  state: SSEState,
+): Promise<void> {
+  const reader = res.body?.getReader();
+  if (!reader) {
+    callbacks.onError("No response body");
+    return;
+  }
+
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, "\n");
+
+    const lastDoubleNewline = buffer.lastIndexOf("\n\n");
+    if (lastDoubleNewline === -1) continue;
+
+    const complete = buffer.slice(0, lastDoubleNewline + 2);
+    buffer = buffer.slice(lastDoubleNewline + 2);
+
+    parseSSE(complete, callbacks, state);
+  }
+
+  if (buffer.trim()) {
+    parseSSE(buffer, callbacks, state);
+  }
+}
+
+const MAX_RESUME_ATTEMPTS = 3;
+
 export function streamChat(
   conversationId: string,
   message: string,
   callbacks: StreamCallbacks,
 ): AbortController {
   const controller = new AbortController();
+  const state: SSEState = { currentEvent: "", lastEventId: null };
+  let streamId: string | null = null;
+  let finished = false;
+
+  const guardedCallbacks: StreamCallbacks = {
+    ...callbacks,
+    onDone: () => {
+      if (!finished) {
+        finished = true;
+        callbacks.onDone();
+      }
+    },
+  };
+
+  // A dropped connection reattaches to the same generation and receives
+  // only the events after the last one seen, instead of regenerating.
+  async function resume(): Promise<void> {
+    for (let attempt = 1; attempt <= MAX_RESUME_ATTEMPTS; attempt++) {
+      await new Promise((resolve) => setTimeout(resolve, 500 * attempt));
+      if (controller.signal.aborted) return;
+      try {
+        const res = await fetch(`${API_BASE}/api/chat/streams/${streamId}`, {
+          headers: state.lastEventId ? { "Last-Event-ID": state.lastEventId } : {},
+          signal: controller.signal,
+        });
+        if (!res.ok) break;
+        state.currentEvent = "";
+        await readSSE(res, guardedCallbacks, state);
+        return;
+      } catch (err: unknown) {
+        if (err instanceof DOMException && err.name === "AbortError") return;
+      }
+    }
+    throw new Error("Connection lost");
+  }
 
   fetch(`${API_BASE}/api/chat`, {
     method: "POST",
@@ -90,45 +168,14 @@ export function streamChat(
         callbacks.onError(`Server error: ${res.status}`);
         return;
       }
-
-      const reader = res.body?.getReader();
-      if (!reader) {
-        callbacks.onError("No response body");
-        return;
-      }
-
-      const decoder = new TextDecoder();
-      const state = { currentEvent: "" };
-      let buffer = "";
-      let finished = false;
-
-      const guardedCallbacks: StreamCallbacks = {
-        ...callbacks,
-        onDone: () => {
-          if (!finished) {
-            finished = true;
-            callbacks.onDone();
-          }
-        },
-      };
-
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-
-        buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, "\n");
-
-        const lastDoubleNewline = buffer.lastIndexOf("\n\n");
-        if (lastDoubleNewline === -1) continue;
-
-        const complete = buffer.slice(0, lastDoubleNewline + 2);
-        buffer = buffer.slice(lastDoubleNewline + 2);
-
-        parseSSE(complete, guardedCallbacks, state);
-      }
-
-      if (buffer.trim()) {
-        parseSSE(buffer, guardedCallbacks, state);
+      streamId = res.headers.get("X-Stream-Id");
+
+      try {
+        await readSSE(res, guardedCallbacks, state);
+      } catch (err: unknown) {
+        if (err instanceof DOMException && err.name === "AbortError") throw err;
+        if (!streamId || finished) throw err;
+        await resume();
       }
 
       guardedCallbacks.onDone();